@@ -0,0 +1,53 @@
+"""
+Throughput of the log formatters
+
+Formats the same record with the text formatter, RobustFormatter and
+JsonLinesFormatter (with each JSON encoder installed) and prints how many
+records per second each one formats.
+
+Run with:
+  python benchmarks/log_formatter_bench.py [records]
+"""
+import logging
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('EAGER_STARTUP', 'false')
+os.environ.setdefault('DATABASE_URI', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+import service  # pylint: disable=wrong-import-position,unused-import
+from loggin.logger import (RobustFormatter, JsonLinesFormatter,  # pylint: disable=wrong-import-position
+                           get_logger_settings)
+
+RECORDS = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+
+
+def formatters():
+    """ The formatters to compare, by name """
+    text = get_logger_settings(tempfile.gettempdir())['formatters']['fmt']
+    yield 'text (fmt)', logging.Formatter(text['format'], text['datefmt'])
+    yield 'RobustFormatter', RobustFormatter()
+    for encoder in ('json', 'ujson', 'orjson'):
+        try:
+            yield 'JsonLinesFormatter ({})'.format(encoder), JsonLinesFormatter(encoder)
+        except ImportError:
+            print('{:<28} not installed'.format('JsonLinesFormatter ({})'.format(encoder)))
+
+
+def main():
+    record = logging.LogRecord('app', logging.INFO, __file__, 42,
+                               'Processing lookup for id %s ...', (1234,), None)
+    record.request_id = '5f0c8e3d9b2a4c1e8f7d6b5a4c3e2d1f'
+    record.method = 'GET'
+    record.route = '/products/<product_id>'
+    record.latency_ms = 1.234
+    for name, formatter in formatters():
+        best = min(timeit.repeat(lambda: formatter.format(record), number=RECORDS, repeat=3))
+        print('{:<28} {:>10,.0f} records/s'.format(name, RECORDS / best))
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,50 @@
+"""
+Per-request overhead of the metrics
+
+Times RequestMetrics.start and observe on their own, and a request to a
+bare WSGI application with and without MetricsMiddleware around it.
+
+Run with:
+  python benchmarks/metrics_bench.py [requests]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+os.environ.setdefault('EAGER_STARTUP', 'false')
+os.environ.setdefault('DATABASE_URI', 'sqlite:///' + os.path.join(tempfile.mkdtemp(), 'bench.db'))
+
+from service import metrics  # pylint: disable=wrong-import-position
+
+REQUESTS = int(sys.argv[1]) if len(sys.argv) > 1 else 200000
+
+
+def counters():
+    """ Counting one request: start, then observe """
+    metrics.metrics.start()
+    metrics.metrics.observe('/products/<product_id>', 'GET', 200, 0.0042)
+
+
+def bare_app(environ, start_response):
+    """ A WSGI application doing nothing but answer """
+    start_response('200 OK', [])
+    return [b'']
+
+
+def main():
+    best = min(timeit.repeat(counters, number=REQUESTS, repeat=3))
+    print('{:<28} {:6.2f} us/request'.format('start + observe', best / REQUESTS * 1e6))
+    environ = {'REQUEST_METHOD': 'GET'}
+    start_response = lambda status, headers, exc_info=None: None
+    middleware = metrics.MetricsMiddleware(bare_app, metrics.RequestMetrics())
+    bare = min(timeit.repeat(lambda: bare_app(environ, start_response),
+                             number=REQUESTS, repeat=3))
+    timed = min(timeit.repeat(lambda: middleware(environ, start_response),
+                              number=REQUESTS, repeat=3))
+    print('{:<28} {:6.2f} us/request'.format('middleware overhead',
+                                             (timed - bare) / REQUESTS * 1e6))
+
+if __name__ == '__main__':
+    main()
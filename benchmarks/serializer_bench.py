@@ -0,0 +1,64 @@
+"""
+Per-row cost of the product read path
+
+Compares reading a page of Products through the ORM, Product.serialize()
+and marshal() with reading plain rows through the compiled serializer.
+
+Run with:
+  python benchmarks/serializer_bench.py [rows]
+"""
+import os
+import sys
+import tempfile
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(__file__), '..'))
+DATABASE = os.path.join(tempfile.mkdtemp(), 'bench.db')
+os.environ.setdefault('EAGER_STARTUP', 'false')
+os.environ.setdefault('DATABASE_URI', 'sqlite:///' + DATABASE)
+
+from flask_restplus import marshal  # pylint: disable=wrong-import-position
+from service import app  # pylint: disable=wrong-import-position
+from service.model import Product, db  # pylint: disable=wrong-import-position
+from service.service import product_model, serialize_row  # pylint: disable=wrong-import-position
+
+ROWS = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+REPEAT = 20
+
+
+def orm_path():
+    """ The read path before: hydrate Products, serialize, then marshal """
+    products = Product.query.order_by(Product.id).limit(ROWS).all()
+    result = marshal([product.serialize() for product in products], product_model)
+    db.session.remove()
+    return result
+
+
+def row_path():
+    """ The read path now: select column tuples and compile them to dicts """
+    rows = Product.rows(Product.query).order_by(Product.id).limit(ROWS).all()
+    result = [serialize_row(row) for row in rows]
+    db.session.remove()
+    return result
+
+
+def main():
+    app.config['SQLALCHEMY_DATABASE_URI'] = os.environ['DATABASE_URI']
+    app.config['PRODUCT_CACHE_SIZE'] = 0
+    with app.app_context():
+        Product.init_db(app)
+        db.drop_all()
+        db.create_all()
+        Product.create_many([Product(name='Product {}'.format(i), category='Food', stock=i,
+                                     price='{}.99'.format(i % 100), description='Benchmark')
+                             for i in range(ROWS)])
+        assert orm_path() == row_path(), 'the two paths must produce the same output'
+        for name, path in (('orm + serialize + marshal', orm_path),
+                           ('rows + serialize_row', row_path)):
+            best = min(timeit.repeat(path, number=1, repeat=REPEAT))
+            print('{:<28} {:8.2f} us/row'.format(name, best / ROWS * 1e6))
+        db.drop_all()
+
+
+if __name__ == '__main__':
+    main()
@@ -32,18 +32,18 @@ def step_impl(context):
     headers = {'X-Api-Key': context.API_KEY, 'Content-Type': 'application/json'}
     context.resp = requests.delete(context.base_url + '/products/reset')
     expect(context.resp.status_code).to_equal(204)
-    create_url = context.base_url + '/products'
-    for row in context.table:
-        data = {
-            "name": row['name'],
-            "stock": row['stock'],
-            "price": row['price'],
-            "description": row['description'],
-            "category": row['category']
-        }
-        payload = json.dumps(data)
-        context.resp = requests.post(create_url, data=payload, headers=headers)
-        expect(context.resp.status_code).to_equal(201)
+    create_url = context.base_url + '/products/batch'
+    data = [{
+        "name": row['name'],
+        "stock": row['stock'],
+        "price": row['price'],
+        "description": row['description'],
+        "category": row['category']
+    } for row in context.table]
+    payload = json.dumps(data)
+    context.resp = requests.post(create_url, data=payload, headers=headers)
+    expect(context.resp.status_code).to_equal(201)
+    expect(len(context.resp.json()['ids'])).to_equal(len(data))
 
 
 ##################################################################
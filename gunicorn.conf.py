@@ -0,0 +1,142 @@
+"""
+Gunicorn configuration for production
+
+Sizes the workers and their threads from the CPUs this process may run on
+and the memory it is allowed, preloads the app so that the startup work
+(database, pool, cache) is done once before the workers are forked, and
+recycles workers after a number of requests, with jitter so they do not
+all restart at once.
+
+Every setting can be overridden from the environment:
+  GUNICORN_WORKER_CLASS  gthread (default), sync or gevent (monkey-patched
+                         here, before the app is preloaded)
+  WEB_CONCURRENCY        number of workers
+  GUNICORN_THREADS       threads per gthread worker (default 4)
+  WORKER_MEMORY_MB       memory to budget per worker (default 128)
+  MEMORY_LIMIT           memory limit, e.g. 512M (default: the cgroup limit)
+  GUNICORN_MAX_REQUESTS  requests before a worker is recycled (default 1000, 0 never)
+
+Run with:
+  gunicorn --config gunicorn.conf.py service:app
+"""
+import os
+
+# gevent has to patch the standard library before the app is preloaded:
+# otherwise the thread locals, queues and locks the app creates in the
+# master stay thread based and every greenlet of a worker shares them
+if os.getenv('GUNICORN_WORKER_CLASS', 'gthread') == 'gevent':
+    from gevent import monkey
+    monkey.patch_all()
+
+import multiprocessing  # pylint: disable=wrong-import-position
+
+DEFAULT_THREADS = 4
+# Database connections of a gevent worker, however many greenlets it runs
+GEVENT_POOL_SIZE_MAX = 20
+DEFAULT_WORKER_MEMORY_MB = 128
+CGROUP_MEMORY_LIMITS = ('/sys/fs/cgroup/memory.max',
+                        '/sys/fs/cgroup/memory/memory.limit_in_bytes')
+MEMORY_UNITS = {'K': 2 ** 10, 'M': 2 ** 20, 'G': 2 ** 30}
+
+
+def cpu_count():
+    """ The CPUs this process may run on """
+    try:
+        return len(os.sched_getaffinity(0))
+    except AttributeError:
+        return multiprocessing.cpu_count()
+
+
+def memory_limit():
+    """ The memory this process may use in bytes, or None when unlimited """
+    value = os.getenv('MEMORY_LIMIT')
+    if value:
+        value = value.strip().upper().rstrip('B')
+        if value[-1:] in MEMORY_UNITS:
+            return int(float(value[:-1]) * MEMORY_UNITS[value[-1]])
+        return int(value)
+    for path in CGROUP_MEMORY_LIMITS:
+        try:
+            with open(path) as limit_file:
+                limit = limit_file.read().strip()
+        except OSError:
+            continue
+        # cgroup v1 reports an unset limit as a huge number
+        if limit != 'max' and int(limit) < 2 ** 60:
+            return int(limit)
+    return None
+
+
+def worker_count(worker_class, cpus, memory):
+    """ Workers for the CPUs, no more than fit in memory """
+    if worker_class == 'sync':
+        count = 2 * cpus + 1
+    else:
+        # threads and greenlets wait on I/O, a process per CPU keeps them busy
+        count = cpus
+    if memory is not None:
+        per_worker = int(os.getenv('WORKER_MEMORY_MB', DEFAULT_WORKER_MEMORY_MB)) * 2 ** 20
+        count = min(count, memory // per_worker)
+    return max(count, 1)
+
+
+bind = '0.0.0.0:{}'.format(os.getenv('PORT', '5000'))
+worker_class = os.getenv('GUNICORN_WORKER_CLASS', 'gthread')
+workers = int(os.getenv('WEB_CONCURRENCY', '0')) or \
+    worker_count(worker_class, cpu_count(), memory_limit())
+threads = int(os.getenv('GUNICORN_THREADS', DEFAULT_THREADS)) if worker_class == 'gthread' else 1
+worker_connections = 1000
+preload_app = True
+max_requests = int(os.getenv('GUNICORN_MAX_REQUESTS', '1000'))
+max_requests_jitter = max_requests // 10
+timeout = 30
+graceful_timeout = 30
+keepalive = 5
+# The heartbeat file of the workers, kept in memory when possible
+worker_tmp_dir = '/dev/shm' if os.path.isdir('/dev/shm') else None
+errorlog = '-'
+
+# One database connection per thread, or per greenlet up to
+# GEVENT_POOL_SIZE_MAX, unless set otherwise; the config is read before the
+# app is preloaded
+pool_size = min(worker_connections, GEVENT_POOL_SIZE_MAX) if worker_class == 'gevent' \
+    else threads
+os.environ.setdefault('DB_POOL_SIZE', str(pool_size))
+
+
+def when_ready(server):
+    """
+    The master serves no requests: it stops retrying the startup and gives
+    up its connections and probes
+    """
+    from service import app, health, startup
+    from service.model import db
+    startup.stop_retry()
+    health.monitor.stop()
+    db.get_engine(app).dispose()
+    server.log.info('Starting %d %s workers with %d threads', workers, worker_class, threads)
+
+
+def pre_fork(server, worker):
+    """ Writes out the queued log records, so no worker inherits them """
+    from loggin import logger
+    logger.flush_logging()
+
+
+def child_exit(server, worker):
+    """ Folds the metrics of an exited worker into those of the dead workers """
+    from service import app, metrics
+    if app.config.get('METRICS_DIR'):
+        metrics.mark_process_dead(worker.pid, app.config['METRICS_DIR'])
+
+
+def post_fork(server, worker):
+    """ Gives the worker its own connections and threads """
+    if worker_class == 'gevent':
+        try:
+            from psycogreen.gevent import patch_psycopg
+            patch_psycopg()
+        except ImportError:
+            server.log.warning('psycogreen is not installed: database calls will block gevent')
+    from service import startup
+    startup.after_fork()
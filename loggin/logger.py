@@ -1,12 +1,21 @@
 # coding:utf-8
 
 import os
+import atexit
+import gzip
+import importlib
 import logging
+import shutil
+import time
 import json
 import datetime
 import traceback
 import logging.config
 import sys
+import threading
+from logging.handlers import QueueHandler, QueueListener
+from queue import Queue, Empty, Full
+from flask import g, request, has_request_context
 from flask.logging import default_handler
 from service import app
 from pathlib import Path
@@ -51,18 +60,577 @@ class RobustFormatter(logging.Formatter):
             r.filename, r.lineno, value)
         return s
 
-from logging.handlers import WatchedFileHandler
+def get_json_encoder(name='auto'):
+    """
+    Returns a function encoding a dictionary as one line of JSON text
+    With auto the fastest installed of orjson, ujson and json is used
+    """
+    names = ('orjson', 'ujson', 'json') if name == 'auto' else (name,)
+    for candidate in names:
+        try:
+            module = importlib.import_module(candidate)
+        except ImportError:
+            if name != 'auto':
+                raise
+            continue
+        if candidate == 'orjson':
+            return lambda data: module.dumps(data, default=str).decode('utf-8')
+        if candidate == 'ujson':
+            return lambda data: module.dumps(data, ensure_ascii=False)
+        return json.JSONEncoder(ensure_ascii=False, separators=(',', ':'), default=str).encode
+    raise ImportError('No JSON encoder named {}'.format(name))
+
+
+class JsonLinesFormatter(logging.Formatter):
+    """
+    Formats each record as one line of JSON for the log shipper
+    The timestamp is taken from the record; its text up to the second is
+    computed once per second. Request fields set by RequestContextFilter
+    are added when present.
+    """
+    request_fields = ('request_id', 'method', 'route', 'latency_ms')
+
+    def __init__(self, encoder='auto'):
+        logging.Formatter.__init__(self)
+        self.encode = get_json_encoder(encoder) if isinstance(encoder, str) else encoder
+        self._second = (None, None)
+
+    def format(self, record):
+        data = {
+            '@timestamp': self.timestamp(record.created),
+            'level': record.levelname,
+            'logger': record.name,
+            'message': record.getMessage(),
+            'module': record.module,
+            'function': record.funcName,
+            'line': record.lineno,
+            'process': record.process,
+        }
+        for name in self.request_fields:
+            value = getattr(record, name, None)
+            if value is not None:
+                data[name] = value
+        if record.exc_info and not record.exc_text:
+            record.exc_text = self.formatException(record.exc_info)
+        if record.exc_text:
+            data['exception'] = record.exc_text
+        return self.encode(data)
+
+    def timestamp(self, created):
+        """ Returns the UTC ISO 8601 timestamp of a record creation time """
+        second = int(created)
+        cached, prefix = self._second
+        if cached != second:
+            prefix = time.strftime('%Y-%m-%dT%H:%M:%S', time.gmtime(second))
+            self._second = (second, prefix)
+        return '{}.{:06d}Z'.format(prefix, int((created - second) * 1000000))
+
+
+class RequestContextFilter(logging.Filter):
+    """
+    Adds the id, method, route and elapsed milliseconds of the current
+    request to the records logged while handling it
+    """
+
+    def filter(self, record):
+        if has_request_context():
+            record.request_id = g.get('request_id')
+            record.method = request.method
+            record.route = request.url_rule.rule if request.url_rule else request.path
+            start = g.get('request_start')
+            if start is not None:
+                record.latency_ms = round((time.perf_counter() - start) * 1000, 3)
+        return True
+
+
+class LogSamplingFilter(logging.Filter):
+    """
+    Samples and rate limits the records of each call site
+    Rules are keyed by logger name (covering its children), by
+    "logger:function" for one function, or by "*" for every logger, and
+    hold any of:
+      sample - keep one record in every sample
+      rate - keep at most rate records per second (a token bucket)
+      burst - the records kept at once before rate applies (default rate)
+    Only records below max_level are limited. When a call site logs again
+    after records were suppressed, a summary record with their count is
+    handed to the handler first, at most once every summary_interval seconds.
+    """
+
+    def __init__(self, rules=None, max_level=logging.WARNING, summary_interval=60,
+                 clock=time.monotonic):
+        logging.Filter.__init__(self)
+        self.max_level = max_level
+        self.summary_interval = summary_interval
+        self.clock = clock
+        self.handler = None
+        self._lock = threading.Lock()
+        self.configure(rules or {})
+
+    def configure(self, rules):
+        """ Validates and replaces the rules, reporting what was suppressed """
+        checked = {}
+        for key, rule in rules.items():
+            if not isinstance(rule, dict) or not rule or \
+                    set(rule) - {'sample', 'rate', 'burst'}:
+                raise ValueError('Invalid sampling rule for {}: {}'.format(key, rule))
+            for name, value in rule.items():
+                if isinstance(value, bool) or not isinstance(value, (int, float)) or value <= 0:
+                    raise ValueError('Invalid {} for {}: {}'.format(name, key, value))
+            if 'sample' in rule and rule['sample'] != int(rule['sample']):
+                raise ValueError('Invalid sample for {}: {}'.format(key, rule['sample']))
+            checked[key] = dict(rule)
+        self.flush_summaries()
+        with self._lock:
+            self.rules = checked
+            self._resolved = {}
+            self._sites = {}
+
+    def filter(self, record):
+        if record.levelno >= self.max_level or getattr(record, 'suppressed', None):
+            return True
+        rule = self._resolved.get((record.name, record.funcName), False)
+        if rule is False:
+            rule = self._resolve(record.name, record.funcName)
+        if rule is None:
+            return True
+        summary = None
+        with self._lock:
+            # seen, tokens, last refill, suppressed, a record, last summary
+            site = self._sites.get((record.pathname, record.lineno))
+            now = self.clock()
+            if site is None:
+                burst = rule.get('burst', rule.get('rate', 0))
+                site = self._sites[(record.pathname, record.lineno)] = \
+                    [0, burst, now, 0, record, now]
+            count = site[0]
+            site[0] += 1
+            keep = 'sample' not in rule or count % rule['sample'] == 0
+            if keep and 'rate' in rule:
+                burst = rule.get('burst', rule['rate'])
+                site[1] = min(burst, site[1] + (now - site[2]) * rule['rate'])
+                site[2] = now
+                if site[1] >= 1:
+                    site[1] -= 1
+                else:
+                    keep = False
+            if not keep:
+                site[3] += 1
+                return False
+            if site[3] and now - site[5] >= self.summary_interval:
+                summary = self._summary(record, site[3])
+                site[3] = 0
+                site[5] = now
+        if summary is not None and self.handler is not None:
+            self.handler.handle(summary)
+        return True
+
+    def flush_summaries(self):
+        """ Hands over the summary records of every call site with suppressed records """
+        summaries = []
+        with self._lock:
+            for site in getattr(self, '_sites', {}).values():
+                if site[3]:
+                    summaries.append(self._summary(site[4], site[3]))
+                    site[3] = 0
+        if self.handler is not None:
+            for summary in summaries:
+                self.handler.handle(summary)
+
+    def stats(self):
+        """ Returns the number of records seen and suppressed per call site """
+        with self._lock:
+            return [{'site': '{}:{}'.format(record.pathname, record.lineno),
+                     'logger': record.name, 'function': record.funcName,
+                     'seen': seen, 'suppressed': suppressed}
+                    for seen, _, _, suppressed, record, _ in self._sites.values()]
 
-class MyFileHandler(WatchedFileHandler):
-    def __init__(self, filename, mode='a', encoding=None, delay=False):
-        WatchedFileHandler.__init__(self, filename, mode, encoding, delay)
+    def _resolve(self, name, function):
+        """ Finds the rule of a logger function, the most specific one first """
+        keys = ['{}:{}'.format(name, function)]
+        parts = name.split('.')
+        keys.extend('.'.join(parts[:index]) for index in range(len(parts), 0, -1))
+        keys.append('*')
+        rules = self.rules
+        rule = next((rules[key] for key in keys if key in rules), None)
+        self._resolved[(name, function)] = rule
+        return rule
+
+    @staticmethod
+    def _summary(record, suppressed):
+        summary = logging.LogRecord(record.name, record.levelno, record.pathname,
+                                    record.lineno, 'suppressed %s similar messages',
+                                    ('{:,}'.format(suppressed),), None, record.funcName)
+        summary.suppressed = suppressed
+        return summary
+
+
+# The file each level is written to; records of other levels are not kept
+LEVEL_FILES = {'DEBUG': 'debug.log', 'INFO': 'info.log', 'WARNING': 'error.log',
+               'ERROR': 'error.log', 'CRITICAL': 'error.log'}
+
+
+class _LogFile(object):
+    """ One log file of a LevelRoutingFileHandler and its rotation state """
+
+    def __init__(self, path, encoding, buffer_size):
+        self.path = path
+        self.encoding = encoding
+        self.buffer_size = buffer_size
+        self.stream = None
+        self.size = 0
+        self.identity = None
+        self.rollover_at = None
+
+    def open(self):
+        self.stream = open(self.path, 'a', encoding=self.encoding,
+                           buffering=self.buffer_size)
+        stat = os.fstat(self.stream.fileno())
+        self.size = stat.st_size
+        self.identity = (stat.st_dev, stat.st_ino)
+
+    def write(self, data):
+        if self.stream is None:
+            self.open()
+        self.stream.write(data)
+        self.size += len(data)
+
+    def flush(self):
+        if self.stream is not None:
+            self.stream.flush()
+
+    def close(self):
+        if self.stream is not None:
+            self.stream.close()
+            self.stream = None
+
+    def moved(self):
+        """ Tells whether the file was moved or removed since it was opened """
+        try:
+            stat = os.stat(self.path)
+        except FileNotFoundError:
+            return True
+        return (stat.st_dev, stat.st_ino) != self.identity
+
+
+class LevelRoutingFileHandler(logging.Handler):
+    """
+    Writes each record to the file of its level, in one pass
+    Writes are buffered and flushed every flush_interval seconds, when a
+    record of flush_level or above is written and on close. Files moved
+    away by an external logrotate are noticed by a stat every
+    watch_interval seconds rather than one per record. The handler can also
+    rotate the files itself, past max_bytes or every rotate_interval
+    seconds (aligned on the epoch, so 86400 rotates at UTC midnight),
+    keeping backup_count rotated files gzipped by a helper thread.
+    """
+    terminator = '\n'
+
+    def __init__(self, log_dir, files=None, max_bytes=0, backup_count=5,
+                 rotate_interval=0, compress=True, flush_interval=1.0,
+                 flush_level=logging.ERROR, watch_interval=1.0,
+                 buffer_size=64 * 1024, encoding='utf-8', clock=time.time):
+        logging.Handler.__init__(self)
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.rotate_interval = rotate_interval
+        self.compress = compress
+        self.flush_interval = flush_interval
+        self.flush_level = flush_level
+        self.watch_interval = watch_interval
+        self.clock = clock
+        self._files = {}
+        # levels sharing a file share one stream and its rotation
+        paths = {}
+        for level, filename in (files or LEVEL_FILES).items():
+            if not isinstance(level, int):
+                level = logging.getLevelName(level)
+            path = os.path.join(log_dir, filename)
+            if path not in paths:
+                paths[path] = _LogFile(path, encoding, buffer_size)
+            self._files[level] = paths[path]
+        self._log_files = list(paths.values())
+        now = clock()
+        self._last_flush = now
+        self._next_check = now + watch_interval
+        self._stopped = threading.Event()
+        self._compress_queue = None
+        self._compressor = None
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically,
+                                             name='log-flush', daemon=True)
+            self._flusher.start()
 
     def emit(self, record):
-        if not record.levelno == self.level:
+        log_file = self._files.get(record.levelno)
+        if log_file is None:
+            return
+        try:
+            data = self.format(record) + self.terminator
+            now = self.clock()
+            if now >= self._next_check:
+                self._reopen_moved(now)
+            if self._should_rollover(log_file, len(data), now):
+                self._rollover(log_file, now)
+            log_file.write(data)
+            if log_file.rollover_at is None and self.rotate_interval > 0:
+                log_file.rollover_at = (now // self.rotate_interval + 1) * self.rotate_interval
+            if record.levelno >= self.flush_level or \
+                    now - self._last_flush >= self.flush_interval:
+                self.flush()
+        except Exception:  # pylint: disable=broad-except
+            self.handleError(record)
+
+    def flush(self):
+        self.acquire()
+        try:
+            for log_file in self._log_files:
+                log_file.flush()
+            self._last_flush = self.clock()
+        finally:
+            self.release()
+
+    def close(self):
+        self._stopped.set()
+        self.acquire()
+        try:
+            for log_file in self._log_files:
+                log_file.close()
+        finally:
+            self.release()
+        if self._flusher is not None and self._flusher is not threading.current_thread():
+            self._flusher.join()
+        if self._compressor is not None:
+            self._compress_queue.put(None)
+            self._compressor.join()
+            self._compressor = None
+        logging.Handler.close(self)
+
+    def _flush_periodically(self):
+        while not self._stopped.wait(self.flush_interval):
+            self.flush()
+
+    def _reopen_moved(self, now):
+        """ Reopens the files that an external rotation moved away """
+        self._next_check = now + self.watch_interval
+        for log_file in self._log_files:
+            if log_file.stream is not None and log_file.moved():
+                log_file.close()
+                log_file.open()
+
+    def _should_rollover(self, log_file, size, now):
+        if self.max_bytes > 0 and log_file.size and log_file.size + size > self.max_bytes:
+            return True
+        return log_file.rollover_at is not None and now >= log_file.rollover_at
+
+    def _rollover(self, log_file, now):
+        """ Moves a full file aside, to be compressed and pruned off-thread """
+        log_file.close()
+        log_file.rollover_at = None
+        if not os.path.exists(log_file.path):
+            return
+        stamp = time.strftime('%Y%m%d-%H%M%S', time.gmtime(now))
+        target = '{}.{}'.format(log_file.path, stamp)
+        count = 0
+        while os.path.exists(target) or os.path.exists(target + '.gz'):
+            count += 1
+            target = '{}.{}.{}'.format(log_file.path, stamp, count)
+        os.rename(log_file.path, target)
+        if not self.compress:
+            self._prune(log_file.path)
             return
-        WatchedFileHandler.emit(self, record)
+        if self._compressor is None:
+            self._compress_queue = Queue()
+            self._compressor = threading.Thread(target=self._compress_rotated,
+                                                name='log-compress', daemon=True)
+            self._compressor.start()
+        self._compress_queue.put((target, log_file.path))
 
-def get_logger_settings(log_dir, console_output=True):
+    def _compress_rotated(self):
+        while True:
+            item = self._compress_queue.get()
+            if item is None:
+                return
+            target, path = item
+            try:
+                with open(target, 'rb') as source, gzip.open(target + '.gz.tmp', 'wb') as out:
+                    shutil.copyfileobj(source, out)
+                os.rename(target + '.gz.tmp', target + '.gz')
+                os.remove(target)
+                self._prune(path)
+            except OSError as error:
+                sys.stderr.write('Could not compress {}: {}\n'.format(target, error))
+
+    def _prune(self, path):
+        """ Removes the oldest rotated files past backup_count """
+        directory, name = os.path.split(path)
+        rotated = sorted(
+            (filename for filename in os.listdir(directory)
+             if filename.startswith(name + '.') and not filename.endswith('.tmp')),
+            key=lambda filename: filename[:-3] if filename.endswith('.gz') else filename)
+        for filename in rotated[:max(len(rotated) - self.backup_count, 0)]:
+            try:
+                os.remove(os.path.join(directory, filename))
+            except FileNotFoundError:
+                pass
+
+# What a full log queue does with a new record: wait for room, make room by
+# dropping the oldest record, or drop the new record
+OVERFLOW_POLICIES = ('block', 'drop_oldest', 'drop')
+
+
+class BoundedQueueHandler(QueueHandler):
+    """
+    Hands records over to a bounded queue drained by a QueueListener
+    Only the message is rendered on the calling thread; formatting and the
+    writes are left to the listener. Records dropped on overflow are counted.
+    """
+
+    def __init__(self, queue, overflow='block'):
+        if overflow not in OVERFLOW_POLICIES:
+            raise ValueError('Invalid log overflow policy: {}'.format(overflow))
+        QueueHandler.__init__(self, queue)
+        self.overflow = overflow
+        self.dropped = 0
+        self._lock = threading.Lock()
+
+    def prepare(self, record):
+        # Render the message and the traceback now, as the arguments may
+        # change or go away before the listener gets to the record
+        record.message = record.getMessage()
+        record.msg = record.message
+        record.args = None
+        if record.exc_info:
+            if not record.exc_text:
+                record.exc_text = _EXCEPTION_FORMATTER.formatException(record.exc_info)
+            record.exc_info = None
+        return record
+
+    def enqueue(self, record):
+        if self.overflow == 'block':
+            self.queue.put(record)
+            return
+        while True:
+            try:
+                self.queue.put_nowait(record)
+                return
+            except Full:
+                with self._lock:
+                    self.dropped += 1
+                if self.overflow == 'drop':
+                    return
+            try:
+                self.queue.get_nowait()
+                self.queue.task_done()
+            except Empty:
+                pass
+
+
+class BlockingQueueListener(QueueListener):
+    """ A QueueListener whose stop waits for room in a full queue """
+
+    def enqueue_sentinel(self):
+        self.queue.put(self._sentinel)
+
+
+class SharedLogSettings(object):
+    """
+    The sampling rules and logger levels changed at runtime, shared by the
+    workers of a server through a file
+    The worker that takes a change applies it and writes it to the file;
+    the others look at the file at most once every interval and apply it
+    again when it was replaced. Levels add up across changes, as loggers
+    left out of a change keep theirs.
+    """
+
+    def __init__(self, path=None, interval=1.0, clock=time.monotonic):
+        self.path = path
+        self.interval = interval
+        self.clock = clock
+        self._version = None
+        self._next_check = 0.0
+        self._lock = threading.Lock()
+
+    def reset(self, path):
+        """ Shares the settings through another file, applying it on the next refresh """
+        with self._lock:
+            self.path = path
+            self._version = None
+            self._next_check = 0.0
+
+    def save(self, rules, levels):
+        """ Applies settings in this worker and hands them to the others """
+        apply_logging_settings(rules, levels)
+        if not self.path:
+            return
+        with self._lock:
+            merged = dict(self._read().get('levels', {}))
+            merged.update(levels)
+            temp_path = '{}.{}.tmp'.format(self.path, os.getpid())
+            try:
+                with open(temp_path, 'w') as settings_file:
+                    json.dump({'rules': rules, 'levels': merged}, settings_file)
+                os.replace(temp_path, self.path)
+            except OSError as error:
+                logging.getLogger('app').warning('Cannot share the logging settings in %s: %s',
+                                                 self.path, error)
+                return
+            self._version = self._stat()
+
+    def refresh(self):
+        """ Applies the settings another worker saved since the last look """
+        if not self.path or self.clock() < self._next_check:
+            return
+        with self._lock:
+            self._next_check = self.clock() + self.interval
+            version = self._stat()
+            if version is None or version == self._version:
+                return
+            self._version = version
+            settings = self._read()
+        try:
+            apply_logging_settings(settings.get('rules', {}), settings.get('levels', {}))
+        except (ValueError, TypeError, AttributeError) as error:
+            logging.getLogger('app').warning('Invalid logging settings in %s: %s',
+                                             self.path, error)
+
+    def _stat(self):
+        try:
+            stat = os.stat(self.path)
+        except OSError:
+            return None
+        return stat.st_ino, stat.st_mtime_ns
+
+    def _read(self):
+        try:
+            with open(self.path) as settings_file:
+                settings = json.load(settings_file)
+        except (OSError, ValueError):
+            return {}
+        return settings if isinstance(settings, dict) else {}
+
+
+def apply_logging_settings(rules, levels):
+    """ Replaces the sampling rules and sets the level of each named logger """
+    sampling_filter.configure(rules)
+    for name, level in levels.items():
+        logging.getLogger(None if name == 'root' else name).setLevel(str(level).upper())
+
+
+_EXCEPTION_FORMATTER = logging.Formatter()
+# The listener of the current logging setup and its queue handler
+_listener = None
+_queue_handler = None
+# Samples the records of every setup; its rules can be changed at runtime
+sampling_filter = LogSamplingFilter()
+# Shares the changes of the sampling rules and levels with the other workers
+shared_settings = SharedLogSettings()
+
+
+def get_logger_settings(log_dir, console_output=True, max_bytes=0, backup_count=5,
+                        rotate_interval=0, compress=True, log_format='text',
+                        json_encoder='auto'):
     logger_settings = {
         'version': 1,
         'disable_existing_loggers': False,
@@ -76,43 +644,40 @@ def get_logger_settings(log_dir, console_output=True):
                            '%(filename)s - %(funcName)s :\n'
                            '%(message)s;'),
                 'datefmt': "%Y-%m-%d %H:%M:%S",
+            },
+            # One JSON object per line, for log shippers
+            'json': {
+                '()': 'loggin.logger.JsonLinesFormatter',
+                'encoder': json_encoder,
             }
         },
         'handlers': {
             'console': {
                 'level': 'INFO',
                 'class': 'logging.StreamHandler',
-                'formatter': 'fmt',
+                'formatter': 'json' if log_format == 'json' else 'fmt',
                 'stream': sys.stdout,
             },
-            'info_file': {
-                'level': 'INFO',
-                'class': 'loggin.logger.MyFileHandler',
-                'formatter': 'fmt',
-                'filename': os.path.join(log_dir, 'info.log'),
-            },
-            'debug_file': {
+            'file': {
                 'level': 'DEBUG',
-                'class': 'loggin.logger.MyFileHandler',
-                'formatter': 'fmt',
-                'filename': os.path.join(log_dir, 'debug.log'),
-            },
-            'error_file': {
-                'level': 'ERROR',
-                'class': 'loggin.logger.MyFileHandler',
-                'formatter': 'fmt',
-                'filename': os.path.join(log_dir, 'error.log'),
+                'class': 'loggin.logger.LevelRoutingFileHandler',
+                'formatter': 'json' if log_format == 'json' else 'fmt',
+                'log_dir': log_dir,
+                'max_bytes': max_bytes,
+                'backup_count': backup_count,
+                'rotate_interval': rotate_interval,
+                'compress': compress,
             },
         },
         'loggers': {
             'service': {
                 'level': 'INFO',
-                'handlers': ['info_file', 'debug_file', 'error_file'],
+                'handlers': ['file'],
                 'propagate': False
             }
         },
         'root': {
-            'handlers': ['info_file', 'debug_file', 'error_file'],
+            'handlers': ['file'],
             'level': 'INFO',
             'propagate': False
         }
@@ -128,6 +693,7 @@ def get_logger_settings(log_dir, console_output=True):
 def initialize_logging(log_level=logging.INFO):
     """ Initialized the default logging to STDOUT """
     print('Setting up logging...')
+    stop_logging()
     handler_list = list(app.logger.handlers)
     for log_handler in handler_list:
         app.logger.removeHandler(log_handler)
@@ -136,7 +702,18 @@ def initialize_logging(log_level=logging.INFO):
     if os.path.exists(log_dir_name) == False:
         os.mkdir(str(Path(log_dir_name).parent))
         os.mkdir(log_dir_name)
-    logging.config.dictConfig(get_logger_settings(log_dir_name, True))
+    sampling_filter.configure(app.config.get('LOG_SAMPLING') or {})
+    shared_settings.reset(app.config.get('LOG_SETTINGS_FILE'))
+    logging.config.dictConfig(get_logger_settings(
+        log_dir_name, True,
+        max_bytes=app.config.get('LOG_MAX_BYTES', 0),
+        backup_count=app.config.get('LOG_BACKUP_COUNT', 5),
+        rotate_interval=app.config.get('LOG_ROTATE_INTERVAL', 0),
+        compress=app.config.get('LOG_COMPRESS', True),
+        log_format=app.config.get('LOG_FORMAT', 'text'),
+        json_encoder=app.config.get('LOG_JSON_ENCODER', 'auto')))
+    start_queue(app.config.get('LOG_QUEUE_SIZE', 10000),
+                app.config.get('LOG_OVERFLOW', 'block'))
     if not app.debug:
         # Set up default logging for submodules to use STDOUT
         # datefmt='%m/%d/%Y %I:%M:%S %p'
@@ -144,3 +721,72 @@ def initialize_logging(log_level=logging.INFO):
     else:
         app.logger.setLevel(logging.DEBUG)
     app.logger.info('Logging handler established')
+
+
+def start_queue(maxsize=10000, overflow='block'):
+    """
+    Moves the handlers of the configured loggers behind a bounded queue
+    A background listener formats and writes the records, so the threads
+    that log never wait on the console or the disk (unless the queue is
+    full and the overflow policy is block)
+    """
+    global _listener, _queue_handler
+    loggers = [logging.getLogger(), logging.getLogger('service')]
+    handlers = []
+    for logger in loggers:
+        for handler in logger.handlers:
+            if handler not in handlers:
+                handlers.append(handler)
+    _queue_handler = BoundedQueueHandler(Queue(maxsize), overflow)
+    # these run on the logging thread: drop sampled out records first,
+    # then add the fields of the request
+    sampling_filter.handler = _queue_handler
+    _queue_handler.addFilter(sampling_filter)
+    _queue_handler.addFilter(RequestContextFilter())
+    for logger in loggers:
+        for handler in list(logger.handlers):
+            logger.removeHandler(handler)
+        logger.addHandler(_queue_handler)
+    _listener = BlockingQueueListener(_queue_handler.queue, *handlers,
+                                      respect_handler_level=True)
+    _listener.start()
+
+
+def stop_logging():
+    """ Writes out the queued records and stops the listener """
+    global _listener
+    if _listener is None:
+        return
+    sampling_filter.flush_summaries()
+    _listener.stop()
+    for handler in _listener.handlers:
+        try:
+            handler.flush()
+            handler.close()
+        except (OSError, ValueError):
+            # the stream may already be closed at interpreter exit
+            pass
+    _listener = None
+
+
+def flush_logging():
+    """ Waits until the queued records are written out, e.g. before a fork """
+    if _listener is None:
+        return
+    _listener.queue.join()
+    for handler in _listener.handlers:
+        handler.flush()
+
+
+def logging_stats():
+    """ Returns the state of the log queue """
+    if _queue_handler is None:
+        return {'queued': 0, 'capacity': 0, 'dropped': 0, 'overflow': None}
+    return {'queued': _queue_handler.queue.qsize(),
+            'capacity': _queue_handler.queue.maxsize,
+            'dropped': _queue_handler.dropped,
+            'overflow': _queue_handler.overflow}
+
+
+# Flush the queue at exit, before logging.shutdown closes the handlers
+atexit.register(stop_logging)
@@ -4,5 +4,32 @@ CREATE TABLE product (
     stock          INTEGER,
     price          DECIMAL(18,2),
     description    VARCHAR(255),
-    category       VARCHAR(50)
+    category       VARCHAR(50),
+    version        INTEGER NOT NULL DEFAULT 1,
+    stock_shards   INTEGER NOT NULL DEFAULT 0,
+    search_document TSVECTOR
+);
+
+CREATE INDEX ix_product_name ON product (name);
+CREATE INDEX ix_product_name_pattern ON product (name varchar_pattern_ops);
+CREATE INDEX ix_product_price ON product (price);
+CREATE INDEX ix_product_category_price ON product (category, price);
+CREATE INDEX ix_product_search_document ON product USING GIN (search_document);
+
+CREATE FUNCTION product_search_document() RETURNS trigger AS $$
+BEGIN
+    NEW.search_document := to_tsvector('english', coalesce(NEW.name, '') || ' ' || coalesce(NEW.description, ''));
+    RETURN NEW;
+END
+$$ LANGUAGE plpgsql;
+
+CREATE TRIGGER product_search_document BEFORE INSERT OR UPDATE OF name, description
+    ON product FOR EACH ROW EXECUTE PROCEDURE product_search_document();
+
+CREATE TABLE product_stock_shard (
+    product_id     INTEGER NOT NULL REFERENCES product (id) ON DELETE CASCADE,
+    shard          INTEGER NOT NULL,
+    stock          INTEGER NOT NULL,
+    last_buy       FLOAT,
+    PRIMARY KEY (product_id, shard)
 );
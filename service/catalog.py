@@ -0,0 +1,277 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Catalog import and export
+
+Moves the product catalog in and out of the database as CSV with the
+columns of psql_data/dummy.csv. Rows are processed in fixed size chunks so
+files of any size are handled in constant memory. On PostgreSQL the chunks
+are written with COPY FROM STDIN and read with COPY TO STDOUT; other
+databases fall back to executemany and a batched cursor.
+
+Commands
+--------
+flask import-csv FILE [--dry-run] - loads a CSV file into the catalog
+flask export-csv FILE - writes the catalog to a CSV file
+"""
+
+import csv
+import io
+import logging
+import threading
+from queue import Queue, Empty, Full
+
+import click
+from service import app
+from sqlalchemy import select
+from sqlalchemy.dialects import postgresql
+from service.model import Product, DataValidationError, PRODUCT_ROW_COLUMNS, db
+
+logger = logging.getLogger('app')
+
+# Columns written by an export and expected by an import (id is optional)
+CSV_COLUMNS = ('name', 'stock', 'price', 'description', 'category')
+# Rows validated and written per COPY or executemany
+IMPORT_CHUNK_SIZE = 5000
+# Most row errors kept in an import report
+MAX_REPORTED_ERRORS = 1000
+
+
+class ImportReport(object):
+    """ The outcome of a CSV import """
+
+    def __init__(self, dry_run=False):
+        self.dry_run = dry_run
+        self.imported = 0
+        self.rejected = 0
+        self.errors = []
+
+    def reject(self, line, message):
+        """ Records a row that could not be imported """
+        self.rejected += 1
+        if len(self.errors) < MAX_REPORTED_ERRORS:
+            self.errors.append({'line': line, 'message': message})
+
+    def serialize(self):
+        """ Serializes the report into a dictionary """
+        return {'dry_run': self.dry_run,
+                'imported': self.imported,
+                'rejected': self.rejected,
+                'errors': self.errors}
+
+
+def import_csv(stream, dry_run=False, chunk_size=IMPORT_CHUNK_SIZE):
+    """
+    Imports Products from a CSV text stream in a single transaction
+    Invalid rows are skipped and reported by line number; with dry_run
+    the rows are only validated and nothing is written
+    Args:
+        stream (file): a text stream with a header row
+    Returns:
+        the ImportReport of the import
+    """
+    logger.info('Importing catalog from CSV (dry run: %s)', dry_run)
+    report = ImportReport(dry_run)
+    reader = csv.DictReader(stream)
+    missing = [name for name in CSV_COLUMNS if name not in (reader.fieldnames or [])]
+    if missing:
+        raise DataValidationError('Invalid CSV: missing columns ' + ', '.join(missing))
+    chunk = []
+    try:
+        for record in reader:
+            try:
+                chunk.append(_validate_row(record))
+            except DataValidationError as error:
+                report.reject(reader.line_num, str(error))
+                continue
+            if len(chunk) >= chunk_size:
+                _write_chunk(chunk, dry_run)
+                report.imported += len(chunk)
+                chunk = []
+        if chunk:
+            _write_chunk(chunk, dry_run)
+            report.imported += len(chunk)
+        if not dry_run:
+            db.session.commit()
+    except Exception:
+        db.session.rollback()
+        raise
+    logger.info('Imported %d products, rejected %d', report.imported, report.rejected)
+    return report
+
+
+def export_csv(out):
+    """ Writes the whole catalog as CSV to a text stream """
+    logger.info('Exporting catalog to CSV')
+    if _is_postgresql():
+        connection = db.session.connection().connection
+        connection.cursor().copy_expert(_copy_out_sql(), out)
+    else:
+        for chunk in _iter_csv_rows():
+            out.write(chunk)
+
+
+def iter_csv():
+    """ Yields the whole catalog as chunks of CSV text """
+    logger.info('Streaming catalog as CSV')
+    if _is_postgresql():
+        return _iter_copy_out(db.engine, _copy_out_sql())
+    return _iter_csv_rows()
+
+
+######################################################################
+#  H E L P E R S
+######################################################################
+def _is_postgresql():
+    return db.engine.dialect.name == 'postgresql'
+
+
+def _validate_row(record):
+    """ Checks one CSV record and converts it into a row of CSV_COLUMNS """
+    product = Product().deserialize(record).validate()
+    return (product.name, product.stock, product.price, product.description, product.category)
+
+
+def _write_chunk(chunk, dry_run):
+    """ Writes validated rows with COPY on PostgreSQL or executemany elsewhere """
+    if dry_run:
+        return
+    if _is_postgresql():
+        buffer = io.StringIO()
+        csv.writer(buffer).writerows(chunk)
+        buffer.seek(0)
+        connection = db.session.connection().connection
+        connection.cursor().copy_expert(
+            'COPY product ({}) FROM STDIN WITH (FORMAT csv)'.format(
+                ', '.join(CSV_COLUMNS)), buffer)
+    else:
+        db.session.execute(Product.__table__.insert(),
+                           [dict(zip(CSV_COLUMNS, row)) for row in chunk])
+
+
+def _export_query():
+    """ Selects the exported columns, with the stock counters of hot Products added up """
+    columns = {column.name: column for column in PRODUCT_ROW_COLUMNS}
+    return select([columns['id']] + [columns[name] for name in CSV_COLUMNS]).order_by(
+        columns['id'])
+
+
+def _copy_out_sql():
+    query = _export_query().compile(dialect=postgresql.dialect(),
+                                    compile_kwargs={'literal_binds': True})
+    return 'COPY ({}) TO STDOUT WITH (FORMAT csv, HEADER)'.format(query)
+
+
+def _iter_csv_rows():
+    """ Yields the catalog as CSV read through a batched cursor """
+    buffer = io.StringIO()
+    writer = csv.writer(buffer)
+    writer.writerow(('id',) + CSV_COLUMNS)
+    rows = db.session.execute(_export_query().execution_options(stream_results=True))
+    for count, row in enumerate(rows, 1):
+        writer.writerow(row)
+        if count % IMPORT_CHUNK_SIZE == 0:
+            yield buffer.getvalue()
+            buffer.seek(0)
+            buffer.truncate()
+    yield buffer.getvalue()
+
+
+class _QueueWriter(object):
+    """ A file-like object handing what COPY writes over to a bounded queue """
+
+    def __init__(self, queue, cancelled):
+        self.queue = queue
+        self.cancelled = cancelled
+
+    def write(self, data):
+        while not self.cancelled.is_set():
+            try:
+                self.queue.put(data, timeout=1)
+                return
+            except Full:
+                continue
+        raise IOError('CSV export cancelled by the client')
+
+
+def _iter_copy_out(engine, sql):
+    """
+    Yields the output of COPY TO STDOUT as it is produced
+    COPY runs on its own connection in a helper thread and blocks whenever
+    the client falls more than a few chunks behind
+    """
+    queue = Queue(maxsize=16)
+    cancelled = threading.Event()
+    done = object()
+
+    def copy():
+        connection = engine.raw_connection()
+        try:
+            connection.cursor().copy_expert(sql, _QueueWriter(queue, cancelled))
+            connection.commit()
+        except Exception as error:  # pylint: disable=broad-except
+            if not cancelled.is_set():
+                logger.error('CSV export failed: %s', error)
+        finally:
+            connection.close()
+            while not cancelled.is_set():
+                try:
+                    queue.put(done, timeout=1)
+                    break
+                except Full:
+                    continue
+
+    worker = threading.Thread(target=copy, name='csv-export', daemon=True)
+    worker.start()
+    try:
+        while True:
+            try:
+                data = queue.get(timeout=1)
+            except Empty:
+                if not worker.is_alive():
+                    return
+                continue
+            if data is done:
+                return
+            yield data
+    finally:
+        cancelled.set()
+
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+@app.cli.command('import-csv')
+@click.argument('filename', type=click.Path(exists=True, dir_okay=False))
+@click.option('--dry-run', is_flag=True, help='Only validate the rows')
+def import_csv_command(filename, dry_run):
+    """ Loads a CSV file into the product catalog """
+    Product.init_db(app)
+    with open(filename, newline='', encoding='utf-8') as stream:
+        report = import_csv(stream, dry_run=dry_run)
+    for error in report.errors:
+        click.echo('line {line}: {message}'.format(**error), err=True)
+    click.echo('{} products {}, {} rejected'.format(
+        report.imported, 'valid' if dry_run else 'imported', report.rejected))
+
+
+@app.cli.command('export-csv')
+@click.argument('filename', type=click.Path(dir_okay=False, writable=True))
+def export_csv_command(filename):
+    """ Writes the product catalog to a CSV file """
+    Product.init_db(app)
+    with open(filename, 'w', newline='', encoding='utf-8') as out:
+        export_csv(out)
+    click.echo('Catalog exported to {}'.format(filename))
@@ -0,0 +1,205 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Health checks
+
+A background thread of every worker probes the dependencies of the service
+each HEALTH_CHECK_INTERVAL seconds: the database, with a SELECT 1 through
+the connection pool, and the queue of the log writer. /healthcheck answers
+with the result of the last probes without touching them itself, so
+polling it often adds no load.
+
+Each component is up, degraded or down, and so is the service as a whole,
+as its worst component. The database is degraded when the 99th percentile
+of its probe latency over the last HEALTH_WINDOW probes passes
+HEALTH_DB_P99_MS milliseconds or when every connection of the pool is in
+use, and the log queue when it is HEALTH_QUEUE_HIGH full. Results older
+than three intervals count as down.
+
+Paths
+-----
+GET /healthcheck - 200 while the service is up or degraded, 503 when down
+"""
+
+import collections
+import os
+import threading
+import time
+
+from flask import jsonify
+from flask_api import status
+from service import app
+from service.model import db
+from loggin import logger
+
+UP = 'up'
+DEGRADED = 'degraded'
+DOWN = 'down'
+# From the best to the worst state
+SEVERITY = (UP, DEGRADED, DOWN)
+# Default probe interval in seconds, and degradation thresholds
+HEALTH_CHECK_INTERVAL = 5
+HEALTH_DB_P99_MS = 100
+HEALTH_WINDOW = 60
+HEALTH_QUEUE_HIGH = 0.8
+
+
+class HealthMonitor(object):
+    """ Probes the dependencies of the service periodically and keeps the results """
+
+    def __init__(self, interval=HEALTH_CHECK_INTERVAL, db_p99_ms=HEALTH_DB_P99_MS,
+                 window=HEALTH_WINDOW, queue_high=HEALTH_QUEUE_HIGH, clock=time.time):
+        self.interval = interval
+        self.db_p99_ms = db_p99_ms
+        self.queue_high = queue_high
+        self.clock = clock
+        self.pid = None
+        self.components = {}
+        self.checked_at = None
+        self._latencies = collections.deque(maxlen=window)
+        self._lock = threading.Lock()
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def running(self):
+        return self._thread is not None and self._thread.is_alive() and self.pid == os.getpid()
+
+    def start(self):
+        """ Probes once, then every interval in a background thread of this process """
+        self.pid = os.getpid()
+        self._stopped.clear()
+        self.probe()
+        self._thread = threading.Thread(target=self._run, name='health', daemon=True)
+        self._thread.start()
+
+    def stop(self):
+        self._stopped.set()
+        if self._thread is not None and self._thread is not threading.current_thread():
+            self._thread.join()
+        self._thread = None
+
+    def probe(self):
+        """ Probes every component, replacing the last results """
+        components = {'database': self.probe_database(), 'log_queue': self.probe_log_queue()}
+        with self._lock:
+            self.components = components
+            self.checked_at = self.clock()
+
+    def probe_database(self):
+        """ Runs SELECT 1 on a connection of the pool """
+        started = time.perf_counter()
+        try:
+            with app.app_context():
+                engine = db.get_engine(app)
+                with engine.connect() as connection:
+                    connection.execute('SELECT 1')
+        except Exception as error:  # pylint: disable=broad-except
+            return {'status': DOWN, 'error': str(error)}
+        latency_ms = (time.perf_counter() - started) * 1000
+        self._latencies.append(latency_ms)
+        result = {'status': UP, 'latency_ms': round(latency_ms, 3),
+                  'p99_ms': round(self.p99(), 3)}
+        result.update(pool_usage(engine.pool))
+        if result['p99_ms'] > self.db_p99_ms:
+            result['status'] = DEGRADED
+            result['reason'] = 'p99 latency above {} ms'.format(self.db_p99_ms)
+        elif result.get('checked_out', 0) >= result.get('capacity', float('inf')):
+            result['status'] = DEGRADED
+            result['reason'] = 'connection pool exhausted'
+        return result
+
+    def probe_log_queue(self):
+        """ Reads how full the queue of the log writer is """
+        stats = logger.logging_stats()
+        result = {'status': UP, 'queued': stats['queued'], 'capacity': stats['capacity'],
+                  'dropped': stats['dropped']}
+        if stats['capacity'] and stats['queued'] >= stats['capacity'] * self.queue_high:
+            result['status'] = DEGRADED
+            result['reason'] = 'log queue {:.0%} full'.format(stats['queued'] / stats['capacity'])
+        return result
+
+    def p99(self):
+        """ The 99th percentile of the recent database probe latencies """
+        latencies = sorted(self._latencies)
+        if not latencies:
+            return 0.0
+        return latencies[min(len(latencies) - 1, int(len(latencies) * 0.99))]
+
+    def report(self):
+        """ Returns the last results, with the state of the service as a whole """
+        with self._lock:
+            components = {name: dict(result) for name, result in self.components.items()}
+            checked_at = self.checked_at
+        if checked_at is None:
+            return {'status': DOWN, 'components': {}, 'checked_at': None, 'age': None}
+        age = self.clock() - checked_at
+        if age > 3 * self.interval:
+            for result in components.values():
+                result['status'] = DOWN
+                result['reason'] = 'not probed for {:.0f} s'.format(age)
+        worst = max((SEVERITY.index(result['status']) for result in components.values()),
+                    default=0)
+        return {'status': SEVERITY[worst], 'components': components,
+                'checked_at': checked_at, 'age': round(age, 3)}
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.probe()
+            except Exception as error:  # pylint: disable=broad-except
+                app.logger.warning('Health probe failed: %s', error)
+
+
+monitor = HealthMonitor()
+_start_lock = threading.Lock()
+
+
+######################################################################
+# GET HEALTH CHECK
+######################################################################
+@app.route('/healthcheck')
+def healthcheck():
+    """ Let them know our heart is still beating, and how well """
+    if not monitor.running:
+        start_monitor()
+    report = monitor.report()
+    code = status.HTTP_503_SERVICE_UNAVAILABLE if report['status'] == DOWN \
+        else status.HTTP_200_OK
+    return jsonify(report), code
+
+
+######################################################################
+#  H E L P E R S
+######################################################################
+def start_monitor():
+    """ Starts probing in this process, e.g. once the worker was forked """
+    with _start_lock:
+        if monitor.running:
+            return
+        monitor.interval = app.config.get('HEALTH_CHECK_INTERVAL', HEALTH_CHECK_INTERVAL)
+        monitor.db_p99_ms = app.config.get('HEALTH_DB_P99_MS', HEALTH_DB_P99_MS)
+        monitor.start()
+
+
+def pool_usage(pool):
+    """ Returns how many connections of a pool are in use, out of how many it can open """
+    if not hasattr(pool, 'checkedout'):
+        return {}
+    usage = {'checked_out': pool.checkedout()}
+    max_overflow = getattr(pool, '_max_overflow', 0)
+    if max_overflow >= 0:
+        usage['capacity'] = pool.size() + max_overflow
+    return usage
@@ -0,0 +1,422 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Runtime metrics
+
+Counts the requests by route, method and status, keeps a latency histogram
+per route and method, and exposes them with the requests in flight, the
+database connection pool and how long checkouts from it waited in the
+Prometheus text format.
+
+Every worker process counts its own requests. When METRICS_DIR is set, each
+one also writes a snapshot of its metrics to that directory every
+METRICS_SYNC_INTERVAL seconds and at exit, and /metrics adds up the
+snapshots of all workers: counters of workers that exited are kept, gauges
+only of the workers still running. When a worker exits, gunicorn folds its
+counters into the snapshot of the dead workers and removes its file, so the
+directory does not grow as workers are recycled and a new worker with the
+same pid does not replace its counts. Empty the directory when the service
+is (re)started.
+
+Paths
+-----
+GET /metrics - the metrics in the Prometheus text format
+"""
+
+import atexit
+import bisect
+import glob
+import json
+import os
+import threading
+import time
+
+from flask import Response
+from service import app
+from service.model import db, pool_stats, POOL_WAIT_BUCKETS
+
+# Upper bounds in seconds of the latency histogram buckets
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+PROMETHEUS_MIMETYPE = 'text/plain; version=0.0.4; charset=utf-8'
+# The snapshot adding up the counters of the workers that exited
+DEAD_SNAPSHOT = 'metrics-dead.json'
+# The route of the requests that did not match any
+UNMATCHED_ROUTE = '<unmatched>'
+GAUGE_HELP = {
+    'http_requests_in_flight': 'Requests being handled',
+    'db_pool_size': 'Connections the database pool keeps open',
+    'db_pool_checked_out': 'Database connections in use',
+    'db_pool_checked_in': 'Idle database connections in the pool',
+    'db_pool_overflow': 'Database connections open beyond the pool size',
+    'db_pool_capacity': 'Database connections the pool can open, overflow included',
+    'db_pool_saturation': 'Share of the database pool capacity in use',
+}
+
+
+class RequestMetrics(object):
+    """ The request counters, latency histograms and gauges of one process """
+
+    def __init__(self, buckets=LATENCY_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forgets everything counted so far, e.g. in a forked worker """
+        with self._lock:
+            self.pid = os.getpid()
+            self.in_flight = 0
+            # (route, method, status) -> count
+            self.requests = {}
+            # (route, method) -> [sum of seconds, count per bucket..., count above]
+            self.latency = {}
+
+    def start(self):
+        """ Counts a request in flight """
+        with self._lock:
+            self.in_flight += 1
+
+    def observe(self, route, method, status, seconds):
+        """ Counts a finished request and its latency """
+        index = bisect.bisect_left(self.buckets, seconds)
+        key = (route, method)
+        with self._lock:
+            self.in_flight -= 1
+            counts = self.requests
+            counts[key + (status,)] = counts.get(key + (status,), 0) + 1
+            latency = self.latency.get(key)
+            if latency is None:
+                latency = self.latency[key] = [0.0] + [0] * (len(self.buckets) + 1)
+            latency[0] += seconds
+            latency[index + 1] += 1
+
+    def snapshot(self, gauges=None, pool=None):
+        """ Returns the metrics as a JSON serializable dictionary """
+        with self._lock:
+            return {'pid': self.pid,
+                    'buckets': list(self.buckets),
+                    'requests': [list(key) + [count] for key, count in self.requests.items()],
+                    'latency': [list(key) + [values] for key, values in self.latency.items()],
+                    'gauges': dict(gauges or {}, http_requests_in_flight=self.in_flight),
+                    'pool': pool}
+
+
+class SnapshotWriter(object):
+    """ Writes the snapshot of a worker to the metrics directory periodically """
+
+    def __init__(self, metrics, directory, interval):
+        self.metrics = metrics
+        self.directory = directory
+        self.interval = interval
+        self._stopped = threading.Event()
+        self._thread = None
+
+    @property
+    def path(self):
+        return os.path.join(self.directory, 'metrics-{}.json'.format(os.getpid()))
+
+    def start(self):
+        os.makedirs(self.directory, exist_ok=True)
+        self._thread = threading.Thread(target=self._run, name='metrics-sync', daemon=True)
+        self._thread.start()
+        atexit.register(self.stop)
+
+    def stop(self):
+        """ Stops the periodic writes, writing a last snapshot """
+        if self._stopped.is_set():
+            return
+        self._stopped.set()
+        try:
+            self.write()
+        except OSError as error:
+            app.logger.warning('Could not write the metrics snapshot: %s', error)
+
+    def write(self):
+        """ Replaces the snapshot file of this worker atomically """
+        temporary = self.path + '.tmp'
+        with open(temporary, 'w') as out:
+            json.dump(worker_snapshot(self.metrics), out)
+        os.replace(temporary, self.path)
+
+    def _run(self):
+        while not self._stopped.wait(self.interval):
+            try:
+                self.write()
+            except OSError as error:
+                app.logger.warning('Could not write the metrics snapshot: %s', error)
+
+
+class MetricsMiddleware(object):
+    """
+    Times every request around the Flask application
+    As WSGI middleware it needs no request context lookups: the status and
+    the route are read when start_response is called, the route from the
+    request that Werkzeug keeps in the environment. Latency is measured up to the response
+    headers, so it leaves out the body of streamed responses.
+    """
+
+    def __init__(self, wsgi_app, request_metrics):
+        self.wsgi_app = wsgi_app
+        self.metrics = request_metrics
+
+    def __call__(self, environ, start_response):
+        request_metrics = self.metrics
+        if request_metrics.pid != os.getpid() or \
+                (_writer is None and app.config.get('METRICS_DIR')):
+            start_worker()
+        status = [500, UNMATCHED_ROUTE]
+
+        def record_status(status_line, headers, exc_info=None):
+            status[0] = int(status_line[:3])
+            # Flask unlinks the request from the environment once it is done
+            current = environ.get('werkzeug.request')
+            if current is not None and current.url_rule is not None:
+                status[1] = current.url_rule.rule
+            return start_response(status_line, headers, exc_info)
+
+        request_metrics.start()
+        start = time.perf_counter()
+        try:
+            return self.wsgi_app(environ, record_status)
+        finally:
+            request_metrics.observe(status[1], environ.get('REQUEST_METHOD'), status[0],
+                                    time.perf_counter() - start)
+
+
+metrics = RequestMetrics()
+_writer = None
+app.wsgi_app = MetricsMiddleware(app.wsgi_app, metrics)
+
+
+######################################################################
+#  PATH: /metrics
+######################################################################
+@app.route('/metrics')
+def prometheus_metrics():
+    """ Returns the metrics of every worker in the Prometheus text format """
+    if _writer is not None:
+        _writer.write()
+        snapshots = read_snapshots(app.config['METRICS_DIR'])
+    else:
+        snapshots = [worker_snapshot(metrics)]
+    return Response(render(snapshots), mimetype=PROMETHEUS_MIMETYPE)
+
+
+######################################################################
+#  H E L P E R S
+######################################################################
+def start_worker():
+    """ Starts counting for this process, forgetting what a parent process counted """
+    global _writer
+    if metrics.pid != os.getpid():
+        metrics.reset()
+        pool_stats.reset()
+        _writer = None
+    if _writer is None and app.config.get('METRICS_DIR'):
+        _writer = SnapshotWriter(metrics, app.config['METRICS_DIR'],
+                                 app.config.get('METRICS_SYNC_INTERVAL', 1.0))
+        _writer.start()
+
+
+def stop_writer():
+    """ Stops writing the snapshots of this worker """
+    global _writer
+    if _writer is not None:
+        _writer.stop()
+        _writer = None
+
+
+def pool_gauges():
+    """ Returns the state of the database connection pool """
+    try:
+        pool = db.get_engine(app).pool
+    except Exception:  # pylint: disable=broad-except
+        return {}
+    gauges = {}
+    for name, method in (('db_pool_size', 'size'), ('db_pool_checked_out', 'checkedout'),
+                         ('db_pool_checked_in', 'checkedin'), ('db_pool_overflow', 'overflow')):
+        if hasattr(pool, method):
+            gauges[name] = getattr(pool, method)()
+    if 'db_pool_size' in gauges and getattr(pool, '_max_overflow', -1) >= 0:
+        gauges['db_pool_capacity'] = gauges['db_pool_size'] + pool._max_overflow
+    return gauges
+
+
+def worker_snapshot(request_metrics):
+    """ Returns the snapshot of the metrics of this worker """
+    return request_metrics.snapshot(pool_gauges(), pool_stats.snapshot())
+
+
+def read_snapshots(directory):
+    """ Reads the snapshots of the workers, without the gauges of those that exited """
+    snapshots = []
+    for path in glob.glob(os.path.join(directory, 'metrics-*.json')):
+        try:
+            with open(path) as snapshot_file:
+                snapshot = json.load(snapshot_file)
+        except (OSError, ValueError):
+            continue
+        if snapshot['pid'] is None or not _is_running(snapshot['pid']):
+            snapshot['gauges'] = {}
+        snapshots.append(snapshot)
+    return snapshots
+
+
+def mark_process_dead(pid, directory):
+    """
+    Folds the counters of a worker that exited into the snapshot of the
+    dead workers and removes its own snapshot; only the master may call it
+    """
+    path = os.path.join(directory, 'metrics-{}.json'.format(pid))
+    try:
+        with open(path) as snapshot_file:
+            snapshot = json.load(snapshot_file)
+    except (OSError, ValueError):
+        return
+    dead_path = os.path.join(directory, DEAD_SNAPSHOT)
+    try:
+        with open(dead_path) as dead_file:
+            dead = json.load(dead_file)
+    except (OSError, ValueError):
+        dead = {'pid': None, 'buckets': snapshot['buckets'], 'requests': [], 'latency': [],
+                'gauges': {}, 'pool': None}
+    temporary = dead_path + '.tmp'
+    with open(temporary, 'w') as out:
+        json.dump(_merge_counters(dead, snapshot), out)
+    os.replace(temporary, dead_path)
+    os.remove(path)
+
+
+def _merge_counters(total, snapshot):
+    """ Adds the counters of a snapshot to those of another, leaving out its gauges """
+    requests = {tuple(row[:3]): row[3] for row in total['requests']}
+    for route, method, status, count in snapshot['requests']:
+        requests[(route, method, status)] = requests.get((route, method, status), 0) + count
+    latency = {tuple(row[:2]): row[2] for row in total['latency']}
+    for route, method, values in snapshot['latency']:
+        summed = latency.setdefault((route, method), [0] * len(values))
+        latency[(route, method)] = [a + b for a, b in zip(summed, values)]
+    pool = total['pool']
+    if snapshot.get('pool'):
+        if pool is None:
+            pool = dict(snapshot['pool'])
+        else:
+            pool = {'checkouts': pool['checkouts'] + snapshot['pool']['checkouts'],
+                    'timeouts': pool['timeouts'] + snapshot['pool']['timeouts'],
+                    'wait_seconds': pool['wait_seconds'] + snapshot['pool']['wait_seconds'],
+                    'max_wait_seconds': max(pool['max_wait_seconds'],
+                                            snapshot['pool']['max_wait_seconds']),
+                    'wait_buckets': [a + b for a, b in zip(pool['wait_buckets'],
+                                                           snapshot['pool']['wait_buckets'])]}
+    return {'pid': None, 'buckets': total['buckets'],
+            'requests': [list(key) + [count] for key, count in requests.items()],
+            'latency': [list(key) + [values] for key, values in latency.items()],
+            'gauges': {}, 'pool': pool}
+
+
+def _is_running(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except PermissionError:
+        pass
+    return True
+
+
+def render(snapshots):
+    """ Adds up snapshots and formats them in the Prometheus text format """
+    requests = {}
+    latency = {}
+    gauges = {}
+    buckets = LATENCY_BUCKETS
+    for snapshot in snapshots:
+        buckets = snapshot['buckets']
+        for route, method, status, count in snapshot['requests']:
+            key = (route, method, status)
+            requests[key] = requests.get(key, 0) + count
+        for route, method, values in snapshot['latency']:
+            total = latency.setdefault((route, method), [0] * len(values))
+            for index, value in enumerate(values):
+                total[index] += value
+        for name, value in snapshot['gauges'].items():
+            gauges[name] = gauges.get(name, 0) + value
+    if gauges.get('db_pool_capacity'):
+        gauges['db_pool_saturation'] = gauges.get('db_pool_checked_out', 0) / \
+            gauges['db_pool_capacity']
+    errors = {}
+    for (route, method, status), count in requests.items():
+        if status >= 500:
+            errors[(route, method)] = errors.get((route, method), 0) + count
+    lines = [
+        '# HELP http_requests_total Requests handled, by route, method and status',
+        '# TYPE http_requests_total counter']
+    for (route, method, status), count in sorted(requests.items()):
+        lines.append('http_requests_total{{{},status="{}"}} {}'.format(
+            _labels(route, method), status, count))
+    lines += [
+        '# HELP http_request_errors_total Requests that failed with a server error',
+        '# TYPE http_request_errors_total counter']
+    for (route, method), count in sorted(errors.items()):
+        lines.append('http_request_errors_total{{{}}} {}'.format(_labels(route, method), count))
+    lines += [
+        '# HELP http_request_duration_seconds Time spent handling requests',
+        '# TYPE http_request_duration_seconds histogram']
+    for (route, method), values in sorted(latency.items()):
+        labels = _labels(route, method)
+        cumulative = 0
+        for bound, count in zip(list(buckets) + ['+Inf'], values[1:]):
+            cumulative += count
+            lines.append('http_request_duration_seconds_bucket{{{},le="{}"}} {}'.format(
+                labels, bound, cumulative))
+        lines.append('http_request_duration_seconds_sum{{{}}} {}'.format(labels, values[0]))
+        lines.append('http_request_duration_seconds_count{{{}}} {}'.format(labels, cumulative))
+    lines += render_pool([snapshot['pool'] for snapshot in snapshots if snapshot.get('pool')])
+    for name, value in sorted(gauges.items()):
+        lines.append('# HELP {} {}'.format(name, GAUGE_HELP.get(name, name)))
+        lines.append('# TYPE {} gauge'.format(name))
+        lines.append('{} {}'.format(name, value))
+    return '\n'.join(lines) + '\n'
+
+
+def render_pool(pools):
+    """ Adds up the pool checkout stats of the workers in the Prometheus text format """
+    if not pools:
+        return []
+    checkouts = sum(pool['checkouts'] for pool in pools)
+    buckets = [sum(counts) for counts in zip(*(pool['wait_buckets'] for pool in pools))]
+    lines = [
+        '# HELP db_pool_checkout_timeouts_total Database connection checkouts that timed out',
+        '# TYPE db_pool_checkout_timeouts_total counter',
+        'db_pool_checkout_timeouts_total {}'.format(sum(pool['timeouts'] for pool in pools)),
+        '# HELP db_pool_checkout_wait_max_seconds Longest wait for a database connection',
+        '# TYPE db_pool_checkout_wait_max_seconds gauge',
+        'db_pool_checkout_wait_max_seconds {}'.format(
+            max(pool['max_wait_seconds'] for pool in pools)),
+        '# HELP db_pool_checkout_wait_seconds Time spent waiting for a database connection',
+        '# TYPE db_pool_checkout_wait_seconds histogram']
+    cumulative = 0
+    for bound, count in zip(list(POOL_WAIT_BUCKETS) + ['+Inf'], buckets):
+        cumulative += count
+        lines.append('db_pool_checkout_wait_seconds_bucket{{le="{}"}} {}'.format(bound, cumulative))
+    lines.append('db_pool_checkout_wait_seconds_sum {}'.format(
+        sum(pool['wait_seconds'] for pool in pools)))
+    lines.append('db_pool_checkout_wait_seconds_count {}'.format(checkouts))
+    return lines
+
+
+def _labels(route, method):
+    return 'route="{}",method="{}"'.format(
+        route.replace('\\', '\\\\').replace('"', '\\"'), method)
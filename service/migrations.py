@@ -0,0 +1,201 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Schema migrations
+
+db.create_all() only creates missing tables, so an existing, populated
+product table never picks up new columns or indexes of the model. This
+module brings it up to date in place: missing columns are added with their
+server defaults, missing tables (the stock counters) are created, and
+missing indexes are built online with CREATE INDEX CONCURRENTLY on
+PostgreSQL so reads and writes are not blocked while they build. The
+full-text search index is created (and filled from the existing rows: the
+FTS5 table on SQLite, the search_document column on PostgreSQL) the same
+way, and so is the index serving name prefixes on PostgreSQL.
+
+Commands
+--------
+flask migrate-db [--no-concurrently] - adds missing columns and indexes
+"""
+
+import logging
+
+import click
+from sqlalchemy import inspect, text
+from service import app
+from service.model import (Product, StockShard, PATTERN_INDEX_DDL, SEARCH_DOCUMENT,
+                           SEARCH_INDEX_DDL, db)
+
+logger = logging.getLogger('app')
+
+# Rows per UPDATE when filling the search_document column of existing rows
+BACKFILL_CHUNK_SIZE = 10000
+
+
+def migrate(concurrently=True):
+    """
+    Adds the tables, columns and indexes of the models that the database lacks
+    Returns:
+        the names of the tables, columns and indexes that were created
+    """
+    engine = db.engine
+    table = Product.__table__
+    if not engine.has_table(table.name):
+        created = [_create_table(engine, new_table)
+                   for new_table in (table, StockShard.__table__)
+                   if not engine.has_table(new_table.name)]
+        logger.info('Migration done, created: %s', ', '.join(created))
+        return created
+    created = []
+    inspector = inspect(engine)
+    columns = set(column['name'] for column in inspector.get_columns(table.name))
+    for column in table.columns:
+        if column.name not in columns:
+            _add_column(engine, column)
+            created.append(column.name)
+    if engine.dialect.name == 'postgresql':
+        _drop_invalid_indexes(engine, table)
+        inspector = inspect(engine)
+    existing = set(index['name'] for index in inspector.get_indexes(table.name))
+    for index in table.indexes:
+        if index.name not in existing:
+            _create_index(engine, index, concurrently)
+            created.append(index.name)
+    if engine.dialect.name == 'postgresql':
+        searchable = 'search_document' in columns
+    else:
+        searchable = 'product_fts' in inspector.get_table_names()
+    if not searchable:
+        if _create_search_index(engine, concurrently):
+            created.append('ix_product_search')
+    if 'ix_product_name_pattern' not in existing and engine.dialect.name in PATTERN_INDEX_DDL:
+        _create_pattern_index(engine, concurrently)
+        created.append('ix_product_name_pattern')
+    if not engine.has_table(StockShard.__tablename__):
+        created.append(_create_table(engine, StockShard.__table__))
+    logger.info('Migration done, created: %s', ', '.join(created) or 'nothing')
+    return created
+
+
+######################################################################
+#  H E L P E R S
+######################################################################
+def _create_table(engine, table):
+    """ Creates a table with its indexes, returning its name """
+    logger.info('Creating table %s', table.name)
+    table.create(engine)
+    return table.name
+
+
+def _add_column(engine, column):
+    """ Adds a model column to an existing table """
+    logger.info('Adding column %s.%s', column.table.name, column.name)
+    ddl = 'ALTER TABLE {} ADD COLUMN {} {}'.format(
+        column.table.name, column.name, column.type.compile(engine.dialect))
+    if column.server_default is not None:
+        ddl += ' DEFAULT {}'.format(column.server_default.arg)
+    if not column.nullable:
+        ddl += ' NOT NULL'
+    with engine.begin() as connection:
+        connection.execute(ddl)
+
+
+def _create_index(engine, index, concurrently):
+    """ Builds an index, without locking out writes on PostgreSQL """
+    columns = ', '.join(column.name for column in index.columns)
+    online = concurrently and engine.dialect.name == 'postgresql'
+    logger.info('Creating index %s on %s (%s)%s', index.name, index.table.name,
+                columns, ' concurrently' if online else '')
+    ddl = 'CREATE INDEX {}IF NOT EXISTS {} ON {} ({})'.format(
+        'CONCURRENTLY ' if online else '', index.name, index.table.name, columns)
+    if online:
+        # CREATE INDEX CONCURRENTLY cannot run inside a transaction
+        with engine.connect() as connection:
+            connection.execution_options(isolation_level='AUTOCOMMIT').execute(ddl)
+    else:
+        with engine.begin() as connection:
+            connection.execute(ddl)
+
+
+def _create_search_index(engine, concurrently):
+    """ Builds the full-text search index, returning whether there is one """
+    statements = SEARCH_INDEX_DDL.get(engine.dialect.name)
+    if not statements:
+        return False
+    logger.info('Creating the full-text search index')
+    if engine.dialect.name == 'postgresql':
+        with engine.connect() as connection:
+            connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+            for statement in statements:
+                if statement.startswith('CREATE INDEX'):
+                    # the trigger covers new writes by now, so fill in the
+                    # rows that were already there before indexing them
+                    _backfill_search_document(connection)
+                connection.execute(statement.format(
+                    concurrently='CONCURRENTLY ' if concurrently else ''))
+    else:
+        with engine.begin() as connection:
+            for statement in statements:
+                connection.execute(statement)
+            # index the rows that are already in the table
+            connection.execute("INSERT INTO product_fts (product_fts) VALUES ('rebuild')")
+    return True
+
+
+def _backfill_search_document(connection):
+    """ Fills the search_document column of the existing rows, a chunk of ids per transaction """
+    last_id = connection.execute('SELECT max(id) FROM product').scalar() or 0
+    logger.info('Filling search_document of the products up to id %d', last_id)
+    update = text('UPDATE product SET search_document = {} WHERE id > :low AND id <= :high'
+                  .format(SEARCH_DOCUMENT.format(row='product')))
+    for low in range(0, last_id, BACKFILL_CHUNK_SIZE):
+        connection.execute(update, low=low, high=low + BACKFILL_CHUNK_SIZE)
+
+
+def _create_pattern_index(engine, concurrently):
+    """ Builds the index serving LIKE prefixes of the name (PostgreSQL) """
+    logger.info('Creating index ix_product_name_pattern on product (name)')
+    statement = PATTERN_INDEX_DDL[engine.dialect.name]
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        connection.execute(statement.format(
+            concurrently='CONCURRENTLY ' if concurrently else ''))
+
+
+def _drop_invalid_indexes(engine, table):
+    """ Drops the indexes left invalid by an interrupted concurrent build """
+    with engine.connect() as connection:
+        connection = connection.execution_options(isolation_level='AUTOCOMMIT')
+        names = [row[0] for row in connection.execute(text(
+            "SELECT c.relname FROM pg_index i "
+            "JOIN pg_class c ON c.oid = i.indexrelid "
+            "JOIN pg_class t ON t.oid = i.indrelid "
+            "WHERE t.relname = :table AND NOT i.indisvalid"), table=table.name)]
+        for name in names:
+            logger.warning('Dropping invalid index %s', name)
+            connection.execute('DROP INDEX CONCURRENTLY IF EXISTS {}'.format(name))
+
+
+######################################################################
+#  C O M M A N D S
+######################################################################
+@app.cli.command('migrate-db')
+@click.option('--concurrently/--no-concurrently', default=True,
+              help='Build indexes without blocking writes (PostgreSQL)')
+def migrate_command(concurrently):
+    """ Adds missing columns and indexes to the product table """
+    Product.init_db(app)
+    created = migrate(concurrently=concurrently)
+    click.echo('Created: {}'.format(', '.join(created) if created else 'nothing'))
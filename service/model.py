@@ -18,6 +18,10 @@ All of the models are stored in this module
 Models
 ------
 Product - A Product used in the Product Store
+StockShard - One of the stock counters of a hot Product
+ProductCache - A bounded LRU cache of Product rows used by Product.find
+ProductRow - The column values of a Product, read without the ORM
+QueryTimer - Times the SQL statements, counting them per request
 Attributes:
 -----------
 name (string) - the name of the product
@@ -25,19 +29,391 @@ stock (integer) - the amound of the product in stock
 price (numeric)) - the price of the product
 description (string) - the description of the product
 category (string) - the category the product belongs to (i.e. apparel, Electric appliance)
+version (integer) - the row version, bumped by every update of the product
+stock_shards (integer) - the counters the stock of a hot product is split into (0: not hot)
 """
 
+import base64
+import binascii
+import bisect
+import hashlib
+import json
 import logging
+import random
+import threading
+import time
+from collections import OrderedDict, namedtuple
+from contextlib import contextmanager
+from decimal import Decimal, InvalidOperation
 from flask_sqlalchemy import SQLAlchemy
-import flask
+from sqlalchemy import bindparam, case, event, func, select, DDL
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.pool import NullPool, QueuePool
+from sqlalchemy.orm import column_property, make_transient_to_detached
+from sqlalchemy.orm.attributes import get_history, set_committed_value
+from sqlalchemy.orm.exc import StaleDataError
 
-# Create the SQLAlchemy object to be initialized later in init_db()
-db = SQLAlchemy()
+# Bounds of the stock (INTEGER) and price (NUMERIC(18,2)) columns
+STOCK_MIN, STOCK_MAX = -2 ** 31, 2 ** 31 - 1
+PRICE_LIMIT = Decimal(10) ** 16
+# Page sizes for keyset pagination of product listings
+PAGE_LIMIT_DEFAULT = 100
+PAGE_LIMIT_MAX = 1000
+# Columns a listing can be sorted (and paged) by
+SORT_KEYS = ('id', 'price', 'name')
+# Rows fetched per round trip when streaming a listing
+STREAM_BATCH_SIZE = 500
+# Most ids a batch lookup resolves
+FIND_MANY_MAX = 500
+# Most distinct Products in one checkout
+CHECKOUT_MAX_ITEMS = 100
+# Most counters the stock of a hot Product can be split into, and the
+# seconds without a buy after which it goes back to a single counter
+STOCK_SHARDS_MAX = 64
+HOT_STOCK_IDLE = 300
+# Seconds between two looks for hot Products that cooled down
+HOT_STOCK_CHECK_INTERVAL = 60
+# Rows per multi-row INSERT statement when creating Products in bulk
+INSERT_CHUNK_SIZE = 1000
+# Price ranges (low, high] of the legacy price query parameter
+PRICE_BUCKETS = {1: (0, 25), 2: (25, 50), 3: (50, 75)}
+# The text that full-text search matches, of a product row
+SEARCH_DOCUMENT = ("to_tsvector('english', coalesce({row}.name, '') || ' ' || "
+                   "coalesce({row}.description, ''))")
+# How it is indexed per database. PostgreSQL stores it in a column that a
+# trigger keeps current, so ranking reads it instead of parsing every match
+SEARCH_INDEX_DDL = {
+    'postgresql': [
+        "ALTER TABLE product ADD COLUMN IF NOT EXISTS search_document tsvector",
+        "CREATE OR REPLACE FUNCTION product_search_document() RETURNS trigger AS $$ "
+        "BEGIN NEW.search_document := " + SEARCH_DOCUMENT.format(row='NEW') + "; "
+        "RETURN NEW; END $$ LANGUAGE plpgsql",
+        "DROP TRIGGER IF EXISTS product_search_document ON product",
+        "CREATE TRIGGER product_search_document BEFORE INSERT OR UPDATE OF name, description "
+        "ON product FOR EACH ROW EXECUTE PROCEDURE product_search_document()",
+        "CREATE INDEX {concurrently}IF NOT EXISTS ix_product_search_document ON product "
+        "USING GIN (search_document)",
+        # the expression index of the document that older versions searched
+        "DROP INDEX {concurrently}IF EXISTS ix_product_search",
+    ],
+    # SQLite keeps an FTS5 table over the product rows, synced by triggers
+    'sqlite': [
+        "CREATE VIRTUAL TABLE IF NOT EXISTS product_fts USING fts5("
+        "name, description, content='product', content_rowid='id')",
+        "CREATE TRIGGER IF NOT EXISTS product_fts_insert AFTER INSERT ON product BEGIN "
+        "INSERT INTO product_fts (rowid, name, description) "
+        "VALUES (new.id, new.name, new.description); END",
+        "CREATE TRIGGER IF NOT EXISTS product_fts_delete AFTER DELETE ON product BEGIN "
+        "INSERT INTO product_fts (product_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); END",
+        "CREATE TRIGGER IF NOT EXISTS product_fts_update AFTER UPDATE OF name, description "
+        "ON product BEGIN "
+        "INSERT INTO product_fts (product_fts, rowid, name, description) "
+        "VALUES ('delete', old.id, old.name, old.description); "
+        "INSERT INTO product_fts (rowid, name, description) "
+        "VALUES (new.id, new.name, new.description); END",
+    ],
+}
+# A LIKE prefix can only use a btree index built with the pattern operators
+# on PostgreSQL (unless the collation is C)
+PATTERN_INDEX_DDL = {
+    'postgresql': "CREATE INDEX {concurrently}IF NOT EXISTS ix_product_name_pattern "
+                  "ON product (name varchar_pattern_ops)",
+}
+# Sorts after any character, closing the range of a name prefix
+MAX_CHAR = '\U0010ffff'
+# Default bounds of the Product.find cache
+PRODUCT_CACHE_SIZE = 10000
+PRODUCT_CACHE_TTL = 30
+# Statements slower than this are logged with their plan (0 disables it)
+SLOW_QUERY_MS = 200
+# The statements whose plan can be shown
+EXPLAINABLE = ('SELECT', 'WITH', 'UPDATE', 'DELETE')
+# Upper bounds in seconds of the pool checkout wait histogram buckets
+POOL_WAIT_BUCKETS = (0.001, 0.005, 0.025, 0.1, 0.5, 1.0, 5.0)
 
 class DataValidationError(Exception):
     """ Used for an data validation errors when deserializing """
     pass
 
+class ProductCache(object):
+    """
+    A read-through cache of Product rows for Product.find
+
+    Rows are stored as tuples of column values keyed by product id. The
+    cache holds at most maxsize rows, evicting the least recently used one,
+    and an entry expires ttl seconds after it was loaded. Writes through the
+    Product model invalidate their entry; the ttl bounds how stale a row
+    written by another process can be. Any object with the same get, set,
+    invalidate and clear methods can be plugged in as Product.cache.
+    """
+
+    def __init__(self, maxsize=PRODUCT_CACHE_SIZE, ttl=PRODUCT_CACHE_TTL, clock=time.monotonic):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.clock = clock
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key):
+        """ Returns the cached row of a key, or None """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None:
+                self.misses += 1
+                return None
+            row, expires = entry
+            if expires <= self.clock():
+                del self._entries[key]
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return row
+
+    def set(self, key, row):
+        """ Caches the row of a key """
+        with self._lock:
+            self._entries[key] = (row, self.clock() + self.ttl)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.maxsize:
+                self._entries.popitem(last=False)
+                self.evictions += 1
+
+    def invalidate(self, key):
+        """ Drops the row of a key """
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        """ Drops every row """
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """ Returns the size and hit/miss counters of the cache """
+        with self._lock:
+            return {'size': len(self._entries),
+                    'maxsize': self.maxsize,
+                    'hits': self.hits,
+                    'misses': self.misses,
+                    'evictions': self.evictions}
+
+class QueryStats(object):
+    """ The number of statements run and the seconds spent running them """
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+
+class QueryTimer(object):
+    """
+    Times every SQL statement of the engines it is attached to
+
+    Statements are added to the QueryStats that the running thread started,
+    e.g. for the request it handles, and those taking at least slow_seconds
+    are logged with their parameters and their query plan.
+    """
+    logger = logging.getLogger('app')
+
+    def __init__(self, slow_seconds=None):
+        self.slow_seconds = slow_seconds
+        self._local = threading.local()
+
+    def attach(self, engine):
+        """ Listens to the statements of an engine, once """
+        if not event.contains(engine, 'before_cursor_execute', self._before):
+            event.listen(engine, 'before_cursor_execute', self._before)
+            event.listen(engine, 'after_cursor_execute', self._after)
+            event.listen(engine, 'handle_error', self._failed)
+
+    def start(self):
+        """ Starts counting the statements of this thread """
+        stats = QueryStats()
+        stack = getattr(self._local, 'stack', None)
+        if stack is None:
+            stack = self._local.stack = []
+        stack.append(stats)
+        return stats
+
+    def stop(self, stats):
+        """ Stops counting into stats; stopping twice does nothing """
+        stack = getattr(self._local, 'stack', ())
+        if stats in stack:
+            stack.remove(stats)
+        return stats
+
+    @contextmanager
+    def count(self):
+        """ Counts the statements this thread runs in a with block """
+        stats = self.start()
+        try:
+            yield stats
+        finally:
+            self.stop(stats)
+
+    def _before(self, conn, cursor, statement, parameters, context, executemany):
+        conn.info.setdefault('query_start', []).append(time.perf_counter())
+
+    def _after(self, conn, cursor, statement, parameters, context, executemany):
+        seconds = time.perf_counter() - conn.info['query_start'].pop()
+        for stats in getattr(self._local, 'stack', ()):
+            stats.count += 1
+            stats.seconds += seconds
+        if self.slow_seconds and seconds >= self.slow_seconds:
+            self.logger.warning('Slow query (%.1f ms): %s\nParameters: %r\nPlan:\n%s',
+                                seconds * 1000, statement, parameters,
+                                self._explain(conn, statement, parameters, executemany))
+
+    def _failed(self, context):
+        starts = context.connection.info.get('query_start') if context.connection else None
+        if starts:
+            starts.pop()
+
+    @staticmethod
+    def _explain(conn, statement, parameters, executemany):
+        """
+        Returns the query plan of a statement, on a cursor of its own
+        Inside a transaction on PostgreSQL it runs in a savepoint, so an
+        EXPLAIN that fails does not abort the transaction of the request
+        """
+        if executemany or not statement.lstrip().upper().startswith(EXPLAINABLE):
+            return 'n/a'
+        prefix = 'EXPLAIN QUERY PLAN ' if conn.dialect.name == 'sqlite' else 'EXPLAIN '
+        savepoint = conn.dialect.name != 'sqlite' and \
+            not getattr(conn.connection, 'autocommit', False)
+        cursor = conn.connection.cursor()
+        try:
+            if savepoint:
+                cursor.execute('SAVEPOINT query_plan')
+            try:
+                cursor.execute(prefix + statement, parameters)
+                plan = '\n'.join(' '.join(str(value) for value in row)
+                                 for row in cursor.fetchall())
+            except Exception:
+                if savepoint:
+                    cursor.execute('ROLLBACK TO SAVEPOINT query_plan')
+                raise
+            if savepoint:
+                cursor.execute('RELEASE SAVEPOINT query_plan')
+            return plan
+        except Exception as error:  # pylint: disable=broad-except
+            return 'unavailable: {}'.format(error)
+        finally:
+            cursor.close()
+
+
+# Times the statements of the database
+query_timer = QueryTimer()
+
+
+class PoolStats(object):
+    """ How long checkouts of a connection pool waited, and how many timed out """
+
+    def __init__(self, buckets=POOL_WAIT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self._lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        """ Forgets the checkouts counted so far, e.g. in a forked worker """
+        with self._lock:
+            self.checkouts = 0
+            self.timeouts = 0
+            self.wait_seconds = 0.0
+            self.max_wait_seconds = 0.0
+            # count per bucket, then the count above
+            self.wait_buckets = [0] * (len(self.buckets) + 1)
+
+    def observe(self, seconds, timed_out=False):
+        """ Counts a checkout and how long it waited """
+        index = bisect.bisect_left(self.buckets, seconds)
+        with self._lock:
+            self.checkouts += 1
+            self.timeouts += timed_out
+            self.wait_seconds += seconds
+            self.max_wait_seconds = max(self.max_wait_seconds, seconds)
+            self.wait_buckets[index] += 1
+
+    def snapshot(self):
+        """ Returns the counters as a JSON serializable dictionary """
+        with self._lock:
+            return {'checkouts': self.checkouts,
+                    'timeouts': self.timeouts,
+                    'wait_seconds': self.wait_seconds,
+                    'max_wait_seconds': self.max_wait_seconds,
+                    'wait_buckets': list(self.wait_buckets)}
+
+
+# Checkout waits of the database connection pool
+pool_stats = PoolStats()
+
+
+class TimedPoolMixin(object):
+    """ Times how long getting a connection from the pool waits into pool_stats """
+
+    def _do_get(self):
+        started = time.perf_counter()
+        try:
+            connection = super()._do_get()
+        except PoolTimeoutError:
+            pool_stats.observe(time.perf_counter() - started, timed_out=True)
+            raise
+        pool_stats.observe(time.perf_counter() - started)
+        return connection
+
+
+class TimedQueuePool(TimedPoolMixin, QueuePool):
+    """ A QueuePool timing its checkouts """
+
+
+class TimedNullPool(TimedPoolMixin, NullPool):
+    """ A NullPool timing how long opening each connection takes """
+
+
+class PooledSQLAlchemy(SQLAlchemy):
+    """
+    SQLAlchemy configured with the connection pool settings of the app
+
+    DB_POOL is queue for a pool of DB_POOL_SIZE connections, plus up to
+    DB_MAX_OVERFLOW more under load, waiting DB_POOL_TIMEOUT seconds for
+    one when all are in use, recycled after DB_POOL_RECYCLE seconds and
+    pinged before use when DB_POOL_PRE_PING is set. DB_POOL is null to
+    open a new connection per checkout, for a PgBouncer in front of the
+    database that does the pooling. SQLite keeps the defaults of
+    Flask-SQLAlchemy. Every engine it creates is timed by query_timer.
+    """
+
+    def create_engine(self, sa_url, engine_opts):
+        engine = super().create_engine(sa_url, engine_opts)
+        query_timer.attach(engine)
+        return engine
+
+    def apply_driver_hacks(self, app, sa_url, options):
+        super().apply_driver_hacks(app, sa_url, options)
+        if sa_url.drivername.startswith('sqlite'):
+            return
+        config = app.config
+        if config.get('DB_POOL', 'queue') == 'null':
+            options['poolclass'] = TimedNullPool
+            return
+        options['poolclass'] = TimedQueuePool
+        for option, key in (('pool_size', 'DB_POOL_SIZE'), ('max_overflow', 'DB_MAX_OVERFLOW'),
+                            ('pool_timeout', 'DB_POOL_TIMEOUT'),
+                            ('pool_recycle', 'DB_POOL_RECYCLE'),
+                            ('pool_pre_ping', 'DB_POOL_PRE_PING')):
+            if config.get(key) is not None:
+                options[option] = config[key]
+
+
+# Create the SQLAlchemy object to be initialized later in init_db()
+db = PooledSQLAlchemy()
+
+
 class Product(db.Model):
     """
     Class that represents a Product
@@ -45,6 +421,10 @@ class Product(db.Model):
 
     logger = logging.getLogger('app')
     app = None
+    cache = None
+    # Seconds without a buy after which a hot Product is cooled (0 never)
+    hot_stock_idle = HOT_STOCK_IDLE
+    _next_cool_check = 0.0
 
     # Table Schema
     id = db.Column(db.Integer, primary_key=True)
@@ -53,26 +433,406 @@ class Product(db.Model):
     price = db.Column(db.Numeric(18,2))
     description = db.Column(db.String(255))
     category = db.Column(db.String(50))
+    version = db.Column(db.Integer, nullable=False, default=1, server_default='1')
+    # A hot Product keeps its stock in this many StockShard rows, on top of
+    # the stock column, so concurrent buys do not all lock the same row
+    stock_shards = db.Column(db.Integer, nullable=False, default=0, server_default='0')
+
+    # Updates and deletes check the version they loaded, so a Product that
+    # was changed in the meantime raises StaleDataError instead of being
+    # overwritten
+    __mapper_args__ = {'version_id_col': version}
+
+    # Secondary indexes for the filtered queries; category lookups use the
+    # leading column of the (category, price) index
+    __table_args__ = (
+        db.Index('ix_product_name', 'name'),
+        db.Index('ix_product_price', 'price'),
+        db.Index('ix_product_category_price', 'category', 'price'),
+    )
 
     def save(self):
         """
         Saves a Product to the data store
         """
         Product.logger.info('Saving %s', self.name)
+        product_id = self.id
         if not self.id:
             db.session.add(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            Product.invalidate(product_id)
+            raise
+        Product.invalidate(self.id)
+
+    @classmethod
+    def create_many(cls, products, chunk_size=INSERT_CHUNK_SIZE):
+        """
+        Saves many new Products to the data store in a single transaction
+        The Products are written with multi-row INSERT statements of up to
+        chunk_size rows each, instead of one statement and commit per Product
+        Returns:
+            the ids of the new Products, in the order they were given
+        """
+        cls.logger.info('Saving %d products', len(products))
+        table = cls.__table__
+        columns = [column.name for column in table.columns
+                   if not column.primary_key and column.default is None]
+        rows = [{name: getattr(product, name) for name in columns}
+                for product in products]
+        ids = []
+        try:
+            for start in range(0, len(rows), chunk_size):
+                chunk = rows[start:start + chunk_size]
+                if db.engine.dialect.implicit_returning:
+                    result = db.session.execute(
+                        table.insert().values(chunk).returning(table.c.id))
+                    ids.extend(row[0] for row in result)
+                else:
+                    # Without INSERT ... RETURNING (e.g. SQLite) the ids can
+                    # only be read back one row at a time
+                    for row in chunk:
+                        result = db.session.execute(table.insert().values(row))
+                        ids.append(result.inserted_primary_key[0])
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        return ids
 
     def delete(self):
         Product.logger.info("Deleting %s", self.name)
+        product_id = self.id
+        # SQLite does not cascade the delete to the stock counters
+        db.session.execute(StockShard.__table__.delete().where(
+            StockShard.__table__.c.product_id == product_id))
         db.session.delete(self)
-        db.session.commit()
+        try:
+            db.session.commit()
+        except StaleDataError:
+            db.session.rollback()
+            Product.invalidate(product_id)
+            raise
+        Product.invalidate(product_id)
 
     @classmethod
     def delete_all(cls):
         Product.logger.info("Deleting all products")
+        db.session.query(StockShard).delete()
         db.session.query(cls).delete()
         db.session.commit()
+        if cls.cache is not None:
+            cls.cache.clear()
+
+    @classmethod
+    def purchase(cls, product_id, quantity=1):
+        """
+        Takes quantity units of a Product out of stock in one statement
+        The stock check and the decrement happen in a single conditional
+        UPDATE, so concurrent buyers can never oversell a Product. A hot
+        Product is bought from one of its stock counters instead, leaving
+        the product row alone.
+        Returns:
+            the updated Product, or None when the Product does not exist
+            or has less than quantity in stock
+        """
+        cls.logger.info('Buying %d of product %s', quantity, product_id)
+        if not isinstance(quantity, int) or quantity < 1:
+            raise DataValidationError('Invalid quantity: must be a positive integer')
+        table = cls.__table__
+        statement = table.update().where(
+            db.and_(table.c.id == product_id, table.c.stock_shards == 0,
+                    table.c.stock >= quantity)
+        ).values(stock=table.c.stock - quantity, version=table.c.version + 1)
+        for _ in range(2):
+            if db.engine.dialect.implicit_returning:
+                row = db.session.execute(statement.returning(*table.columns)).first()
+            else:
+                # No UPDATE ... RETURNING (e.g. SQLite): read the row back in the
+                # same transaction, which the UPDATE has already locked
+                result = db.session.execute(statement)
+                row = None
+                if result.rowcount:
+                    row = db.session.execute(
+                        select(PRODUCT_ROW_COLUMNS).where(table.c.id == product_id)).first()
+            if row is not None:
+                break
+            # Missing, sold out or hot: only the last pays for another query
+            shards = db.session.execute(
+                select([table.c.stock_shards]).where(table.c.id == product_id)).scalar()
+            if not shards:
+                break
+            taken = cls._take_from_shards(product_id, quantity, shards)
+            if taken is None:
+                # Cooled down in the meantime: buy from the product row
+                db.session.rollback()
+                continue
+            if taken:
+                row = db.session.execute(
+                    select(PRODUCT_ROW_COLUMNS).where(table.c.id == product_id)).first()
+            break
+        db.session.commit()
+        if row is None:
+            return None
+        cls.invalidate(row['id'])
+        cls._cool_if_due()
+        return cls(**dict(row))
+
+    @classmethod
+    def checkout(cls, items):
+        """
+        Takes the quantities of many Products out of stock in one transaction
+        The rows are locked in id order, so overlapping checkouts queue
+        behind each other instead of deadlocking, and either every Product
+        is bought or none is. Hot Products are bought from their stock
+        counters.
+        Args:
+            items: (product id, quantity) pairs; quantities of the same id add up
+        Returns:
+            the updated ProductRows in id order and an empty list, or no rows
+            and the short items as dicts of id, requested and available
+            (0 for a Product that does not exist)
+        """
+        quantities = {}
+        for product_id, quantity in items:
+            if isinstance(product_id, bool) or not isinstance(product_id, int):
+                raise DataValidationError('Invalid id: {}'.format(product_id))
+            if isinstance(quantity, bool) or not isinstance(quantity, int) or quantity < 1:
+                raise DataValidationError('Invalid quantity: must be a positive integer')
+            quantities[product_id] = quantities.get(product_id, 0) + quantity
+        if not quantities:
+            raise DataValidationError('Invalid checkout: no items')
+        if len(quantities) > CHECKOUT_MAX_ITEMS:
+            raise DataValidationError(
+                'Invalid checkout: at most {} products'.format(CHECKOUT_MAX_ITEMS))
+        cls.logger.info('Checking out %d products', len(quantities))
+        ids = sorted(quantities)
+        table = cls.__table__
+        for _ in range(2):
+            locked = db.session.execute(
+                select([table.c.id, STOCK_TOTAL, table.c.stock_shards])
+                .where(table.c.id.in_(ids)).order_by(table.c.id)
+                .with_for_update(of=table)).fetchall()
+            stock = {row[0]: row[1] for row in locked}
+            hot = {row[0]: row[2] for row in locked if row[2]}
+            short = [{'id': product_id, 'requested': quantities[product_id],
+                      'available': stock.get(product_id, 0)}
+                     for product_id in ids if stock.get(product_id, 0) < quantities[product_id]]
+            if short:
+                break
+            cold = [product_id for product_id in ids if product_id not in hot]
+            bought = len(cold)
+            if cold:
+                # Conditional as well, for databases without row locks (SQLite)
+                result = db.session.execute(
+                    table.update().where(db.and_(table.c.id == bindparam('product_id'),
+                                                 table.c.stock_shards == 0,
+                                                 table.c.stock >= bindparam('quantity')))
+                    .values(stock=table.c.stock - bindparam('quantity'),
+                            version=table.c.version + 1),
+                    [{'product_id': product_id, 'quantity': quantities[product_id]}
+                     for product_id in cold])
+                if db.engine.dialect.supports_sane_multi_rowcount:
+                    bought = result.rowcount
+            bought += sum(bool(cls._take_from_shards(product_id, quantities[product_id], shards))
+                          for product_id, shards in sorted(hot.items()))
+            if bought == len(ids):
+                rows = [ProductRow(*row) for row in db.session.execute(
+                    select(PRODUCT_ROW_COLUMNS).where(table.c.id.in_(ids)).order_by(table.c.id))]
+                db.session.commit()
+                for product_id in ids:
+                    cls.invalidate(product_id)
+                cls._cool_if_due()
+                return rows, []
+            # Another buyer came first: look at the stock again
+            db.session.rollback()
+        db.session.rollback()
+        return [], short
+
+    @classmethod
+    def set_stock_shards(cls, product_id, shards):
+        """
+        Splits the stock of a Product across shards counters, or gathers it
+        back into the product row with 0
+        A hot Product is bought from a random counter with stock left, so
+        concurrent buyers mostly lock different rows
+        Returns:
+            the ProductRow of the Product, or None when it does not exist
+        """
+        if isinstance(shards, bool) or not isinstance(shards, int) or \
+                not 0 <= shards <= STOCK_SHARDS_MAX:
+            raise DataValidationError(
+                'Invalid shards: must be an integer from 0 to {}'.format(STOCK_SHARDS_MAX))
+        cls.logger.info('Splitting the stock of product %s into %d counters',
+                        product_id, shards)
+        table = cls.__table__
+        shard = StockShard.__table__
+        try:
+            # The product row first, as its updates do
+            base = db.session.execute(select([table.c.stock]).where(table.c.id == product_id)
+                                      .with_for_update()).first()
+            if base is None:
+                db.session.rollback()
+                return None
+            counted = db.session.execute(
+                select([shard.c.stock]).where(shard.c.product_id == product_id)
+                .order_by(shard.c.shard).with_for_update()).fetchall()
+            total = (base[0] or 0) + sum(row[0] for row in counted)
+            cls._write_shards(db.session, product_id, shards, total)
+            db.session.execute(table.update().where(table.c.id == product_id).values(
+                stock=0 if shards else total, stock_shards=shards,
+                version=table.c.version + 1))
+            db.session.commit()
+        except Exception:
+            db.session.rollback()
+            raise
+        cls.invalidate(product_id)
+        return cls.find_row(product_id)
+
+    @classmethod
+    def find_shards(cls, product_id):
+        """ Returns the stock of each counter of a Product, in shard order """
+        shard = StockShard.__table__
+        return [row[0] for row in db.session.execute(
+            select([shard.c.stock]).where(shard.c.product_id == product_id)
+            .order_by(shard.c.shard))]
+
+    @classmethod
+    def cool_idle(cls, idle):
+        """
+        Gathers the stock of the hot Products not bought for idle seconds
+        back into their product row
+        Returns:
+            the ids of the Products that were cooled
+        """
+        table = cls.__table__
+        shard = StockShard.__table__
+        recent = select([shard.c.product_id]).where(shard.c.last_buy >= time.time() - idle)
+        ids = [row[0] for row in db.session.execute(
+            select([table.c.id]).where(db.and_(table.c.stock_shards > 0,
+                                               ~table.c.id.in_(recent))))]
+        db.session.commit()
+        for product_id in ids:
+            cls.set_stock_shards(product_id, 0)
+        if ids:
+            cls.logger.info('Cooled %d hot products', len(ids))
+        return ids
+
+    @classmethod
+    def _cool_if_due(cls):
+        """ Cools the idle hot Products, at most once per check interval """
+        now = time.monotonic()
+        if not cls.hot_stock_idle or now < cls._next_cool_check:
+            return
+        cls._next_cool_check = now + HOT_STOCK_CHECK_INTERVAL
+        try:
+            cls.cool_idle(cls.hot_stock_idle)
+        except Exception as error:  # pylint: disable=broad-except
+            db.session.rollback()
+            cls.logger.warning('Cooling hot products failed: %s', error)
+
+    @classmethod
+    def _take_from_shards(cls, product_id, quantity, shards):
+        """
+        Takes quantity units out of a stock counter of a hot Product
+        A random counter is tried first, then one of those with enough
+        left, and when none has the counters are rebalanced, which locks
+        them all. Does not commit
+        Returns:
+            True when bought, False when the Product has less than quantity
+            in stock, and None when it has no counters (any more)
+        """
+        shard = StockShard.__table__
+        now = time.time()
+
+        def take(number):
+            return db.session.execute(shard.update().where(db.and_(
+                shard.c.product_id == product_id, shard.c.shard == number,
+                shard.c.stock >= quantity)).values(
+                    stock=shard.c.stock - quantity, last_buy=now)).rowcount
+
+        if take(random.randrange(shards)):
+            return True
+        candidates = [row[0] for row in db.session.execute(
+            select([shard.c.shard]).where(db.and_(shard.c.product_id == product_id,
+                                                  shard.c.stock >= quantity)))]
+        random.shuffle(candidates)
+        for number in candidates:
+            if take(number):
+                return True
+        # No counter has enough on its own: spread what is left evenly
+        counters = db.session.execute(
+            select([shard.c.shard, shard.c.stock]).where(shard.c.product_id == product_id)
+            .order_by(shard.c.shard).with_for_update()).fetchall()
+        if not counters:
+            return None
+        total = sum(row[1] for row in counters)
+        if total < quantity:
+            return False
+        cls.logger.info('Rebalancing the stock counters of product %s', product_id)
+        db.session.execute(
+            shard.update().where(db.and_(shard.c.product_id == product_id,
+                                         shard.c.shard == bindparam('number')))
+            .values(stock=bindparam('new_stock'), last_buy=now),
+            [{'number': row[0], 'new_stock': stock}
+             for row, stock in zip(counters, cls._split_stock(total - quantity, len(counters)))])
+        return True
+
+    @classmethod
+    def _write_shards(cls, connection, product_id, shards, total):
+        """ Replaces the stock counters of a Product with shards holding total """
+        shard = StockShard.__table__
+        connection.execute(shard.delete().where(shard.c.product_id == product_id))
+        if shards:
+            now = time.time()
+            connection.execute(shard.insert(), [
+                {'product_id': product_id, 'shard': number, 'stock': stock, 'last_buy': now}
+                for number, stock in enumerate(cls._split_stock(total, shards))])
+
+    @staticmethod
+    def _split_stock(total, shards):
+        """ Splits a stock into shards parts differing by at most one """
+        return [total // shards + (number < total % shards) for number in range(shards)]
+
+    def etag(self):
+        """ Returns the strong entity tag of a Product, derived from its version """
+        return Product.row_etag(self)
+
+    @staticmethod
+    def row_etag(row):
+        """
+        Returns the strong entity tag of a Product or of one of its rows
+        Buys of a hot Product leave its version alone, so its tag has the
+        stock as well
+        """
+        if row.stock_shards:
+            return '{}-{}-{}'.format(row.id, row.version, row.stock)
+        return '{}-{}'.format(row.id, row.version)
+
+    @staticmethod
+    def listing_etag(products):
+        """
+        Returns the weak entity tag of a list of Products
+        The tag is a digest of the ids and versions of the rows, which change
+        whenever a Product in the list is written (and the stock of the hot
+        ones), so it can be computed without serializing anything.
+        It is taken from the page rather than from a table-wide watermark:
+        a change counter row would queue every buy behind one lock, max(version)
+        misses updates of other rows and count/sum aggregates scan the whole
+        table, while the page is an index range scan of limit + 1 rows
+        """
+        digest = hashlib.sha1()
+        for product in products:
+            digest.update('{}:{};'.format(product.id, product.version).encode('ascii'))
+            if product.stock_shards:
+                digest.update('{};'.format(product.stock).encode('ascii'))
+        return digest.hexdigest()
+
+    def row(self):
+        """ Returns the column values of a Product as a ProductRow """
+        return ProductRow(*(getattr(self, name) for name in self.__table__.columns.keys()))
 
     def serialize(self):
         """ Serializes a Product into a dictionary """
@@ -105,23 +865,196 @@ class Product(db.Model):
                                       'bad or no data')
         return self
 
+    def validate(self):
+        """
+        Checks the types and sizes of the fields of a deserialized Product,
+        so it can be inserted along with others without failing them all
+        Converts the stock to an int and the price to a Decimal, both within
+        the range of their columns
+        """
+        try:
+            if isinstance(self.stock, bool):
+                raise TypeError
+            stock = int(self.stock)
+            if stock != self.stock and not isinstance(self.stock, str):
+                raise ValueError
+        except (TypeError, ValueError, OverflowError):
+            raise DataValidationError('Invalid stock: {}'.format(self.stock))
+        if not STOCK_MIN <= stock <= STOCK_MAX:
+            raise DataValidationError('Invalid stock: {} is out of range'.format(self.stock))
+        self.stock = stock
+        try:
+            if isinstance(self.price, bool):
+                raise TypeError
+            price = Decimal(str(self.price))
+        except (TypeError, ValueError, InvalidOperation):
+            raise DataValidationError('Invalid price: {}'.format(self.price))
+        if not price.is_finite():
+            raise DataValidationError('Invalid price: {}'.format(self.price))
+        if price.copy_abs() >= PRICE_LIMIT:
+            raise DataValidationError('Invalid price: {} is out of range'.format(self.price))
+        self.price = price
+        for name in ('name', 'description', 'category'):
+            value = getattr(self, name)
+            if value is None and name == 'description':
+                continue
+            if not isinstance(value, str):
+                raise DataValidationError('Invalid {}: must be a string'.format(name))
+            length = self.__table__.c[name].type.length
+            if len(value) > length:
+                raise DataValidationError(
+                    'Invalid {}: longer than {} characters'.format(name, length))
+        return self
+
     @classmethod
     def init_db(cls, app):
         """ Initializes the database session """
         cls.logger.info('Initializing database')
         cls.app = app
-        # This is where we initialize SQLAlchemy from the Flask app
-        db.init_app(app)
-        if flask.has_request_context() == False:
-            app.app_context().push()
+        cache_size = app.config.get('PRODUCT_CACHE_SIZE', PRODUCT_CACHE_SIZE)
+        cls.cache = ProductCache(
+            cache_size, app.config.get('PRODUCT_CACHE_TTL', PRODUCT_CACHE_TTL)
+        ) if cache_size else None
+        cls.hot_stock_idle = app.config.get('HOT_STOCK_IDLE', HOT_STOCK_IDLE)
+        # This is where we initialize SQLAlchemy from the Flask app, once:
+        # every call would make a new engine and add a teardown, and the
+        # startup calls this again on each retry
+        if 'sqlalchemy' not in app.extensions:
+            db.init_app(app)
+        query_timer.slow_seconds = app.config.get('SLOW_QUERY_MS', SLOW_QUERY_MS) / 1000.0
         with app.app_context():
             db.create_all()  # make our sqlalchemy tables
 
     @classmethod
-    def find(cls, product_id):
-        """ Finds a Product by it's ID """
+    def find(cls, product_id, fresh=False):
+        """
+        Finds a Product by it's ID
+        With fresh, it is read from the database rather than the cache,
+        which another process may have left stale, e.g. to check its version
+        """
         cls.logger.info('Processing lookup for id %s ...', product_id)
-        return cls.query.get(product_id)
+        key = cls._cache_key(product_id)
+        if fresh:
+            product = cls.query.populate_existing().get(product_id)
+            if key is not None:
+                if product is None:
+                    cls.cache.invalidate(key)
+                else:
+                    cls.cache.set(key, product.row())
+            return product
+        if key is None:
+            return cls.query.get(product_id)
+        row = cls.cache.get(key)
+        if row is not None:
+            # Attach a copy of the cached row to the session without a query,
+            # so the Product can still be updated or deleted
+            product = cls(**dict(zip(cls.__table__.columns.keys(), row)))
+            make_transient_to_detached(product)
+            return db.session.merge(product, load=False)
+        product = cls.query.get(product_id)
+        if product is not None:
+            cls.cache.set(key, product.row())
+        return product
+
+    @classmethod
+    def find_row(cls, product_id):
+        """
+        Finds the row of a Product by it's ID
+        Returns the column values as a ProductRow without building a Product
+        object, serving it from the cache when possible
+        """
+        cls.logger.info('Processing row lookup for id %s ...', product_id)
+        key = cls._cache_key(product_id)
+        if key is not None:
+            row = cls.cache.get(key)
+            if row is not None:
+                return row
+        table = cls.__table__
+        row = db.session.execute(
+            select(PRODUCT_ROW_COLUMNS).where(table.c.id == product_id)).first()
+        if row is None:
+            return None
+        row = ProductRow(*row)
+        if key is not None:
+            cls.cache.set(key, row)
+        return row
+
+    @classmethod
+    def find_many(cls, ids):
+        """
+        Finds the rows of many Products by their ids with a single query
+        Cached rows are served from the cache and only the others are
+        queried, with one IN clause
+        Returns:
+            the ProductRows found, in the order of the ids (each id once),
+            and the ids that were not found
+        """
+        cls.logger.info('Processing batch lookup for %d ids ...', len(ids))
+        try:
+            ids = list(OrderedDict.fromkeys(int(product_id) for product_id in ids))
+        except (TypeError, ValueError):
+            raise DataValidationError('Invalid ids: {}'.format(ids))
+        if len(ids) > FIND_MANY_MAX:
+            raise DataValidationError(
+                'Invalid ids: at most {} ids per lookup'.format(FIND_MANY_MAX))
+        found = {}
+        if cls.cache is not None:
+            for product_id in ids:
+                row = cls.cache.get(product_id)
+                if row is not None:
+                    found[product_id] = row
+        remaining = [product_id for product_id in ids if product_id not in found]
+        if remaining:
+            table = cls.__table__
+            for row in db.session.execute(
+                    select(PRODUCT_ROW_COLUMNS).where(table.c.id.in_(remaining))):
+                row = ProductRow(*row)
+                found[row.id] = row
+                if cls.cache is not None:
+                    cls.cache.set(row.id, row)
+        rows = [found[product_id] for product_id in ids if product_id in found]
+        missing = [product_id for product_id in ids if product_id not in found]
+        return rows, missing
+
+    @classmethod
+    def prime_cache(cls, limit):
+        """
+        Loads the rows of up to limit Products, lowest ids first, into the
+        cache, no more than it holds. Returns how many were loaded
+        """
+        if cls.cache is None or limit <= 0:
+            return 0
+        limit = min(limit, getattr(cls.cache, 'maxsize', limit))
+        table = cls.__table__
+        rows = db.session.execute(
+            select(PRODUCT_ROW_COLUMNS).order_by(table.c.id).limit(limit)).fetchall()
+        for row in rows:
+            row = ProductRow(*row)
+            cls.cache.set(row.id, row)
+        cls.logger.info('Primed the cache with %d products', len(rows))
+        return len(rows)
+
+    @classmethod
+    def rows(cls, query):
+        """ Turns a Product query into a query of plain ProductRow-like rows """
+        return query.with_entities(*PRODUCT_ROW_COLUMNS)
+
+    @classmethod
+    def invalidate(cls, product_id):
+        """ Drops a Product from the cache after it has been written """
+        key = cls._cache_key(product_id)
+        if key is not None:
+            cls.cache.invalidate(key)
+
+    @classmethod
+    def _cache_key(cls, product_id):
+        """ Returns the cache key of a product id, or None when not caching """
+        if cls.cache is None:
+            return None
+        try:
+            return int(product_id)
+        except (TypeError, ValueError):
+            return None
 
     @classmethod
     def find_by_category(cls, category):
@@ -138,7 +1071,289 @@ class Product(db.Model):
         cls.logger.info('Processing price query as range (%d %d] ...', low, high)
         return cls.query.filter(db.and_(cls.price > low, cls.price <= high))
 
+    @classmethod
+    def find_by_filters(cls, category=None, name=None, name_prefix=None,
+                        min_price=None, max_price=None, price_bucket=None,
+                        in_stock=None, min_stock=None, max_stock=None):
+        """
+        Finds the Products matching every given filter in one query
+        Args:
+            category (list): the categories a Product may be in
+            name (string): the exact name of the Product
+            name_prefix (string): the start of the name of the Product
+            min_price, max_price (Decimal): the inclusive price range
+            price_bucket (int): a key of PRICE_BUCKETS
+            in_stock (bool): whether the Product must (not) be in stock
+            min_stock, max_stock (int): the inclusive stock range
+        Returns:
+            a query of the matching Products
+        """
+        cls.logger.info('Processing filtered query ...')
+        if (min_price is not None and min_price < 0) or (max_price is not None and max_price < 0):
+            raise DataValidationError('Invalid price range: prices cannot be negative')
+        if min_price is not None and max_price is not None and min_price > max_price:
+            raise DataValidationError('Invalid price range: min_price is above max_price')
+        if min_stock is not None and max_stock is not None and min_stock > max_stock:
+            raise DataValidationError('Invalid stock range: min_stock is above max_stock')
+        if price_bucket is not None and price_bucket not in PRICE_BUCKETS:
+            raise DataValidationError('Invalid price: expected one of {}'.format(
+                ', '.join(str(bucket) for bucket in sorted(PRICE_BUCKETS))))
+        conditions = []
+        if category:
+            conditions.append(cls.category.in_(category) if len(category) > 1
+                              else cls.category == category[0])
+        if name is not None:
+            conditions.append(cls.name == name)
+        if name_prefix:
+            if db.engine.dialect.name == 'sqlite':
+                # SQLite only uses an index for LIKE when it is case sensitive,
+                # a range of the binary collation always can
+                conditions.extend([cls.name >= name_prefix, cls.name < name_prefix + MAX_CHAR])
+            else:
+                conditions.append(cls.name.startswith(name_prefix, autoescape=True))
+        if min_price is not None:
+            conditions.append(cls.price >= min_price)
+        if max_price is not None:
+            conditions.append(cls.price <= max_price)
+        if price_bucket is not None:
+            low, high = PRICE_BUCKETS[price_bucket]
+            conditions.extend([cls.price > low, cls.price <= high])
+        if in_stock is not None:
+            conditions.append(STOCK_TOTAL > 0 if in_stock else STOCK_TOTAL <= 0)
+        if min_stock is not None:
+            conditions.append(STOCK_TOTAL >= min_stock)
+        if max_stock is not None:
+            conditions.append(STOCK_TOTAL <= max_stock)
+        return cls.query.filter(*conditions)
+
+    @classmethod
+    def search(cls, text, limit=None, cursor=None):
+        """
+        Finds the rows of the Products whose name or description match a text, best first
+        Args:
+            text (string): the words to look for; all of them must match
+            limit (int): the page size, capped at PAGE_LIMIT_MAX
+            cursor (string): the opaque cursor returned with the previous page
+        Returns:
+            a tuple of the rows in the page and the cursor of the next page,
+            which is None on the last page
+        """
+        cls.logger.info('Processing search for %s ...', text)
+        words = (text or '').split()
+        if not words:
+            raise DataValidationError('Invalid search: q cannot be empty')
+        limit = cls._parse_limit(limit)
+        offset = cls._decode_cursor(cursor, 'rank')[0] if cursor else 0
+        if not isinstance(offset, int) or offset < 0:
+            raise DataValidationError('Invalid cursor: {}'.format(cursor))
+        if db.engine.dialect.name == 'postgresql':
+            document = db.literal_column('product.search_document')
+            terms = db.func.plainto_tsquery('english', ' '.join(words))
+            query = cls.query.filter(document.op('@@')(terms)).order_by(
+                db.func.ts_rank(document, terms).desc(), cls.id)
+        else:
+            # Quote every word so FTS5 reads it as a term, not as syntax
+            terms = ' '.join('"{}"'.format(word.replace('"', '""')) for word in words)
+            matches = db.session.query(
+                db.literal_column('product_fts.rowid').label('id'),
+                db.literal_column('bm25(product_fts)').label('rank')
+            ).select_from(db.table('product_fts')).filter(
+                db.text('product_fts MATCH :terms').bindparams(terms=terms)
+            ).subquery()
+            query = cls.query.join(matches, cls.id == matches.c.id).order_by(
+                matches.c.rank, cls.id)
+        products = cls.rows(query).offset(offset).limit(limit + 1).all()
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            next_cursor = cls._encode_cursor('rank', offset + limit, 0)
+        return products, next_cursor
+
     @classmethod
     def all(cls):
         cls.logger.info('Processing all Products')
         return cls.query.all()
+
+    @classmethod
+    def paginate(cls, query, limit=None, cursor=None, sort='id'):
+        """
+        Returns one page of a Product query using keyset (seek) pagination
+        Args:
+            query (Query): the (possibly filtered) query to page through
+            limit (int): the page size, capped at PAGE_LIMIT_MAX
+            cursor (string): the opaque cursor returned with the previous page
+            sort (string): one of SORT_KEYS, prefixed with '-' for descending
+        Returns:
+            a tuple of the Products in the page and the cursor of the next
+            page, which is None on the last page
+        """
+        sort = sort or 'id'
+        key, descending = cls._parse_sort(sort)
+        limit = cls._parse_limit(limit)
+        column = getattr(cls, key)
+        if cursor:
+            value, last_id = cls._decode_cursor(cursor, sort)
+            query = query.filter(cls._after_cursor(key, descending, value, last_id))
+        # Fetch one extra row to find out whether there is a next page
+        products = list(query.order_by(*cls._sort_order(key, descending))
+                        .limit(limit + 1).all())
+        next_cursor = None
+        if len(products) > limit:
+            products = products[:limit]
+            last = products[-1]
+            next_cursor = cls._encode_cursor(sort, getattr(last, key), last.id)
+        return products, next_cursor
+
+    @classmethod
+    def stream(cls, query, sort='id', batch_size=STREAM_BATCH_SIZE):
+        """
+        Yields every Product of a query, fetching batch_size rows at a time
+        On PostgreSQL the rows are read through a server-side cursor, so only
+        one batch is ever held in memory
+        """
+        key, descending = cls._parse_sort(sort or 'id')
+        cls.logger.info('Streaming Products in batches of %d', batch_size)
+        return (query.order_by(*cls._sort_order(key, descending))
+                .enable_eagerloads(False).yield_per(batch_size))
+
+    @classmethod
+    def _sort_order(cls, key, descending):
+        """
+        Returns the ORDER BY columns of a sort key, with id as tie-breaker
+        Null prices and names sort after every value, as PostgreSQL indexes
+        them, so a page can seek past them
+        """
+        if key == 'id':
+            return [cls.id.desc() if descending else cls.id]
+        column = getattr(cls, key)
+        if descending:
+            return [column.desc().nullsfirst(), cls.id.desc()]
+        return [column.asc().nullslast(), cls.id]
+
+    @classmethod
+    def _after_cursor(cls, key, descending, value, last_id):
+        """ Returns the condition on the rows that come after a cursor in a sort order """
+        if key == 'id':
+            return cls.id < last_id if descending else cls.id > last_id
+        # Rows sort by (column, id) so ties on price or name stay stable,
+        # and the rows where column is null come last
+        column = getattr(cls, key)
+        if value is None:
+            after_id = cls.id < last_id if descending else cls.id > last_id
+            if descending:
+                return db.or_(db.and_(column.is_(None), after_id), column.isnot(None))
+            return db.and_(column.is_(None), after_id)
+        keyset, position = db.tuple_(column, cls.id), db.tuple_(value, last_id)
+        if descending:
+            return keyset < position
+        return db.or_(keyset > position, column.is_(None))
+
+    @staticmethod
+    def _parse_sort(sort):
+        """ Splits a sort parameter into its column name and direction """
+        descending = sort.startswith('-')
+        key = sort[1:] if descending else sort
+        if key not in SORT_KEYS:
+            raise DataValidationError(
+                'Invalid sort: {} (expected one of {})'.format(sort, ', '.join(SORT_KEYS)))
+        return key, descending
+
+    @staticmethod
+    def _parse_limit(limit):
+        """ Validates a page size and applies the server-side cap """
+        if limit is None or limit == '':
+            return PAGE_LIMIT_DEFAULT
+        try:
+            limit = int(limit)
+        except (TypeError, ValueError):
+            raise DataValidationError('Invalid limit: {}'.format(limit))
+        if limit < 1:
+            raise DataValidationError('Invalid limit: must be a positive integer')
+        return min(limit, PAGE_LIMIT_MAX)
+
+    @staticmethod
+    def _encode_cursor(sort, value, last_id):
+        """ Packs the position of the last row of a page into an opaque token """
+        if isinstance(value, Decimal):
+            value = str(value)
+        token = json.dumps([sort, value, last_id], separators=(',', ':'))
+        return base64.urlsafe_b64encode(token.encode('utf-8')).decode('ascii').rstrip('=')
+
+    @staticmethod
+    def _decode_cursor(cursor, sort):
+        """ Unpacks a cursor, checking that it was issued for the same sort """
+        try:
+            padded = cursor + '=' * (-len(cursor) % 4)
+            cursor_sort, value, last_id = json.loads(
+                base64.urlsafe_b64decode(padded.encode('ascii')).decode('utf-8'))
+        except (ValueError, TypeError, UnicodeError, binascii.Error):
+            raise DataValidationError('Invalid cursor: {}'.format(cursor))
+        if cursor_sort != sort or not isinstance(last_id, int):
+            raise DataValidationError('Cursor does not match sort order {}'.format(sort))
+        if sort.lstrip('-') == 'price' and value is not None:
+            value = Decimal(value)
+        return value, last_id
+
+
+class StockShard(db.Model):
+    """
+    One of the stock counters of a hot Product
+
+    The stock of the Product is the stock of its row plus that of its
+    counters; last_buy is when a buy last took from the counter.
+    """
+    __tablename__ = 'product_stock_shard'
+
+    product_id = db.Column(db.Integer, db.ForeignKey('product.id', ondelete='CASCADE'),
+                           primary_key=True)
+    shard = db.Column(db.Integer, primary_key=True, autoincrement=False)
+    stock = db.Column(db.Integer, nullable=False)
+    last_buy = db.Column(db.Float)
+
+
+# The stock of a Product: that of its row, plus its counters when it is hot
+STOCK_TOTAL = case(
+    [(Product.__table__.c.stock_shards > 0, Product.__table__.c.stock + select(
+        [func.coalesce(func.sum(StockShard.__table__.c.stock), 0)]
+    ).where(StockShard.__table__.c.product_id == Product.__table__.c.id).as_scalar())],
+    else_=Product.__table__.c.stock)
+Product.stock_total = column_property(STOCK_TOTAL)
+# The columns of a ProductRow, with the stock counters added up
+PRODUCT_ROW_COLUMNS = [STOCK_TOTAL.label(column.name) if column.name == 'stock' else column
+                       for column in Product.__table__.columns]
+# The column values of a Product, as read by the ORM-free read path
+ProductRow = namedtuple('ProductRow', Product.__table__.columns.keys())
+
+
+@event.listens_for(Product, 'load')
+@event.listens_for(Product, 'refresh')
+def _load_stock_total(product, *args):
+    """ Shows the stock of a hot Product as it is sold, with its counters """
+    state = product.__dict__
+    if state.get('stock_shards') and state.get('stock_total') is not None:
+        set_committed_value(product, 'stock', state['stock_total'])
+
+
+@event.listens_for(Product, 'before_update')
+def _write_stock_total(mapper, connection, product):
+    """ Spreads a stock set on a hot Product across its counters """
+    if not product.stock_shards or not get_history(product, 'stock').added:
+        return
+    table = Product.__table__
+    # Lock the product row before the counters, as checkouts and
+    # set_stock_shards do
+    connection.execute(select([table.c.id]).where(table.c.id == product.id).with_for_update())
+    Product._write_shards(connection, product.id, product.stock_shards, product.stock or 0)
+    product.stock = 0
+
+
+# Build the full-text search and name pattern indexes along with the product table
+for dialect, statements in SEARCH_INDEX_DDL.items():
+    for statement in statements:
+        event.listen(Product.__table__, 'after_create',
+                     DDL(statement.format(concurrently='')).execute_if(dialect=dialect))
+for dialect, statement in PATTERN_INDEX_DDL.items():
+    event.listen(Product.__table__, 'after_create',
+                 DDL(statement.format(concurrently='')).execute_if(dialect=dialect))
+event.listen(Product.__table__, 'after_drop',
+             DDL('DROP TABLE IF EXISTS product_fts').execute_if(dialect='sqlite'))
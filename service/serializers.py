@@ -0,0 +1,55 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Row serializers
+
+The read endpoints select plain column tuples instead of Product objects.
+compile_row_serializer turns such a row straight into the dictionary that
+marshalling a Product with an API model would produce: same keys, same
+order, same value types. The function is generated once from the model, so
+serializing a row is a single dict display with no per-field lookups.
+"""
+
+from flask_restplus import fields
+
+# What marshalling turns a value into for each field type
+FIELD_TYPES = {fields.Integer: int, fields.Float: float, fields.String: str}
+
+
+def compile_row_serializer(model, columns):
+    """
+    Compiles a function serializing rows of columns as marshal() would
+    Args:
+        model (Model): the API model giving the fields and their order
+        columns (list): the columns of the rows, in row order
+    Returns:
+        a function taking a row and returning a dictionary
+    """
+    names = [column.name for column in columns]
+    namespace = {}
+    items = []
+    for name, field in model.items():
+        index = names.index(name)
+        value = 'row[{}]'.format(index)
+        convert = FIELD_TYPES[type(field)]
+        # Only convert the values the database does not already return
+        # with the right type, e.g. Decimal prices for a Float field
+        if columns[index].type.python_type is not convert:
+            namespace['convert_{}'.format(index)] = convert
+            value = '(None if {0} is None else convert_{1}({0}))'.format(value, index)
+        items.append('{!r}: {}'.format(name, value))
+    source = 'def serialize_row(row):\n    return {' + ', '.join(items) + '}\n'
+    exec(compile(source, '<serialize {}>'.format(model.name), 'exec'), namespace)
+    return namespace['serialize_row']
@@ -18,24 +18,60 @@ Product Service
 Paths:
 ------
 GET /products - Returns a list all of the Products
+GET /products?limit={n}&sort={key}&cursor={cursor} - pages through the Products
+GET /products?stream=true - streams every Product as one chunked JSON array
+    (or as newline delimited JSON with Accept: application/x-ndjson)
+GET /products?ids={1,2,3} - Returns the Products with any of these ids, in that order
 GET /products/{id} - Returns the Product with a given id number
+    (with an ETag; If-None-Match returns 304 and If-Match makes PUT and
+    DELETE conditional)
 POST /products - creates a new Product record in the database
+POST /products/batch - creates many Product records in one transaction
+GET /products/search?q={text} - full-text search of Product names and descriptions
+POST /products/import - loads Products from a CSV body (text/csv)
+GET /products/export - downloads all of the Products as CSV
 PUT /products/{id} - updates a Product record in the database
 DELETE /products/{id} - deletes a Product record in the database
 GET /products?category={category} - query a list of the Products match the specific category
+GET /products?category={a,b}&name_prefix={prefix}&min_price={low}&max_price={high}&in_stock=true
+    - combines any of the filters in one query
 PUT /products/{id}/buy - updates the purchase amoubt of a Product record
+PUT /products/{id}/buy?quantity={n} - buys n units of a Product at once
+POST /products/checkout - buys a list of {id, quantity} in one transaction
+GET /products/{id}/shards - Returns how the stock of a Product is split across counters
+PUT /products/{id}/shards - splits the stock of a hot Product across {shards} counters
 """
 
+import io
+import json
+import logging
+import time
 import uuid
+from decimal import Decimal, InvalidOperation
 from functools import wraps
 from flask import Flask, jsonify, request, url_for, make_response, abort
+from flask import Response, stream_with_context, g
 from flask_api import status
 from flask import jsonify, request, url_for, make_response
 from flask_restplus import Api, Resource, fields, reqparse, inputs
 # Import Flask application
 from . import app
 from werkzeug.exceptions import NotFound
-from service.model import Product, DataValidationError
+from werkzeug.http import quote_etag
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm.exc import StaleDataError
+from service.model import Product, DataValidationError, STREAM_BATCH_SIZE, query_timer
+from service.catalog import import_csv, iter_csv
+from service.serializers import compile_row_serializer
+from loggin.logger import sampling_filter, shared_settings, logging_stats
+
+NDJSON_MIMETYPE = 'application/x-ndjson'
+# Time spent in the database, statements run and total time of a request
+SERVER_TIMING = 'db;dur={:.3f};desc="queries: {}", app;dur={:.3f}'
+# One record per request, with its latency
+access_logger = logging.getLogger('service.access')
+# Largest number of Products accepted by one batch create
+BATCH_CREATE_MAX = 10000
 
 # The type of autorization required
 authorizations = {
@@ -64,12 +100,40 @@ def index():
 
 
 ######################################################################
-# GET HEALTH CHECK
+# REQUEST CONTEXT
 ######################################################################
-@app.route('/healthcheck')
-def healthcheck():
-    """ Let them know our heart is still beating """
-    return make_response(jsonify(status=200, message='Healthy'), status.HTTP_200_OK)
+@app.before_request
+def start_request():
+    """ Identifies the request and starts its clock for the logs """
+    g.request_start = time.perf_counter()
+    g.request_id = request.headers.get('X-Request-Id') or uuid.uuid4().hex
+    g.query_stats = query_timer.start()
+    # take up the logging settings another worker was given
+    shared_settings.refresh()
+
+
+@app.after_request
+def end_request(response):
+    """
+    Returns the request id, the statements run and the time spent in the
+    database and in total, and logs the request with its latency
+    """
+    response.headers['X-Request-Id'] = g.get('request_id', '')
+    stats = g.get('query_stats')
+    if stats is not None:
+        query_timer.stop(stats)
+        response.headers['Server-Timing'] = SERVER_TIMING.format(
+            stats.seconds * 1000, stats.count, (time.perf_counter() - g.request_start) * 1000)
+    access_logger.info('%s %s %s', request.method, request.path, response.status_code)
+    return response
+
+
+@app.teardown_request
+def teardown_request(error=None):
+    """ Stops counting the statements of a request that failed """
+    stats = g.get('query_stats')
+    if stats is not None:
+        query_timer.stop(stats)
 
 
 ######################################################################
@@ -103,6 +167,9 @@ product_model = api.model('Product', {
                               description='The category of the product')
 })
 
+# Serializes a product row exactly as marshalling it with product_model would
+serialize_row = compile_row_serializer(product_model, list(Product.__table__.columns))
+
 create_model = api.model('Product', {
     'name': fields.String(required=True,
                           description='The name of the product'),
@@ -116,15 +183,90 @@ create_model = api.model('Product', {
                               description='The category of the product')
 })
 
+batch_error_model = api.model('BatchError', {
+    'index': fields.Integer(description='The position of the rejected Product in the request'),
+    'message': fields.String(description='Why the Product was rejected')
+})
+
+checkout_item_model = api.model('CheckoutItem', {
+    'id': fields.Integer(required=True, description='The id of the Product to buy'),
+    'quantity': fields.Integer(required=True, description='The number of units to buy')
+})
+
+batch_result_model = api.model('BatchResult', {
+    'ids': fields.List(fields.Integer,
+                       description='The ids of the created Products, in request order'),
+    'errors': fields.List(fields.Nested(batch_error_model),
+                          description='The Products that could not be created')
+})
+
+stock_shards_model = api.model('StockShards', {
+    'id': fields.Integer(readOnly=True, description='The id of the Product'),
+    'stock': fields.Integer(readOnly=True, description='The stock of the Product, in total'),
+    'shards': fields.Integer(required=True,
+                             description='The counters the stock is split into (0: not hot)'),
+    'counters': fields.List(fields.Integer, readOnly=True,
+                            description='The stock of each counter')
+})
+
+logging_settings_model = api.model('LoggingSettings', {
+    'rules': fields.Raw(description='Sampling rules by logger, "logger:function" or "*", '
+                                    'e.g. {"app": {"sample": 10, "rate": 5, "burst": 20}}'),
+    'levels': fields.Raw(description='Levels by logger, e.g. {"app": "WARNING"}')
+})
+
 
 # query string arguments
 product_args = reqparse.RequestParser()
 product_args.add_argument(
     'name', type=str, required=False, help='List Products by name')
-product_args.add_argument('category', type=str,
-                          required=False, help='List Products by category')
+product_args.add_argument('name_prefix', type=str, required=False,
+                          help='List Products whose name starts with this')
+product_args.add_argument('category', type=str, required=False, action='split',
+                          help='List Products in any of these comma separated categories')
 product_args.add_argument(
-    'price', type=int, required=False, help='List Products by price')
+    'price', type=int, required=False, help='List Products by price range 1, 2 or 3')
+product_args.add_argument(
+    'min_price', type=float, required=False, help='List Products costing at least this')
+product_args.add_argument(
+    'max_price', type=float, required=False, help='List Products costing at most this')
+product_args.add_argument(
+    'in_stock', type=inputs.boolean, required=False, help='List Products (not) in stock')
+product_args.add_argument(
+    'min_stock', type=int, required=False, help='List Products with at least this in stock')
+product_args.add_argument(
+    'max_stock', type=int, required=False, help='List Products with at most this in stock')
+product_args.add_argument(
+    'limit', type=int, required=False, help='Maximum number of Products in a page')
+product_args.add_argument(
+    'cursor', type=str, required=False, help='Cursor of the page to return')
+product_args.add_argument('sort', type=str, required=False,
+                          help='Sort by id, price or name; prefix with - for descending')
+product_args.add_argument('stream', type=inputs.boolean, required=False,
+                          help='Stream all matching Products instead of one page')
+product_args.add_argument('ids', type=str, required=False,
+                          help='Look up these comma separated ids instead of listing')
+
+
+# query string arguments for searching products
+search_args = reqparse.RequestParser()
+search_args.add_argument('q', type=str, required=True, location='args',
+                         help='The words to look for in names and descriptions')
+search_args.add_argument('limit', type=int, required=False, location='args',
+                         help='Maximum number of Products in a page')
+search_args.add_argument('cursor', type=str, required=False, location='args',
+                         help='Cursor of the page to return')
+
+# query string arguments for buying a product
+buy_args = reqparse.RequestParser()
+buy_args.add_argument('quantity', type=int, required=False, default=1,
+                      location='args', help='The number of units to buy')
+
+
+# query string arguments for importing a catalog
+import_args = reqparse.RequestParser()
+import_args.add_argument('dry_run', type=inputs.boolean, required=False, default=False,
+                         location='args', help='Only validate the CSV rows')
 
 
 ######################################################################
@@ -140,6 +282,16 @@ def request_validation_error(error):
             'message': message}, status.HTTP_400_BAD_REQUEST
 
 
+@api.errorhandler(PoolTimeoutError)
+def pool_timeout_error(error):
+    """ Sheds the request when no database connection came free in time """
+    app.logger.warning('No database connection available: %s', error)
+    return {'status_code': status.HTTP_503_SERVICE_UNAVAILABLE,
+            'error': 'Service Unavailable',
+            'message': 'The database is busy, try again later'}, \
+        status.HTTP_503_SERVICE_UNAVAILABLE, {'Retry-After': '1'}
+
+
 ######################################################################
 # Generate a random API key
 ######################################################################
@@ -186,18 +338,23 @@ class ProductResource(Resource):
     # ------------------------------------------------------------------
     @api.doc('get_products')
     @api.response(404, 'Product not found')
-    @api.marshal_with(product_model)
+    @api.response(304, 'Product not modified')
+    @api.response(200, 'Success', product_model)
     def get(self, product_id):
         """
         Retrieve a single Product 
         This endpoint will return a Product based on it's id
         """
         app.logger.info('Request for product with id: %s', product_id)
-        product = Product.find(product_id)
-        if not product:
+        row = Product.find_row(product_id)
+        if not row:
             api.abort(status.HTTP_404_NOT_FOUND,
                       "Product with id '{}' was not found.".format(product_id))
-        return product.serialize(), status.HTTP_200_OK
+        etag = Product.row_etag(row)
+        headers = {'ETag': quote_etag(etag), 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains_weak(etag):
+            return '', status.HTTP_304_NOT_MODIFIED, headers
+        return serialize_row(row), status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # UPDATE AN EXISTING PRODUCT
@@ -205,36 +362,63 @@ class ProductResource(Resource):
     @api.doc('update_products', security='apikey')
     @api.response(404, 'Product not found')
     @api.response(400, 'The posted Product data was not valid')
+    @api.response(412, 'The Product does not match If-Match')
     @api.expect(product_model)
     @api.marshal_with(product_model)
     @token_required
     def put(self, product_id):
         app.logger.info('Request to update product with id: %s', product_id)
         check_content_type('application/json')
-        product = Product.find(product_id)
-        if not product:
-            api.abort(status.HTTP_404_NOT_FOUND,
-                      "Product with id {} was not found.".format(product_id))
         app.logger.debug('Payload = %s', api.payload)
         data = api.payload
-        product.deserialize(data)
-        product.id = product_id
-        product.save()
-        return product.serialize(), status.HTTP_200_OK
+        conditional = 'If-Match' in request.headers
+        for attempt in range(2):
+            # If-Match is checked against the version in the database, not a
+            # cached copy that another worker may have left stale
+            product = Product.find(product_id, fresh=conditional)
+            if not product:
+                if conditional:
+                    abort_precondition_failed(product_id)
+                api.abort(status.HTTP_404_NOT_FOUND,
+                          "Product with id {} was not found.".format(product_id))
+            if conditional and not request.if_match.contains(product.etag()):
+                abort_precondition_failed(product_id)
+            product.deserialize(data)
+            product.id = product_id
+            try:
+                product.save()
+                break
+            except StaleDataError:
+                # Changed since it was read; a plain PUT retries with a
+                # fresh copy, a conditional one must fail
+                if conditional or attempt:
+                    abort_precondition_failed(product_id)
+        return product.serialize(), status.HTTP_200_OK, {'ETag': quote_etag(product.etag())}
 
     # ------------------------------------------------------------------
     # DELETE A PRODUCT
     # ------------------------------------------------------------------
     @api.doc('delete_products', security='apikey')
     @api.response(204, 'Product deleted')
+    @api.response(412, 'The Product does not match If-Match')
     @token_required
     def delete(self, product_id):
         """Delete a Product by id"""
         app.logger.info(
             'Request to delete product with the id [%s] provided', product_id)
-        product = Product.find(product_id)
+        conditional = 'If-Match' in request.headers
+        product = Product.find(product_id, fresh=conditional)
+        if conditional and (not product or not request.if_match.contains(product.etag())):
+            abort_precondition_failed(product_id)
         if product:
-            product.delete()
+            try:
+                product.delete()
+            except StaleDataError:
+                if conditional:
+                    abort_precondition_failed(product_id)
+                product = Product.find(product_id, fresh=True)
+                if product:
+                    product.delete()
         return '', status.HTTP_204_NO_CONTENT
 
 ######################################################################
@@ -249,29 +433,50 @@ class ProductCollection(Resource):
     # ------------------------------------------------------------------
     @api.doc('list_products')
     @api.expect(product_args, validate=True)
-    @api.marshal_list_with(product_model)
+    @api.response(400, 'The paging parameters were not valid')
+    @api.response(200, 'Success', [product_model])
+    @api.produces(['application/json', 'application/x-ndjson'])
     def get(self):
-        """Returns all of the Products"""
+        """
+        Returns all of the Products
+        Results are paged by keyset; the next page is linked from the
+        Link and X-Next-Cursor headers. Ask for application/x-ndjson or
+        pass stream=true to stream every matching Product instead.
+        With ids, returns the Products of those ids in the same order, the
+        ids not found in the X-Missing-Ids header; the other filters are
+        ignored.
+        """
+        if request.args.get('ids') is not None:
+            return lookup_products(request.args['ids'])
         app.logger.info('Request for product list')
-        products = []
-        category = request.args.get('category')
-        name = request.args.get('name')
-        price = request.args.get('price')
-        if category:
-            products = Product.find_by_category(category)
-        elif name:
-            products = Product.find_by_name(name)
-        elif price and int(price) > 0 and int(price) < 4:  # query price by range
-            if int(price) == 1:
-                products = Product.find_by_price(0, 25)
-            elif int(price) == 2:
-                products = Product.find_by_price(25, 50)
-            else:
-                products = Product.find_by_price(50, 75)
-        else:
-            products = Product.all()
-        results = [product.serialize() for product in products]
-        return results, status.HTTP_200_OK
+        products = Product.rows(Product.find_by_filters(**product_filters()))
+        sort = request.args.get('sort')
+        mimetype = request.accept_mimetypes.best_match(
+            ['application/json', NDJSON_MIMETYPE])
+        if mimetype == NDJSON_MIMETYPE:
+            return stream_products(Product.stream(products, sort), ndjson=True)
+        try:
+            streaming = inputs.boolean(request.args.get('stream', False))
+        except ValueError as error:
+            raise DataValidationError('Invalid stream: {}'.format(error))
+        if streaming:
+            return stream_products(Product.stream(products, sort), ndjson=False)
+        products, next_cursor = Product.paginate(products,
+                                                 limit=request.args.get('limit'),
+                                                 cursor=request.args.get('cursor'),
+                                                 sort=sort)
+        etag = Product.listing_etag(products)
+        headers = {'ETag': quote_etag(etag, weak=True), 'Cache-Control': 'no-cache'}
+        if request.if_none_match.contains_weak(etag):
+            return '', status.HTTP_304_NOT_MODIFIED, headers
+        results = [serialize_row(row) for row in products]
+        if next_cursor:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = '<{}>; rel="next"'.format(
+                api.url_for(ProductCollection, _external=True, **args))
+        return results, status.HTTP_200_OK, headers
 
     # ------------------------------------------------------------------
     # ADD A NEW PRODUCT
@@ -297,6 +502,196 @@ class ProductCollection(Resource):
             ProductResource, product_id=product.id, _external=True)
         return product.serialize(), status.HTTP_201_CREATED, {'Location': location_url}
 
+######################################################################
+#  PATH: /products/batch
+######################################################################
+@api.route('/products/batch')
+class ProductBatch(Resource):
+    """ Handles bulk creation of Products """
+    # ------------------------------------------------------------------
+    # ADD MANY NEW PRODUCTS
+    # ------------------------------------------------------------------
+    @api.doc('create_products_batch', security='apikey')
+    @api.expect([create_model])
+    @api.response(400, 'None of the posted Products were valid')
+    @api.response(201, 'Products created successfully')
+    @api.marshal_with(batch_result_model, code=201)
+    @token_required
+    def post(self):
+        """
+        Creates many Products
+        Each Product is validated on its own; the valid ones are created in a
+        single transaction and the invalid ones are reported by position
+        """
+        app.logger.info('Request to create a batch of products')
+        check_content_type('application/json')
+        data = api.payload
+        if not isinstance(data, list):
+            raise DataValidationError('Invalid batch: body must be a list of products')
+        if len(data) > BATCH_CREATE_MAX:
+            raise DataValidationError(
+                'Invalid batch: at most {} products per request'.format(BATCH_CREATE_MAX))
+        products = []
+        errors = []
+        for index, item in enumerate(data):
+            try:
+                products.append(Product().deserialize(item).validate())
+            except DataValidationError as error:
+                errors.append({'index': index, 'message': str(error)})
+        if errors and not products:
+            api.abort(status.HTTP_400_BAD_REQUEST,
+                      'None of the posted products were valid', errors=errors)
+        ids = Product.create_many(products)
+        app.logger.info('Created %d products, rejected %d', len(ids), len(errors))
+        return {'ids': ids, 'errors': errors}, status.HTTP_201_CREATED
+
+######################################################################
+#  PATH: /products/checkout
+######################################################################
+@api.route('/products/checkout')
+class CheckoutResource(Resource):
+    """ Buys a cart of Products at once """
+    @api.doc('checkout_products')
+    @api.expect([checkout_item_model])
+    @api.response(400, 'The items were not valid')
+    @api.response(409, 'Some Products do not have enough in stock')
+    @api.response(200, 'Success', [product_model])
+    def post(self):
+        """
+        Buys many Products in one transaction
+        Either every item is bought or none is; the items short of stock are
+        listed in the 409 response
+        """
+        app.logger.info('Request to check out a cart')
+        check_content_type('application/json')
+        data = api.payload
+        if not isinstance(data, list) or \
+                not all(isinstance(item, dict) and 'id' in item for item in data):
+            raise DataValidationError('Invalid checkout: body must be a list of {id, quantity}')
+        rows, short = Product.checkout(
+            [(item['id'], item.get('quantity', 1)) for item in data])
+        if not rows:
+            api.abort(status.HTTP_409_CONFLICT,
+                      'Not enough in stock for products {}'.format(
+                          ', '.join(str(item['id']) for item in short)) if short
+                      else 'The stock changed during the checkout, try again',
+                      short=short)
+        app.logger.info('Checked out %d products', len(rows))
+        return [serialize_row(row) for row in rows], status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products/search
+######################################################################
+@api.route('/products/search')
+class ProductSearch(Resource):
+    """ Full-text search over the Products """
+    @api.doc('search_products')
+    @api.expect(search_args, validate=True)
+    @api.response(400, 'The search parameters were not valid')
+    @api.response(200, 'Success', [product_model])
+    def get(self):
+        """
+        Searches Products by name and description
+        Results are ranked best match first and paged; the next page is
+        linked from the Link and X-Next-Cursor headers
+        """
+        app.logger.info('Request to search products')
+        products, next_cursor = Product.search(request.args.get('q'),
+                                               limit=request.args.get('limit'),
+                                               cursor=request.args.get('cursor'))
+        headers = {}
+        if next_cursor:
+            args = request.args.to_dict()
+            args['cursor'] = next_cursor
+            headers['X-Next-Cursor'] = next_cursor
+            headers['Link'] = '<{}>; rel="next"'.format(
+                api.url_for(ProductSearch, _external=True, **args))
+        return [serialize_row(row) for row in products], status.HTTP_200_OK, headers
+
+######################################################################
+#  PATH: /products/import
+######################################################################
+@api.route('/products/import')
+class CatalogImport(Resource):
+    """ Loads the catalog from CSV """
+    @api.doc('import_products', security='apikey')
+    @api.expect(import_args, validate=True)
+    @api.response(400, 'The CSV header was not valid')
+    @api.response(415, 'The body was not text/csv')
+    @token_required
+    def post(self):
+        """
+        Imports Products from CSV
+        The body is read as a stream; rows that fail validation are skipped
+        and reported by line number. Pass dry_run=true to only validate.
+        """
+        app.logger.info('Request to import products from CSV')
+        check_content_type('text/csv')
+        try:
+            dry_run = inputs.boolean(request.args.get('dry_run', False))
+        except ValueError as error:
+            raise DataValidationError('Invalid dry_run: {}'.format(error))
+        stream = io.TextIOWrapper(request.stream, encoding='utf-8', newline='')
+        report = import_csv(stream, dry_run=dry_run)
+        return report.serialize(), status.HTTP_200_OK
+
+######################################################################
+#  PATH: /products/export
+######################################################################
+@api.route('/products/export')
+class CatalogExport(Resource):
+    """ Dumps the catalog as CSV """
+    @api.doc('export_products', security='apikey')
+    @api.produces(['text/csv'])
+    @token_required
+    def get(self):
+        """ Exports all of the Products as CSV """
+        app.logger.info('Request to export products as CSV')
+        return Response(stream_with_context(iter_csv()), mimetype='text/csv',
+                        headers={'Content-Disposition': 'attachment; filename=products.csv'})
+
+######################################################################
+#  PATH: /admin/logging
+######################################################################
+@api.route('/admin/logging')
+class LoggingSettings(Resource):
+    """ Tunes the logging of the running service """
+    @api.doc('get_logging', security='apikey')
+    @token_required
+    def get(self):
+        """ Returns the sampling rules, the suppressed records and the log queue """
+        return {'rules': sampling_filter.rules,
+                'levels': logging_levels(list(sampling_filter.rules)),
+                'sites': sampling_filter.stats(),
+                'queue': logging_stats()}, status.HTTP_200_OK
+
+    @api.doc('update_logging', security='apikey')
+    @api.expect(logging_settings_model)
+    @api.response(400, 'The logging settings were not valid')
+    @token_required
+    def put(self):
+        """
+        Changes the sampling rules and the logger levels
+        The rules replace the current ones; loggers not in levels keep theirs.
+        With LOG_SETTINGS_FILE the other workers take them up within a second
+        """
+        app.logger.info('Request to change the logging settings')
+        check_content_type('application/json')
+        data = api.payload or {}
+        rules = data.get('rules', sampling_filter.rules)
+        levels = data.get('levels', {})
+        if not isinstance(rules, dict) or not isinstance(levels, dict):
+            raise DataValidationError('Invalid logging settings: rules and levels must be objects')
+        for name, level in levels.items():
+            if not isinstance(logging.getLevelName(str(level).upper()), int):
+                raise DataValidationError('Invalid level for {}: {}'.format(name, level))
+        try:
+            shared_settings.save(rules, levels)
+        except ValueError as error:
+            raise DataValidationError(str(error))
+        return {'rules': sampling_filter.rules,
+                'levels': logging_levels(list(rules) + list(levels))}, status.HTTP_200_OK
+
 ######################################################################
 #  PATH: /products/{id}/buy
 ######################################################################
@@ -308,25 +703,82 @@ class BuyResource(Resource):
     # BUY A PRODUCT
     # ------------------------------------------------------------------
     @api.doc('buy_products')
+    @api.expect(buy_args, validate=True)
+    @api.response(400, 'The quantity was not valid')
     @api.response(404, 'Product not found')
     @api.response(409, 'The Product is not available for purchase')
     @api.marshal_with(product_model)
     def put(self, product_id):
         """Buy a Product by id"""
         app.logger.info('Request for buy a product')
-        product = Product.find(product_id)
+        quantity = request.args.get('quantity', 1)
+        try:
+            quantity = int(quantity)
+        except ValueError:
+            raise DataValidationError('Invalid quantity: {}'.format(quantity))
+        product = Product.purchase(product_id, quantity)
         if not product:
-            api.abort(status.HTTP_404_NOT_FOUND,
-                      "Product with id '{}' was not found.".format(product_id))
-        elif product.stock == 0:
+            # Only a failed purchase pays for telling missing from sold out,
+            # from the database as the cache of this worker may be stale
+            product = Product.find(product_id, fresh=True)
+            if not product:
+                api.abort(status.HTTP_404_NOT_FOUND,
+                          "Product with id '{}' was not found.".format(product_id))
+            elif product.stock == 0:
+                api.abort(status.HTTP_409_CONFLICT,
+                          "Product with id '{}' has been sold out!".format(product_id))
             api.abort(status.HTTP_409_CONFLICT,
-                      "Product with id '{}' has been sold out!".format(product_id))
-        else:
-            product.stock = product.stock - 1
-        product.save()
+                      "Product with id '{}' has only {} left in stock.".format(
+                          product_id, product.stock))
         app.logger.info('Product with id [%s] has been bought!', product.id)
         return product.serialize(), status.HTTP_200_OK
 
+######################################################################
+#  PATH: /products/{id}/shards
+######################################################################
+@api.route('/products/<product_id>/shards')
+@api.param('product_id', 'The Product identifier')
+class StockShardsResource(Resource):
+    """
+    The stock counters of a hot Product
+
+    During a flash sale every buy of a Product locks its row; splitting
+    its stock across counters lets concurrent buys take from different rows
+    """
+    @api.doc('get_stock_shards')
+    @api.response(404, 'Product not found')
+    @api.marshal_with(stock_shards_model)
+    def get(self, product_id):
+        """ Returns the stock counters of a Product """
+        row = Product.find_row(product_id)
+        if not row:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Product with id '{}' was not found.".format(product_id))
+        return stock_shards_report(row), status.HTTP_200_OK
+
+    @api.doc('update_stock_shards', security='apikey')
+    @api.expect(stock_shards_model)
+    @api.response(400, 'The number of shards was not valid')
+    @api.response(404, 'Product not found')
+    @api.marshal_with(stock_shards_model)
+    @token_required
+    def put(self, product_id):
+        """
+        Splits the stock of a Product across counters
+        With shards 0 the stock goes back to the product row; a hot Product
+        also goes back once it has not been bought for a while
+        """
+        app.logger.info('Request to split the stock of product %s', product_id)
+        check_content_type('application/json')
+        data = api.payload
+        if not isinstance(data, dict) or 'shards' not in data:
+            raise DataValidationError('Invalid shards: body must be {shards}')
+        row = Product.set_stock_shards(product_id, data['shards'])
+        if not row:
+            api.abort(status.HTTP_404_NOT_FOUND,
+                      "Product with id '{}' was not found.".format(product_id))
+        return stock_shards_report(row), status.HTTP_200_OK
+
 ######################################################################
 # DELETE ALL PRODUCTS (for testing only)
 ######################################################################
@@ -380,13 +832,99 @@ def delete_products_all():
 ######################################################################
 #  U T I L I T Y   F U N C T I O N S
 ######################################################################
-@app.before_first_request
 def init_db():
     """ Initialies the SQLAlchemy app """
     global app
     Product.init_db(app)
 
 
+def product_filters():
+    """ Reads and type checks the filters of a product listing request """
+    args = request.args
+    categories = [category for value in args.getlist('category')
+                  for category in value.split(',') if category]
+    filters = {'category': categories or None,
+               'name': args.get('name') or None,
+               'name_prefix': args.get('name_prefix') or None}
+    parsers = [('min_price', 'min_price', Decimal), ('max_price', 'max_price', Decimal),
+               ('price', 'price_bucket', int), ('in_stock', 'in_stock', inputs.boolean),
+               ('min_stock', 'min_stock', int), ('max_stock', 'max_stock', int)]
+    for arg, key, parse in parsers:
+        value = args.get(arg)
+        if not value:
+            continue
+        try:
+            filters[key] = parse(value)
+        except (ValueError, InvalidOperation):
+            raise DataValidationError('Invalid {}: {}'.format(arg, value))
+        if parse is Decimal and not filters[key].is_finite():
+            raise DataValidationError('Invalid {}: {}'.format(arg, value))
+    return filters
+
+
+def lookup_products(ids):
+    """ Returns the Products of comma separated ids, with the missing ids in a header """
+    app.logger.info('Request for products by ids')
+    rows, missing = Product.find_many([product_id for product_id in ids.split(',')
+                                       if product_id.strip()])
+    headers = {}
+    if missing:
+        headers['X-Missing-Ids'] = ','.join(str(product_id) for product_id in missing)
+    return [serialize_row(row) for row in rows], status.HTTP_200_OK, headers
+
+
+def stock_shards_report(row):
+    """ Returns the stock of a Product row with that of each of its counters """
+    return {'id': row.id, 'stock': row.stock, 'shards': row.stock_shards,
+            'counters': Product.find_shards(row.id) if row.stock_shards else []}
+
+
+def logging_levels(names):
+    """ Returns the effective level of the main loggers and of each named one """
+    levels = {}
+    for name in ['root', 'service', 'app'] + names:
+        if name != '*':
+            logger = logging.getLogger(None if name == 'root' else name.split(':')[0])
+            levels[name] = logging.getLevelName(logger.getEffectiveLevel())
+    return levels
+
+
+def abort_precondition_failed(product_id):
+    """ Rejects a conditional request whose If-Match does not hold """
+    api.abort(status.HTTP_412_PRECONDITION_FAILED,
+              "Product with id '{}' does not match If-Match.".format(product_id))
+
+
+def stream_products(rows, ndjson):
+    """
+    Streams Product rows as newline delimited JSON or as a chunked JSON array
+    Rows are encoded and flushed one database batch at a time so memory
+    use is bounded by the batch size rather than the size of the result
+    """
+    def generate():
+        batch = []
+        first = True
+        if not ndjson:
+            yield '['
+        for row in rows:
+            data = json.dumps(serialize_row(row))
+            if ndjson:
+                batch.append(data + '\n')
+            else:
+                batch.append(data if first else ',' + data)
+                first = False
+            if len(batch) >= STREAM_BATCH_SIZE:
+                yield ''.join(batch)
+                batch = []
+        if batch:
+            yield ''.join(batch)
+        if not ndjson:
+            yield ']'
+
+    mimetype = NDJSON_MIMETYPE if ndjson else 'application/json'
+    return Response(stream_with_context(generate()), mimetype=mimetype)
+
+
 def check_content_type(content_type):
     """ Checks that the media type is correct """
     if request.headers['Content-Type'] == content_type:
@@ -0,0 +1,227 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the 'License');
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an 'AS IS' BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Service startup
+
+Gets a worker ready before it takes traffic instead of on its first
+request: the database is initialized, the connection pool is filled, the
+Product cache is primed and the first-request hooks are run, each stage
+timed in the logs. Until that is done /ready answers 503, and so does
+every other endpoint except the probes and the docs.
+
+If the database cannot be reached within STARTUP_TIMEOUT seconds the
+worker starts anyway, not ready, and keeps retrying in the background.
+
+When gunicorn preloads the app, startup runs once in the master process and
+after_fork gets each forked worker its own connections and threads. The
+master stops retrying once it forks, and a worker forked before the master
+was ready retries on its own. Without EAGER_STARTUP the worker starts on
+its first request instead.
+
+Paths
+-----
+GET /ready - 200 once the worker is ready, 503 before
+"""
+
+import threading
+import time
+
+from flask import jsonify, request
+from flask_api import status
+from service import app, health, metrics
+from service.model import Product, db
+from loggin import logger
+
+# The endpoints that answer before the worker is ready
+PROBE_ENDPOINTS = ('ready', 'healthcheck', 'prometheus_metrics', 'index',
+                   'static', 'doc', 'specs', 'restplus_doc.static')
+# Seconds between two startup attempts
+RETRY_INTERVAL = 2
+
+
+class StartupState(object):
+    """ How far the startup of this worker went """
+
+    def __init__(self):
+        self.ready = False
+        self.stages = {}
+        self.error = None
+        self.attempts = 0
+
+    def serialize(self):
+        return {'ready': self.ready,
+                'stages': {name: round(ms, 1) for name, ms in self.stages.items()},
+                'attempts': self.attempts,
+                'error': self.error}
+
+
+state = StartupState()
+_retry_thread = None
+_retry_stopped = threading.Event()
+_lazy_lock = threading.Lock()
+
+
+def run_startup():
+    """ Runs every startup stage, raising the error of a stage that fails """
+    state.attempts += 1
+    started = time.perf_counter()
+    with app.app_context():
+        for name, stage in STAGES:
+            stage_started = time.perf_counter()
+            stage()
+            state.stages[name] = (time.perf_counter() - stage_started) * 1000
+            app.logger.info('Startup stage %s done in %.1f ms', name, state.stages[name])
+    state.ready = True
+    state.error = None
+    app.logger.info('Service ready in %.1f ms', (time.perf_counter() - started) * 1000)
+
+
+def start(timeout=None):
+    """
+    Gets the worker ready, waiting up to timeout seconds for the database,
+    then carries on retrying in a background thread
+    """
+    timeout = app.config.get('STARTUP_TIMEOUT', 30) if timeout is None else timeout
+    deadline = time.time() + timeout
+    while True:
+        try:
+            run_startup()
+            return True
+        except Exception as error:  # pylint: disable=broad-except
+            state.error = str(error)
+            app.logger.warning('Startup attempt %d failed: %s', state.attempts, error)
+        if time.time() + RETRY_INTERVAL > deadline:
+            break
+        time.sleep(RETRY_INTERVAL)
+    start_retry()
+    return False
+
+
+def start_lazily():
+    """ Starts a worker that did not start eagerly, once, on its first request """
+    with _lazy_lock:
+        if state.ready or state.attempts:
+            return
+        start(timeout=0)
+
+
+def start_retry(on_ready=None):
+    """ Retries the startup in a background thread of this process until it is ready """
+    global _retry_thread, _retry_stopped
+    _retry_stopped = threading.Event()
+    _retry_thread = threading.Thread(target=_retry, args=(_retry_stopped, on_ready),
+                                     name='startup', daemon=True)
+    _retry_thread.start()
+
+
+def stop_retry():
+    """ Stops retrying the startup, e.g. in the master once it forks the workers """
+    _retry_stopped.set()
+    if _retry_thread is not None and _retry_thread is not threading.current_thread():
+        _retry_thread.join()
+
+
+def after_fork():
+    """
+    Gets a forked worker going: the threads of the parent did not survive
+    the fork and its connections must not be shared, so the worker opens
+    its own and restarts the log writer, the metrics and the health probes.
+    A worker forked before the master was ready retries the startup itself
+    """
+    db.get_engine(app).dispose()
+    logger.initialize_logging()
+    metrics.start_worker()
+    if state.ready:
+        warm_pool()
+        health.start_monitor()
+    else:
+        start_retry(on_ready=health.start_monitor)
+
+
+######################################################################
+#  S T A G E S
+######################################################################
+def init_database():
+    """ Connects to the database and creates the missing tables """
+    Product.init_db(app)
+
+
+def warm_pool():
+    """ Opens as many connections as the pool keeps, so requests do not wait on connects """
+    engine = db.get_engine(app)
+    size = engine.pool.size() if hasattr(engine.pool, 'size') else 1
+    connections = []
+    try:
+        for _ in range(size):
+            connection = engine.connect()
+            connections.append(connection)
+            connection.execute('SELECT 1')
+    finally:
+        for connection in connections:
+            connection.close()
+
+
+def prime_cache():
+    """ Loads the first Products into the cache """
+    Product.prime_cache(app.config.get('STARTUP_CACHE_PRIME', 1000))
+
+
+def run_first_request_hooks():
+    """ Runs what Flask would otherwise run on the first request """
+    app.try_trigger_before_first_request_functions()
+
+
+STAGES = [
+    ('database', init_database),
+    ('pool', warm_pool),
+    ('cache', prime_cache),
+    ('hooks', run_first_request_hooks),
+]
+
+
+def _retry(stopped, on_ready):
+    while not state.ready and not stopped.wait(RETRY_INTERVAL):
+        try:
+            run_startup()
+        except Exception as error:  # pylint: disable=broad-except
+            state.error = str(error)
+            app.logger.warning('Startup attempt %d failed: %s', state.attempts, error)
+        else:
+            if on_ready is not None:
+                on_ready()
+
+
+######################################################################
+#  R E A D I N E S S
+######################################################################
+@app.before_request
+def reject_until_ready():
+    """ Turns requests away until the worker is ready """
+    if not state.ready and not state.attempts:
+        start_lazily()
+    if not state.ready and request.endpoint not in PROBE_ENDPOINTS:
+        response = jsonify(status=status.HTTP_503_SERVICE_UNAVAILABLE,
+                           error='Service Unavailable', message='The service is starting')
+        response.status_code = status.HTTP_503_SERVICE_UNAVAILABLE
+        response.headers['Retry-After'] = str(RETRY_INTERVAL)
+        return response
+    return None
+
+
+@app.route('/ready')
+def ready():
+    """ Tells whether this worker is ready to take traffic """
+    code = status.HTTP_200_OK if state.ready else status.HTTP_503_SERVICE_UNAVAILABLE
+    return jsonify(state.serialize()), code
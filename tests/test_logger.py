@@ -0,0 +1,372 @@
+# Copyright 2019. All Rights Reserved.
+#
+# Licensed under the Apache License, Version 2.0 (the "License");
+# you may not use this file except in compliance with the License.
+# You may obtain a copy of the License at
+#
+# https://www.apache.org/licenses/LICENSE-2.0
+#
+# Unless required by applicable law or agreed to in writing, software
+# distributed under the License is distributed on an "AS IS" BASIS,
+# WITHOUT WARRANTIES OR CONDITIONS OF ANY KIND, either express or implied.
+# See the License for the specific language governing permissions and
+# limitations under the License.
+
+"""
+Test cases for the logging pipeline
+Test cases can be run with:
+  nosetests
+  coverage report -m
+"""
+import gzip
+import json
+import logging
+import os
+import shutil
+import tempfile
+import unittest
+from queue import Queue
+
+from service import app
+from loggin import logger
+from loggin.logger import BoundedQueueHandler, BlockingQueueListener, initialize_logging
+from loggin.logger import LevelRoutingFileHandler, JsonLinesFormatter, RequestContextFilter
+from loggin.logger import get_json_encoder, LogSamplingFilter, SharedLogSettings
+
+
+class ListHandler(logging.Handler):
+    """ Keeps the messages it handles """
+
+    def __init__(self):
+        logging.Handler.__init__(self)
+        self.messages = []
+
+    def emit(self, record):
+        self.messages.append(self.format(record))
+
+
+def make_record(message, *args, level=logging.INFO, name='app', line=1, function='find'):
+    return logging.LogRecord(name, level, __file__, line, message, args, None, function)
+
+
+######################################################################
+#  T E S T   C A S E S
+######################################################################
+class TestLogger(unittest.TestCase):
+    """ Logging Pipeline Tests """
+
+    def tearDown(self):
+        initialize_logging()
+
+    def test_drop_new_records(self):
+        """ Drop and count the records that do not fit in the queue """
+        handler = BoundedQueueHandler(Queue(2), overflow='drop')
+        for number in range(5):
+            handler.handle(make_record('record %d', number))
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual([handler.queue.get().msg for _ in range(2)],
+                         ['record 0', 'record 1'])
+
+    def test_drop_oldest_records(self):
+        """ Make room for new records by dropping the oldest ones """
+        handler = BoundedQueueHandler(Queue(2), overflow='drop_oldest')
+        for number in range(5):
+            handler.handle(make_record('record %d', number))
+        self.assertEqual(handler.dropped, 3)
+        self.assertEqual([handler.queue.get().msg for _ in range(2)],
+                         ['record 3', 'record 4'])
+
+    def test_bad_overflow_policy(self):
+        """ Reject an unknown overflow policy """
+        self.assertRaises(ValueError, BoundedQueueHandler, Queue(2), 'wait')
+
+    def test_listener_writes_records(self):
+        """ Write every queued record, exceptions included, when stopped """
+        handler = BoundedQueueHandler(Queue(10))
+        target = ListHandler()
+        target.setFormatter(logging.Formatter('%(levelname)s %(message)s'))
+        listener = BlockingQueueListener(handler.queue, target)
+        listener.start()
+        for number in range(20):
+            handler.handle(make_record('record %d', number))
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            record = make_record('failed')
+            record.exc_info = logging.sys.exc_info()
+            handler.handle(record)
+        listener.stop()
+        self.assertEqual(len(target.messages), 21)
+        self.assertEqual(target.messages[0], 'INFO record 0')
+        self.assertIn('ValueError: broken', target.messages[-1])
+
+    def test_initialize_logging_twice(self):
+        """ Route the app logs through a single queue however often it is set up """
+        app.config['LOG_OVERFLOW'] = 'drop'
+        try:
+            initialize_logging()
+            initialize_logging()
+        finally:
+            app.config['LOG_OVERFLOW'] = 'block'
+        root = logging.getLogger()
+        self.assertEqual(len(root.handlers), 1)
+        self.assertIsInstance(root.handlers[0], BoundedQueueHandler)
+        self.assertIs(logging.getLogger('service').handlers[0], root.handlers[0])
+        app.logger.info('Queued message')
+        logger.stop_logging()
+        stats = logger.logging_stats()
+        self.assertEqual(stats['queued'], 0)
+        self.assertEqual(stats['overflow'], 'drop')
+
+
+class TestLevelRoutingFileHandler(unittest.TestCase):
+    """ Level Routing File Handler Tests """
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.now = [1000.0]
+        self.handler = None
+
+    def tearDown(self):
+        if self.handler:
+            self.handler.close()
+        shutil.rmtree(self.log_dir)
+
+    def make_handler(self, **kwargs):
+        kwargs.setdefault('flush_interval', 0)
+        self.handler = LevelRoutingFileHandler(self.log_dir, clock=lambda: self.now[0],
+                                               **kwargs)
+        return self.handler
+
+    def read(self, filename):
+        with open(os.path.join(self.log_dir, filename)) as log_file:
+            return log_file.read()
+
+    def test_route_by_level(self):
+        """ Write each record to the file of its level only """
+        handler = self.make_handler()
+        for level in (logging.DEBUG, logging.INFO, logging.WARNING, logging.ERROR,
+                      logging.CRITICAL):
+            handler.handle(make_record(logging.getLevelName(level), level=level))
+        handler.flush()
+        self.assertEqual(self.read('debug.log'), 'DEBUG\n')
+        self.assertEqual(self.read('info.log'), 'INFO\n')
+        # warnings and critical errors go with the errors
+        self.assertEqual(self.read('error.log'), 'WARNING\nERROR\nCRITICAL\n')
+        self.assertEqual(sorted(os.listdir(self.log_dir)),
+                         ['debug.log', 'error.log', 'info.log'])
+
+    def test_buffered_writes(self):
+        """ Flush buffered records after flush_interval and on errors """
+        handler = self.make_handler(flush_interval=60)
+        handler.handle(make_record('first'))
+        self.assertEqual(self.read('info.log'), '')
+        self.now[0] += 60
+        handler.handle(make_record('second'))
+        self.assertEqual(self.read('info.log'), 'first\nsecond\n')
+        handler.handle(make_record('failed', level=logging.ERROR))
+        self.assertEqual(self.read('error.log'), 'failed\n')
+
+    def test_reopen_moved_file(self):
+        """ Notice a file moved away by an external rotation """
+        handler = self.make_handler(watch_interval=5)
+        handler.handle(make_record('before'))
+        os.rename(os.path.join(self.log_dir, 'info.log'),
+                  os.path.join(self.log_dir, 'info.log.old'))
+        self.now[0] += 5
+        handler.handle(make_record('after'))
+        handler.flush()
+        self.assertEqual(self.read('info.log.old'), 'before\n')
+        self.assertEqual(self.read('info.log'), 'after\n')
+
+    def test_rotate_by_size(self):
+        """ Rotate and gzip a file past max_bytes, keeping backup_count files """
+        handler = self.make_handler(max_bytes=20, backup_count=2)
+        for number in range(4):
+            handler.handle(make_record('record number %d', number))
+            self.now[0] += 1
+        handler.close()
+        self.handler = None
+        rotated = sorted(name for name in os.listdir(self.log_dir)
+                         if name.startswith('info.log.'))
+        self.assertEqual(len(rotated), 2)
+        self.assertTrue(all(name.endswith('.gz') for name in rotated))
+        with gzip.open(os.path.join(self.log_dir, rotated[-1]), 'rt') as log_file:
+            self.assertEqual(log_file.read(), 'record number 2\n')
+        self.assertEqual(self.read('info.log'), 'record number 3\n')
+
+    def test_rotate_by_time(self):
+        """ Rotate a file on every rotate_interval boundary """
+        handler = self.make_handler(rotate_interval=100, compress=False)
+        handler.handle(make_record('monday'))
+        self.now[0] += 50
+        handler.handle(make_record('still monday'))
+        self.now[0] += 50
+        handler.handle(make_record('tuesday'))
+        handler.flush()
+        rotated = [name for name in os.listdir(self.log_dir) if name.startswith('info.log.')]
+        self.assertEqual(len(rotated), 1)
+        self.assertEqual(self.read(rotated[0]), 'monday\nstill monday\n')
+        self.assertEqual(self.read('info.log'), 'tuesday\n')
+
+
+class TestJsonLinesFormatter(unittest.TestCase):
+    """ JSON Lines Formatter Tests """
+
+    def test_format_record(self):
+        """ Format a record as one line of JSON """
+        formatter = JsonLinesFormatter(encoder='json')
+        record = make_record('Saving %s', 'Steak\nand fries')
+        record.created = 86400.25
+        line = formatter.format(record)
+        self.assertNotIn('\n', line)
+        data = json.loads(line)
+        self.assertEqual(data['@timestamp'], '1970-01-02T00:00:00.250000Z')
+        self.assertEqual(data['message'], 'Saving Steak\nand fries')
+        self.assertEqual(data['level'], 'INFO')
+        self.assertEqual(data['logger'], 'app')
+        self.assertNotIn('request_id', data)
+
+    def test_format_exception(self):
+        """ Keep the traceback of a record in one field """
+        formatter = JsonLinesFormatter()
+        try:
+            raise ValueError('broken')
+        except ValueError:
+            record = make_record('failed')
+            record.exc_info = logging.sys.exc_info()
+        data = json.loads(formatter.format(record))
+        self.assertIn('ValueError: broken', data['exception'])
+
+    def test_timestamp_cache(self):
+        """ Compute the timestamps right across seconds """
+        formatter = JsonLinesFormatter()
+        self.assertEqual(formatter.timestamp(59.5), '1970-01-01T00:00:59.500000Z')
+        self.assertEqual(formatter.timestamp(59.75), '1970-01-01T00:00:59.750000Z')
+        self.assertEqual(formatter.timestamp(60.0), '1970-01-01T00:01:00.000000Z')
+
+    def test_encoders(self):
+        """ Fall back on the json module and reject unknown encoders """
+        self.assertEqual(get_json_encoder('json')({'a': 1}), '{"a":1}')
+        self.assertEqual(json.loads(get_json_encoder()({'a': 'é'})), {'a': 'é'})
+        self.assertRaises(ImportError, get_json_encoder, 'nojson')
+
+    def test_request_fields(self):
+        """ Add the fields of the current request to its records """
+        formatter = JsonLinesFormatter()
+        request_filter = RequestContextFilter()
+        with app.test_request_context('/products/1', method='PUT',
+                                      headers={'X-Request-Id': 'abc'}):
+            app.preprocess_request()
+            record = make_record('Updating')
+            request_filter.filter(record)
+        data = json.loads(formatter.format(record))
+        self.assertEqual(data['request_id'], 'abc')
+        self.assertEqual(data['method'], 'PUT')
+        self.assertEqual(data['route'], '/products/<product_id>')
+        self.assertGreaterEqual(data['latency_ms'], 0)
+        resp = app.test_client().get('/healthcheck', headers={'X-Request-Id': 'abc'})
+        self.assertEqual(resp.headers['X-Request-Id'], 'abc')
+
+
+class TestLogSamplingFilter(unittest.TestCase):
+    """ Log Sampling Filter Tests """
+
+    def setUp(self):
+        self.now = [0.0]
+        self.handler = ListHandler()
+        self.sampling = LogSamplingFilter(clock=lambda: self.now[0])
+        self.sampling.handler = self.handler
+
+    def kept(self, count, **kwargs):
+        return sum(self.sampling.filter(make_record('lookup', **kwargs)) for _ in range(count))
+
+    def test_no_rules(self):
+        """ Keep every record without rules """
+        self.assertEqual(self.kept(100), 100)
+
+    def test_sample(self):
+        """ Keep one record in every sample per call site """
+        self.sampling.configure({'app': {'sample': 10}})
+        self.assertEqual(self.kept(100), 10)
+        self.assertEqual(self.kept(100, line=2), 10)
+        # other loggers and warnings are not sampled
+        self.assertEqual(self.kept(100, name='service'), 100)
+        self.assertEqual(self.kept(100, level=logging.WARNING), 100)
+
+    def test_rate_limit(self):
+        """ Keep at most rate records per second after a burst """
+        self.sampling.configure({'app.model:find': {'rate': 2, 'burst': 5}})
+        self.assertEqual(self.kept(100, name='app.model'), 5)
+        self.assertEqual(self.kept(100, name='app.model', function='all'), 100)
+        self.now[0] += 1
+        self.assertEqual(self.kept(100, name='app.model'), 2)
+        self.now[0] += 100
+        self.assertEqual(self.kept(100, name='app.model'), 5)
+
+    def test_summary(self):
+        """ Report the suppressed records of a call site """
+        self.sampling.configure({'*': {'sample': 3}})
+        self.kept(30)
+        self.assertEqual(self.handler.messages, [])
+        self.now[0] += 60
+        self.kept(1)
+        self.assertEqual(self.handler.messages, ['suppressed 20 similar messages'])
+        self.kept(3000)
+        self.sampling.flush_summaries()
+        self.assertEqual(self.handler.messages[-1], 'suppressed 2,000 similar messages')
+        self.assertEqual(self.sampling.stats()[0]['seen'], 3031)
+
+    def test_bad_rules(self):
+        """ Reject rules that are not valid """
+        for rules in ({'app': 10}, {'app': {}}, {'app': {'sample': 0}},
+                      {'app': {'sample': 1.5}}, {'app': {'every': 2}},
+                      {'app': {'rate': 'fast'}}):
+            self.assertRaises(ValueError, self.sampling.configure, rules)
+
+
+class TestSharedLogSettings(unittest.TestCase):
+    """ Shared Log Settings Tests """
+
+    def setUp(self):
+        self.log_dir = tempfile.mkdtemp()
+        self.path = os.path.join(self.log_dir, 'logging-settings.json')
+        self.now = [0.0]
+
+    def tearDown(self):
+        logger.apply_logging_settings({}, {'shared.one': 'NOTSET', 'shared.two': 'NOTSET'})
+        shutil.rmtree(self.log_dir)
+
+    def test_share_between_workers(self):
+        """ A change saved by one worker is applied by the others on refresh """
+        worker = SharedLogSettings(self.path, interval=1, clock=lambda: self.now[0])
+        other = SharedLogSettings(self.path, interval=1, clock=lambda: self.now[0])
+        worker.save({'app': {'sample': 10}}, {'shared.one': 'debug'})
+        worker.save({'app': {'sample': 20}}, {'shared.two': 'error'})
+        # the other worker missed both changes
+        logger.apply_logging_settings({}, {'shared.one': 'NOTSET', 'shared.two': 'NOTSET'})
+        other.refresh()
+        self.assertEqual(logger.sampling_filter.rules, {'app': {'sample': 20}})
+        self.assertEqual(logging.getLogger('shared.one').level, logging.DEBUG)
+        self.assertEqual(logging.getLogger('shared.two').level, logging.ERROR)
+        # it looks at the file once per interval, and only applies a new one
+        logger.apply_logging_settings({}, {})
+        other.refresh()
+        self.now[0] += 1
+        other.refresh()
+        self.assertEqual(logger.sampling_filter.rules, {})
+        worker.save({'*': {'rate': 5}}, {})
+        logger.apply_logging_settings({}, {})
+        other.refresh()
+        self.assertEqual(logger.sampling_filter.rules, {})
+        self.now[0] += 1
+        other.refresh()
+        self.assertEqual(logger.sampling_filter.rules, {'*': {'rate': 5}})
+
+    def test_without_file(self):
+        """ Apply the settings to this worker only without a file """
+        settings = SharedLogSettings()
+        settings.save({'app': {'sample': 3}}, {})
+        settings.refresh()
+        self.assertEqual(logger.sampling_filter.rules, {'app': {'sample': 3}})
+        self.assertEqual(os.listdir(self.log_dir), [])
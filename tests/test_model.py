@@ -18,12 +18,24 @@ Test cases can be run with:
   nosetests
   coverage report -m
 """
+import logging
+import shutil
+import sqlite3
 import sys
+import tempfile
+import time
 import unittest
 import os
+from unittest.mock import patch
 from werkzeug.exceptions import NotFound
-from service.model import Product, DataValidationError, db
+from sqlalchemy.engine.url import make_url
+from sqlalchemy.exc import TimeoutError as PoolTimeoutError
+from sqlalchemy.orm.exc import StaleDataError
+from service.model import Product, ProductCache, DataValidationError, db
+from service.model import PAGE_LIMIT_DEFAULT, PAGE_LIMIT_MAX, FIND_MANY_MAX, query_timer
+from service.model import pool_stats, TimedNullPool, TimedQueuePool, STOCK_SHARDS_MAX
 from service import app
+from loggin.logger import LevelRoutingFileHandler
 from decimal import *
 
 DATABASE_URI = os.getenv(
@@ -50,6 +62,8 @@ class TestProducts(unittest.TestCase):
         pass
 
     def setUp(self):
+        self.ctx = app.app_context()
+        self.ctx.push()
         Product.init_db(app)
         db.drop_all()    # clean up the last tests
         db.create_all()  # make our sqlalchemy tables
@@ -58,6 +72,7 @@ class TestProducts(unittest.TestCase):
         db.session.remove()
         db.drop_all()
         db.get_engine(app).dispose()
+        self.ctx.pop()
 
     ##### Create a product #####
     def test_create_a_product(self):
@@ -109,6 +124,39 @@ class TestProducts(unittest.TestCase):
         self.assertEqual(len(products), 1)
         self.assertEqual(products[0].category, "beverage")
 
+    def test_create_many_products(self):
+        """ Create many Products in one transaction """
+        products = [Product(name="product {}".format(i), category="food",
+                            stock=i, price=i + 0.5, description="bulk")
+                    for i in range(5)]
+        ids = Product.create_many(products, chunk_size=2)
+        self.assertEqual(len(ids), 5)
+        self.assertEqual(len(Product.all()), 5)
+        for i, product_id in enumerate(ids):
+            self.assertEqual(Product.find(product_id).name, "product {}".format(i))
+
+    def test_update_a_stale_product(self):
+        """ Refuse to overwrite a Product changed since it was read """
+        product = Product(name="shampos", category="Health Care", stock=48, price=12.34)
+        product.save()
+        self.assertEqual(product.version, 1)
+        Product.find(product.id)
+        db.session.remove()
+        # another process updates the product behind the cache's back
+        db.session.execute(Product.__table__.update().values(
+            stock=47, version=Product.__table__.c.version + 1))
+        db.session.commit()
+        stale = Product.find(product.id)
+        self.assertEqual(stale.version, 1)
+        stale.category = "beauty"
+        self.assertRaises(StaleDataError, stale.save)
+        product = Product.find(product.id)
+        self.assertEqual(product.version, 2)
+        self.assertEqual(product.category, "Health Care")
+        product.category = "beauty"
+        product.save()
+        self.assertEqual(product.version, 3)
+
     ##### Delete a product #####
     def test_delete_a_product(self):
         """ Delete a Product """
@@ -166,6 +214,24 @@ class TestProducts(unittest.TestCase):
         product = Product()
         self.assertRaises(DataValidationError, product.deserialize, data)
 
+    def test_validate_ranges(self):
+        """ Reject a stock or a price that its column cannot hold """
+        def product(**fields):
+            data = {"name": "shampos", "category": "Health Care", "stock": 1,
+                    "price": "12.34", "description": None}
+            data.update(fields)
+            return Product().deserialize(data)
+
+        self.assertEqual(product(stock="48").validate().stock, 48)
+        self.assertEqual(product(stock=2.0).validate().stock, 2)
+        self.assertEqual(product(stock=2 ** 31 - 1).validate().stock, 2 ** 31 - 1)
+        self.assertEqual(product(price="9999999999999999.99").validate().price,
+                         Decimal("9999999999999999.99"))
+        for fields in ({"stock": 1.7}, {"stock": "1.7"}, {"stock": 2 ** 31},
+                       {"stock": -2 ** 31 - 1}, {"stock": float("inf")},
+                       {"price": "1e16"}, {"price": -10 ** 17}):
+            self.assertRaises(DataValidationError, product(**fields).validate)
+
     ##### Find a product #####
     def test_find_product(self):
         """ Find a Product by ID """
@@ -214,3 +280,379 @@ class TestProducts(unittest.TestCase):
         print(products[0].price)
         print(getcontext())
         self.assertAlmostEqual(products[0].price, Decimal(12.34))
+
+    ##### Buy a product #####
+    def test_purchase(self):
+        """ Buy a Product with a conditional update """
+        product = Product(name="shampos", category="Health Care", stock=3, price=12.34)
+        product.save()
+        bought = Product.purchase(product.id, 2)
+        self.assertEqual(bought.id, product.id)
+        self.assertEqual(bought.stock, 1)
+        self.assertIsNone(Product.purchase(product.id, 2))
+        self.assertIsNone(Product.purchase(product.id + 1))
+        self.assertEqual(Product.find(product.id).stock, 1)
+        self.assertRaises(DataValidationError, Product.purchase, product.id, 0)
+
+    ##### Page through products #####
+    def test_paginate(self):
+        """ Page through Products by name with a keyset cursor """
+        for name in ["kiwi", "apple", "fig", "apple", "banana"]:
+            Product(name=name, category="food", stock=1, price=2.5).save()
+        products, cursor = Product.paginate(Product.query, limit=2, sort="name")
+        self.assertEqual([p.name for p in products], ["apple", "apple"])
+        self.assertIsNotNone(cursor)
+        products, cursor = Product.paginate(Product.query, limit=2,
+                                            cursor=cursor, sort="name")
+        self.assertEqual([p.name for p in products], ["banana", "fig"])
+        products, cursor = Product.paginate(Product.query, limit=2,
+                                            cursor=cursor, sort="name")
+        self.assertEqual([p.name for p in products], ["kiwi"])
+        self.assertIsNone(cursor)
+
+    def test_paginate_null_sort_values(self):
+        """ Page through Products whose sort column is null, both ways """
+        for name in ["fig", None, "apple", None, None, "kiwi"]:
+            Product(name=name, category="food", stock=1, price=None).save()
+        for sort in ("name", "-name", "price", "-price"):
+            seen = []
+            cursor = None
+            while True:
+                products, cursor = Product.paginate(Product.query, limit=2,
+                                                    cursor=cursor, sort=sort)
+                seen.extend(p.id for p in products)
+                if cursor is None:
+                    break
+            self.assertEqual(len(seen), 6, sort)
+            self.assertEqual(len(set(seen)), 6, sort)
+        names = []
+        cursor = None
+        while True:
+            products, cursor = Product.paginate(Product.query, limit=2,
+                                                cursor=cursor, sort="name")
+            names.extend(p.name for p in products)
+            if cursor is None:
+                break
+        self.assertEqual(names, ["apple", "fig", "kiwi", None, None, None])
+
+    def test_paginate_caps_limit(self):
+        """ The page size is capped on the server """
+        self.assertEqual(Product._parse_limit(None), PAGE_LIMIT_DEFAULT)
+        self.assertEqual(Product._parse_limit(PAGE_LIMIT_MAX * 10), PAGE_LIMIT_MAX)
+        self.assertRaises(DataValidationError, Product._parse_limit, -1)
+
+    ##### Cache products #####
+    def test_find_product_cached(self):
+        """ Serve repeated lookups from the cache """
+        product = Product(name="shampos", category="Health Care", stock=48, price=12.34)
+        product.save()
+        self.assertEqual(Product.find(product.id).name, "shampos")
+        db.session.remove()
+        cached = Product.find(str(product.id))
+        self.assertEqual(Product.cache.stats()['hits'], 1)
+        self.assertEqual(cached.name, "shampos")
+        self.assertEqual(cached.stock, 48)
+        # a cached Product can still be updated and deleted
+        cached.stock = 40
+        cached.save()
+        self.assertEqual(Product.find(product.id).stock, 40)
+        Product.find(product.id).delete()
+        self.assertIsNone(Product.find(product.id))
+
+    def test_find_row(self):
+        """ Find the row of a Product without building the Product """
+        product = Product(name="shampos", category="Health Care", stock=48, price=12.34)
+        product.save()
+        row = Product.find_row(product.id)
+        self.assertEqual(row.name, "shampos")
+        self.assertEqual(row.stock, 48)
+        self.assertEqual(Product.row_etag(row), product.etag())
+        # the row is cached and shared with find
+        self.assertEqual(Product.find_row(product.id), row)
+        self.assertEqual(Product.find(product.id).name, "shampos")
+        self.assertEqual(Product.cache.stats()['hits'], 2)
+        self.assertIsNone(Product.find_row(0))
+
+    def test_cache_invalidation(self):
+        """ Writes invalidate the cached Products """
+        product = Product(name="shampos", category="Health Care", stock=3, price=12.34)
+        product.save()
+        Product.find(product.id)
+        Product.purchase(product.id, 2)
+        self.assertEqual(Product.find(product.id).stock, 1)
+        Product.delete_all()
+        self.assertEqual(Product.cache.stats()['size'], 0)
+        self.assertIsNone(Product.find(product.id))
+
+    def test_cache_eviction(self):
+        """ The cache evicts the least recently used and expired rows """
+        now = [0]
+        cache = ProductCache(maxsize=2, ttl=10, clock=lambda: now[0])
+        cache.set(1, ("one",))
+        cache.set(2, ("two",))
+        self.assertEqual(cache.get(1), ("one",))
+        cache.set(3, ("three",))
+        self.assertIsNone(cache.get(2))
+        self.assertEqual(cache.get(3), ("three",))
+        now[0] = 10
+        self.assertIsNone(cache.get(1))
+        self.assertEqual(cache.stats(), {'size': 1, 'maxsize': 2, 'hits': 2,
+                                         'misses': 2, 'evictions': 1})
+
+    ##### Time SQL statements #####
+    def test_count_queries(self):
+        """ Count the statements run in a block """
+        Product(name="shampos", category="Health Care", stock=48, price=12.34).save()
+        with query_timer.count() as stats:
+            Product.all()
+            with query_timer.count() as inner:
+                Product.find_by_category("Health Care").all()
+        Product.all()
+        self.assertEqual(stats.count, 2)
+        self.assertEqual(inner.count, 1)
+        self.assertGreater(stats.seconds, 0)
+
+    def test_slow_query_log(self):
+        """ Log the slow statements with their plan """
+        Product(name="shampos", category="Health Care", stock=48, price=12.34).save()
+        query_timer.slow_seconds = 1e-9
+        try:
+            with self.assertLogs('app', logging.WARNING) as logs:
+                Product.find_by_category("Health Care").all()
+        finally:
+            query_timer.slow_seconds = None
+        self.assertIn('Slow query', logs.output[0])
+        self.assertIn("'Health Care'", logs.output[0])
+        self.assertIn('ix_product_category_price', logs.output[0])
+
+    def test_slow_query_plan_savepoint(self):
+        """ A failing EXPLAIN on PostgreSQL rolls back to a savepoint """
+        executed = []
+
+        class Cursor(object):
+            def execute(self, statement, parameters=None):
+                executed.append(statement.split()[0])
+                if statement.startswith('EXPLAIN'):
+                    raise ValueError('cannot explain')
+
+            def close(self):
+                executed.append('close')
+
+        class Connection(object):
+            autocommit = False
+
+            def cursor(self):
+                return Cursor()
+
+        conn = type('Conn', (object,), {})()
+        conn.dialect = type('Dialect', (object,), {'name': 'postgresql'})()
+        conn.connection = Connection()
+        plan = query_timer._explain(conn, 'SELECT 1', {}, False)
+        self.assertIn('cannot explain', plan)
+        self.assertEqual(executed, ['SAVEPOINT', 'EXPLAIN', 'ROLLBACK', 'close'])
+
+    ##### Search products #####
+    def test_search(self):
+        """ Search Products by name and description, best match first """
+        Product(name="Lamb Chops", category="food", stock=5, price=11.5,
+                description="Grilled lamb, healthy and delicious").save()
+        Product(name="Wagyu Tenderloin Steak", category="food", stock=11, price=20.56,
+                description="The most decadent, succulent cut of beef, ever.").save()
+        shampoo = Product(name="Shampos", category="Health Care", stock=48, price=12.34,
+                          description="A hair care product for the lamb of the family")
+        shampoo.save()
+        products, cursor = Product.search("lamb")
+        self.assertEqual([p.name for p in products], ["Lamb Chops", "Shampos"])
+        self.assertIsNone(cursor)
+        products, _ = Product.search("lamb hair")
+        self.assertEqual([p.name for p in products], ["Shampos"])
+        self.assertEqual(Product.search('"beef" OR')[0], [])
+        # the index follows updates and deletes
+        shampoo.description = "A hair care product"
+        shampoo.save()
+        self.assertEqual(len(Product.search("lamb")[0]), 1)
+        Product.find_by_name("Lamb Chops")[0].delete()
+        self.assertEqual(Product.search("lamb")[0], [])
+        self.assertRaises(DataValidationError, Product.search, "  ")
+
+    def test_search_pages(self):
+        """ Page through search results """
+        for i in range(5):
+            Product(name="Tea {}".format(i), category="drink", stock=1, price=2,
+                    description="green tea").save()
+        products, cursor = Product.search("tea", limit=3)
+        self.assertEqual(len(products), 3)
+        more, cursor = Product.search("tea", limit=3, cursor=cursor)
+        self.assertEqual(len(more), 2)
+        self.assertIsNone(cursor)
+        self.assertEqual(len(set(p.id for p in products + more)), 5)
+
+    def test_slow_query_log_file(self):
+        """ Write the warning of a slow query to the error log file """
+        log_dir = tempfile.mkdtemp()
+        handler = LevelRoutingFileHandler(log_dir, flush_interval=0)
+        Product.logger.addHandler(handler)
+        query_timer.slow_seconds = 1e-9
+        try:
+            Product.find_row(1)
+        finally:
+            query_timer.slow_seconds = None
+            Product.logger.removeHandler(handler)
+            handler.close()
+        with open(os.path.join(log_dir, 'error.log')) as log_file:
+            self.assertIn('Slow query', log_file.read())
+        shutil.rmtree(log_dir)
+
+    def test_pool_options(self):
+        """ Configure the connection pool from the app settings """
+        options = {}
+        db.apply_driver_hacks(app, make_url('postgresql://user@localhost/products'), options)
+        self.assertEqual(options['poolclass'], TimedQueuePool)
+        self.assertEqual(options['pool_size'], app.config['DB_POOL_SIZE'])
+        self.assertEqual(options['max_overflow'], app.config['DB_MAX_OVERFLOW'])
+        self.assertEqual(options['pool_pre_ping'], app.config['DB_POOL_PRE_PING'])
+        app.config['DB_POOL'] = 'null'
+        try:
+            options = {}
+            db.apply_driver_hacks(app, make_url('postgresql://user@pgbouncer/products'),
+                                  options)
+        finally:
+            app.config['DB_POOL'] = 'queue'
+        self.assertEqual(options, {'poolclass': TimedNullPool})
+
+    def test_pool_checkout_wait(self):
+        """ Time the checkouts of the pool, counting those that time out """
+        pool_stats.reset()
+        pool = TimedQueuePool(lambda: sqlite3.connect(':memory:'), pool_size=1,
+                              max_overflow=0, timeout=0.01)
+        connection = pool.connect()
+        self.assertRaises(PoolTimeoutError, pool.connect)
+        connection.close()
+        stats = pool_stats.snapshot()
+        self.assertEqual(stats['checkouts'], 2)
+        self.assertEqual(stats['timeouts'], 1)
+        self.assertGreaterEqual(stats['max_wait_seconds'], 0.01)
+
+    def test_find_many(self):
+        """ Find many Products by id with one query, in the order asked """
+        products = [Product(name="item {}".format(i), category="misc", stock=i, price=1)
+                    for i in range(4)]
+        for product in products:
+            product.save()
+        Product.find_row(products[2].id)
+        ids = [products[3].id, 0, products[2].id, products[0].id, products[3].id]
+        with query_timer.count() as stats:
+            rows, missing = Product.find_many([str(product_id) for product_id in ids])
+        self.assertEqual([row.id for row in rows],
+                         [products[3].id, products[2].id, products[0].id])
+        self.assertEqual(missing, [0])
+        # the cached row needs no query, the others one between them
+        self.assertEqual(stats.count, 1)
+        self.assertEqual(Product.find_row(products[0].id).name, "item 0")
+        self.assertRaises(DataValidationError, Product.find_many, ['1', 'x'])
+        self.assertRaises(DataValidationError, Product.find_many, range(FIND_MANY_MAX + 1))
+
+    def test_checkout(self):
+        """ Buy many Products in one transaction, all or nothing """
+        tea = Product(name="tea", category="drink", stock=5, price=2)
+        tea.save()
+        cake = Product(name="cake", category="food", stock=1, price=4)
+        cake.save()
+        Product.find(tea.id)
+        rows, short = Product.checkout([(cake.id, 1), (tea.id, 2), (tea.id, 1)])
+        self.assertEqual(short, [])
+        self.assertEqual([(row.id, row.stock) for row in rows],
+                         sorted([(tea.id, 2), (cake.id, 0)]))
+        # the cached Product was invalidated
+        self.assertEqual(Product.find(tea.id).stock, 2)
+        rows, short = Product.checkout([(tea.id, 1), (cake.id, 1), (0, 1)])
+        self.assertEqual(rows, [])
+        self.assertEqual(short, [{'id': 0, 'requested': 1, 'available': 0},
+                                 {'id': cake.id, 'requested': 1, 'available': 0}])
+        self.assertEqual(Product.find(tea.id).stock, 2)
+        self.assertRaises(DataValidationError, Product.checkout, [(tea.id, 0)])
+        self.assertRaises(DataValidationError, Product.checkout, [('1', 1)])
+        self.assertRaises(DataValidationError, Product.checkout, [])
+
+    def test_stock_shards(self):
+        """ Split the stock of a hot Product across counters and buy from them """
+        product = Product(name="sneaker", category="shoes", stock=10, price=90)
+        product.save()
+        row = Product.set_stock_shards(product.id, 4)
+        self.assertEqual((row.stock, row.stock_shards), (10, 4))
+        self.assertEqual(Product.find_shards(product.id), [3, 3, 2, 2])
+        for left in (8, 6, 4):
+            bought = Product.purchase(product.id, 2)
+            self.assertEqual(bought.stock, left)
+        self.assertEqual(sum(Product.find_shards(product.id)), 4)
+        # no counter has 3 left on its own: the counters are rebalanced
+        self.assertEqual(Product.purchase(product.id, 3).stock, 1)
+        self.assertEqual(sorted(Product.find_shards(product.id)), [0, 0, 0, 1])
+        self.assertIsNone(Product.purchase(product.id, 2))
+        self.assertEqual(Product.find(product.id).stock, 1)
+        self.assertEqual(Product.find_row(product.id).stock, 1)
+        self.assertEqual(Product.find_by_filters(in_stock=True).count(), 1)
+        self.assertEqual(Product.find_by_filters(min_stock=2).count(), 0)
+        # the stock of the row is all in the counters
+        self.assertEqual(db.session.query(Product.__table__.c.stock).scalar(), 0)
+        self.assertRaises(DataValidationError, Product.set_stock_shards, product.id,
+                          STOCK_SHARDS_MAX + 1)
+        self.assertIsNone(Product.set_stock_shards(product.id + 1, 2))
+
+    def test_update_hot_product(self):
+        """ Set the stock of a hot Product through the ORM """
+        product = Product(name="console", category="games", stock=7, price=300)
+        product.save()
+        product_id = product.id
+        Product.set_stock_shards(product_id, 2)
+        db.session.remove()
+        product = Product.find(product_id)
+        self.assertEqual(product.stock, 7)
+        etag = product.etag()
+        product.stock = 21
+        product.save()
+        self.assertEqual(product.stock, 21)
+        self.assertNotEqual(product.etag(), etag)
+        self.assertEqual(Product.find_shards(product.id), [11, 10])
+        product.name = "console pro"
+        product.save()
+        self.assertEqual(Product.find_shards(product.id), [11, 10])
+        row = Product.set_stock_shards(product.id, 0)
+        self.assertEqual((row.stock, row.stock_shards), (21, 0))
+        self.assertEqual(Product.find_shards(product.id), [])
+        product = Product.find(product.id)
+        product.delete()
+        self.assertEqual(Product.all(), [])
+
+    def test_cool_idle_products(self):
+        """ Gather the stock of hot Products that are no longer bought """
+        busy = Product(name="phone", category="tech", stock=6, price=500)
+        busy.save()
+        idle = Product(name="watch", category="tech", stock=6, price=200)
+        idle.save()
+        Product.set_stock_shards(busy.id, 3)
+        Product.set_stock_shards(idle.id, 3)
+        Product.purchase(idle.id, 1)
+        self.assertEqual(Product.cool_idle(60), [])
+        with patch('service.model.time.time', return_value=time.time() + 120):
+            Product.purchase(busy.id, 1)
+            self.assertEqual(Product.cool_idle(60), [idle.id])
+        self.assertEqual(Product.find_row(idle.id).stock_shards, 0)
+        self.assertEqual(Product.find_row(idle.id).stock, 5)
+        self.assertEqual(Product.find_row(busy.id).stock_shards, 3)
+        # buys go back to the product row
+        self.assertEqual(Product.purchase(idle.id, 5).stock, 0)
+
+    def test_checkout_hot_products(self):
+        """ Check out a cart with hot and regular Products """
+        hot = Product(name="ticket", category="events", stock=4, price=50)
+        hot.save()
+        cold = Product(name="poster", category="events", stock=4, price=5)
+        cold.save()
+        Product.set_stock_shards(hot.id, 2)
+        rows, short = Product.checkout([(hot.id, 3), (cold.id, 1)])
+        self.assertEqual(short, [])
+        self.assertEqual([(row.id, row.stock) for row in rows], [(hot.id, 1), (cold.id, 3)])
+        rows, short = Product.checkout([(hot.id, 2), (cold.id, 1)])
+        self.assertEqual(short, [{'id': hot.id, 'requested': 2, 'available': 1}])
+        self.assertEqual(Product.find_row(cold.id).stock, 3)